@@ -7,10 +7,16 @@ from ..gui import build_gui
 def main(argv=None):
     parser = argparse.ArgumentParser(description="remote microscope monitor")
     parser.add_argument('hosts', nargs="+", metavar='HOST', help='the hosts to monitor')
-    parser.add_argument('--downsample', default=3, type=int, help='image downsampling to reduce load (default %(default)s).')
+    parser.add_argument('--downsample', default='auto', type=_downsample,
+        help='image downsampling to reduce load, or "auto" to choose downsampling and compression to reach the maximum FPS (default %(default)s).')
     parser.add_argument('--fps-max', type=int, default=5, help='maximum image update FPS to reduce load')
+    parser.add_argument('--pyramid-level', type=int, default=None,
+        help='show images binned by 2**N on the server, which looks better than downsampling, and transfers less data')
     args = parser.parse_args(argv)
-    build_gui.monitor_main(args.hosts, args.downsample, args.fps_max)
+    build_gui.monitor_main(args.hosts, args.downsample, args.fps_max, args.pyramid_level)
+
+def _downsample(value):
+    return value if value == 'auto' else int(value)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
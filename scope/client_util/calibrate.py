@@ -262,7 +262,7 @@ def get_averaged_images(scope, positions, dark_corrector, frames_to_average=5):
         for position in positions:
             scope.stage.position = position
             with scope.camera.image_sequence_acquisition(frames_to_average, trigger_mode='Internal'):
-                images = [scope.camera.next_image() for i in range(frames_to_average)]
+                images = scope.camera.next_images(frames_to_average)
             images = [dark_corrector.correct(image, exposure_ms) for image in images]
             position_images.append(numpy.mean(images, axis=0))
     return numpy.median(position_images, axis=0)
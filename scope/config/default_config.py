@@ -15,6 +15,7 @@ scope_configuration = dict(
         #('il.spectra', 'spectra.SpectraIII'), # dm6
         ('tl.lamp', 'tl_lamp.SutterLED_Lamp'),
         # ('camera', 'andor.Zyla'),
+        # ('camera', 'andor.simulated.SimulatedZyla'), # no hardware required
         ('camera.acquisition_sequencer', 'acquisition_sequencer.AcquisitionSequencer'),
         ('camera.autofocus', 'autofocus.Autofocus'),
         #('temperature_controller', 'temp_control.TorreyPinesPeltier'), # dm6000
@@ -31,6 +32,19 @@ scope_configuration = dict(
         RPC_INTERRUPT_PORT = '6001',
         PROPERTY_PORT = '6002',
         IMAGE_TRANSFER_RPC_PORT = '6003',
+        LIVE_BROADCAST_PORT = '6004', # for remote viewers of live images
+        # directory for Unix domain sockets for clients on the same host, or None. The server creates it if
+        # needed, and refuses to use it unless it is owned by the server's user and writable by nobody else.
+        IPC_DIR = '/usr/local/scope/ipc',
+        RPC_WORKERS = 8, # number of RPC commands that can run at once (on different devices)
+        PROPERTY_MAX_RATES = { # maximum publications per second of properties starting with each prefix
+            # Updates are always conflated (only the latest value is sent if a property changes faster
+            # than it can be published). To also cap the rate of live-mode frame number updates, e.g. for
+            # many remote viewers on a slow network, add 'scope.camera.frame_number': 30. Note that
+            # clients counting frames or measuring FPS from these updates then see at most that rate.
+            'scope.stage.': 20,
+        },
+        METRICS_LOG_INTERVAL = 600, # seconds between log summaries of the most time-consuming RPC commands, or None
     ),
 
     stand = dict(
@@ -57,6 +71,9 @@ scope_configuration = dict(
             arm = 'B1',
             aux_out1 = 'B2'
         ),
+        LIVE_BUFFER_COUNT = 3, # buffers queued with the camera in live mode
+        CONVERSION_WORKERS = 4, # threads converting acquired image sequences to uint16
+        # SIMULATED_READOUT_TIME_MS = 10, # full-frame readout time for andor.simulated cameras
     ),
 
     iotool = dict(
@@ -25,9 +25,24 @@ def get_addresses(host=None, config=None):
         rpc=make_tcp_host(host, config.server.RPC_PORT),
         interrupt=make_tcp_host(host, config.server.RPC_INTERRUPT_PORT),
         property=make_tcp_host(host, config.server.PROPERTY_PORT),
-        image_transfer_rpc=make_tcp_host(host, config.server.IMAGE_TRANSFER_RPC_PORT)
+        image_transfer_rpc=make_tcp_host(host, config.server.IMAGE_TRANSFER_RPC_PORT),
+        live_broadcast=make_tcp_host(host, config.server.get('LIVE_BROADCAST_PORT', '6004'))
      )
 
+def make_ipc_address(ipc_dir, name):
+    return 'ipc://{}/{}'.format(ipc_dir, name)
+
+def get_ipc_addresses(config=None):
+    """Return a dict of ipc:// (Unix domain socket) addresses, with the same
+    keys as get_addresses(), at which the server can also be reached by clients
+    on the same host; or None if IPC_DIR is not configured."""
+    if config is None:
+        config = get_config()
+    ipc_dir = config.server.get('IPC_DIR')
+    if not ipc_dir:
+        return None
+    return {name: make_ipc_address(ipc_dir, name) for name in ('rpc', 'interrupt', 'property', 'image_transfer_rpc')}
+
 _CONFIG = None
 
 def get_config():
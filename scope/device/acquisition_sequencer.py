@@ -3,6 +3,8 @@
 import time
 import collections
 from ..config import scope_configuration
+from ..simple_rpc import cancellation
+from ..simple_rpc import streaming
 from . import andor
 from . import iotool
 from . import spectra
@@ -205,6 +207,14 @@ class AcquisitionSequencer:
 
     def run(self):
         """Run the assembled acquisition steps and return the images obtained."""
+        names, return_value = streaming.collect(self.iter_run())
+        return names
+
+    def iter_run(self):
+        """Run the assembled acquisition steps as for run(), but yield each
+        image as soon as it has been obtained, so that images can be retrieved
+        while the acquisition continues. (Called over RPC, the images are
+        streamed to the client.)"""
         self._compile()
         # state stack: set tl_intensity to current intensity, so that if it gets set
         # as part of the acquisition, it will be returned to the current value. Must set it to
@@ -234,14 +244,20 @@ class AcquisitionSequencer:
                            config.spectra.TIMING.off_latency_ms + config.spectra.TIMING.fall_ms) / 1000)
             readout_ms = self._camera.get_readout_time() # get this after setting the relevant camera modes above
             self._exposures = [exp + readout_ms for exp in self._fire_all_time]
+            cancellation.check() # last chance to stop before the lamps and camera are triggered
             self._iotool.start_program()
-            names, self._latest_timestamps = [], []
-            for exposure in self._exposures:
-                name, timestamp, frame = self._camera.next_image_and_metadata(read_timeout_ms=exposure+1000)
-                names.append(name)
-                self._latest_timestamps.append(timestamp)
+            self._latest_timestamps = []
+            try:
+                for exposure in self._exposures:
+                    cancellation.check()
+                    name, timestamp, frame = self._camera.next_image_and_metadata(read_timeout_ms=exposure+1000)
+                    self._latest_timestamps.append(timestamp)
+                    yield name
+            except (cancellation.Cancelled, GeneratorExit):
+                # don't leave the program running if the acquisition is abandoned
+                self._iotool.stop()
+                raise
             self._output = self._iotool.wait_until_done()
-        return names
 
     def get_latest_timestamps(self):
         return self._latest_timestamps
@@ -63,13 +63,17 @@ import numpy
 import contextlib
 import collections
 import atexit
-import itertools
+import queue
+import concurrent.futures
 
 from . import lowlevel
 from .. import iotool
 from ...util import transfer_ism_buffer
 from ...util import property_device
 from ...util import timer
+from ...simple_rpc import cacheable
+from ...simple_rpc import cancellation
+from ...simple_rpc import streaming
 from ...config import scope_configuration
 
 from ...util import logging
@@ -146,6 +150,7 @@ class Camera(property_device.PropertyDevice):
         'sensor_temperature': '°C'
     }
     _MODEL_PREFIX = None # to be filled by subclass
+    _VOLATILE_PROPERTIES = ('sensor_temperature',) # polled every 10 seconds
 
     def __init__(self, property_server=None, property_prefix=''):
         # _updaters maps Andor property names to a function that will update the scope clients as to the new value
@@ -154,12 +159,15 @@ class Camera(property_device.PropertyDevice):
         self._defaulters = []
 
         super().__init__(property_server, property_prefix)
-        camera_name, software_version = lowlevel.initialize() # safe to call this multiple times
+        camera_name, software_version = self._initialize_lowlevel()
         if not camera_name.startswith(self._MODEL_PREFIX):
             lowlevel.close_camera()
             raise RuntimeError(f'Attached camera is "{camera_name}" but "{self._MODEL_PREFIX}" expected.')
 
         self._live_mode = False
+        self._conversion_workers = scope_configuration.get_config().camera.get('CONVERSION_WORKERS', 4)
+        self._convert_pool = concurrent.futures.ThreadPoolExecutor(self._conversion_workers,
+            thread_name_prefix='BufferConverter')
 
         # initialize properties
         names_and_props = list(self._CAMERA_PROPERTIES.items())
@@ -185,8 +193,15 @@ class Camera(property_device.PropertyDevice):
         self._frame_number = -1
         self._update_property('frame_number', self._frame_number)
         self._update_property('live_mode', self._live_mode)
+        self._set_live_dropped_frames(0)
         self._update_frame_rate_and_range()
         self._latest_data = None
+        self._image_listeners = []
+
+    def _initialize_lowlevel(self):
+        """Initialize the andor libraries and return the camera name and SDK
+        software version. Subclasses may override to use a different backend."""
+        return lowlevel.initialize() # safe to call this multiple times
 
     def _update_properties(self):
         self._updaters['SensorTemperature']()
@@ -326,6 +341,7 @@ class Camera(property_device.PropertyDevice):
             lowlevel.SetEnumString('IOSelector', io_pin)
             lowlevel.SetBool('IOInvert', False)
 
+    @cacheable.cacheable
     def get_camera_properties(self):
         """Return a dict mapping the property names to a dict with keys:
         (andor_type, read_only, units), where andor_type is one of
@@ -344,6 +360,7 @@ class Camera(property_device.PropertyDevice):
         properties['live_mode'] = dict(andor_type='Bool', read_only=False, units=None)
         return properties
 
+    @cacheable.cacheable
     def get_basic_properties(self):
         return self._BASIC_PROPERTIES
 
@@ -554,34 +571,54 @@ class Camera(property_device.PropertyDevice):
         that another image has been retrieved."""
         self._frame_number += 1
         self._latest_data = name, array, self._frame_number, timestamp
+        for listener in self._image_listeners:
+            listener(name, array, self._frame_number, timestamp)
         self._update_property('frame_number', self._frame_number)
 
+    def _add_image_listener(self, listener):
+        """Call listener(name, array, frame_number, timestamp) from the image
+        reading thread for each new image. The listener must return quickly, so
+        as not to hold up live imaging."""
+        self._image_listeners.append(listener)
+
     def _enable_live(self):
         """Turn on live-imaging mode. The basic strategy is to put the camera
         into software triggering mode with continuous cycling and then have a
         thread that simply executes a software trigger at the maximum possible
         rate given how fast the camera can operate (as determined by the logic
-        in _calculate_live_trigger_interval()). A single buffer is created and
-        repeatedly queued and waited on by a separate thread, which exists to
-        copy the result out to the output array via convert_buffer() as fast as
-        possible. Note that tight coupling between the trigger and the reader
-        threads is not required, as the camera has some RAM in which images
-        that have been acquired can be buffered before getting read out to the
-        computer via the Andor queue / wait commands."""
+        in _calculate_live_trigger_interval()). A small ring of buffers is kept
+        queued with the camera by a separate thread, which waits on them and
+        copies each result out to an output array via convert_buffer() as fast
+        as possible. With several buffers queued, the camera can fill one while
+        the previous one is being converted. If the reader thread falls behind,
+        it skips to the newest frame available, counting the skipped frames in
+        the live_dropped_frames property. Note that tight coupling between the
+        trigger and the reader threads is not required, as the camera has some
+        RAM in which images that have been acquired can be buffered before
+        getting read out to the computer via the Andor queue / wait commands."""
         if self._live_mode:
             return
         lowlevel.Flush()
         self.push_state(cycle_mode='Continuous', trigger_mode='Software')
         trigger_interval = self._calculate_live_trigger_interval()
-        namebase = 'live@-'+str(time.time())
-        buffer_maker = BufferFactory(namebase, frame_count=1, cycle=True)
+        buffer_count = scope_configuration.get_config().camera.get('LIVE_BUFFER_COUNT', 3)
+        buffer_maker = BufferFactory(frame_count=buffer_count)
         self._live_mode = True
+        self._set_live_dropped_frames(0)
         lowlevel.Command('AcquisitionStart')
-        def update():
-            self._update_image_data(*buffer_maker.convert_buffer())
-        self._live_reader = LiveReader(buffer_maker.queue_buffer, update, trigger_interval)
+        self._live_reader = LiveReader(buffer_maker, buffer_count, self._update_image_data,
+            self._set_live_dropped_frames, trigger_interval)
         self._live_trigger = LiveTrigger(trigger_interval, self._live_reader)
 
+    def _set_live_dropped_frames(self, dropped_frames):
+        self._live_dropped_frames = dropped_frames
+        self._update_property('live_dropped_frames', dropped_frames)
+
+    def get_live_dropped_frames(self):
+        """Number of frames acquired in the current (or most recent) round of
+        live imaging that were skipped because the image reader fell behind."""
+        return self._live_dropped_frames
+
     def _calculate_live_trigger_interval(self):
         """Determine how long to wait between sending acquisition triggers in
         live mode, based on data from the andor API.
@@ -604,6 +641,13 @@ class Camera(property_device.PropertyDevice):
         self._live_mode = False
         self.pop_state()
 
+    def get_image_pool_stats(self):
+        """Return statistics about the pool of shared memory buffers that images
+        are stored in, for each image shape: the number of buffers in use and
+        the high-water mark thereof, the numbers free and awaiting release by
+        clients, and how many buffers have been created, reused and discarded."""
+        return transfer_ism_buffer.pool_stats()
+
     def get_live_fps(self):
         if not self._live_mode:
             return
@@ -658,10 +702,6 @@ class Camera(property_device.PropertyDevice):
         state.
 
         """
-        if frame_count == 1:
-            namebase = 'acquire@'+str(time.time())
-        else:
-            namebase = 'sequence@{}-'.format(time.time())
         if frame_count is None:
             cycle_mode = 'Continuous'
         else:
@@ -670,13 +710,12 @@ class Camera(property_device.PropertyDevice):
         self.push_state(live_mode=False) # turn off live mode first so that when we push the rest of the state, we don't get state parameters that are valid only for live mode
         self.push_state(cycle_mode=cycle_mode, trigger_mode=trigger_mode, **camera_params)
         lowlevel.Flush()
-        self._buffer_maker = BufferFactory(namebase, frame_count=frame_count, cycle=False)
-        if frame_count is not None:
-            # if we have a known number of images to acquire, create and queue buffers for them now.
-            # however, don't queue up more than a gig or so of images
-            max_queue = int(1024**3 / self.get_image_byte_count())
-            for i in range(min(max_queue, frame_count)):
-                self._buffer_maker.queue_buffer()
+        # if we have a known number of images to acquire, create and queue buffers for them now.
+        # however, don't queue up more than a gig or so of images
+        max_queue = int(1024**3 / self.get_image_byte_count())
+        max_pending = 2 * self._conversion_workers
+        self._sequence_reader = SequenceReader(BufferFactory(frame_count), frame_count,
+            max_queue, max_pending, self._convert_pool)
         lowlevel.Command('AcquisitionStart')
 
     def next_image_and_metadata(self, read_timeout_ms=None):
@@ -686,15 +725,15 @@ class Camera(property_device.PropertyDevice):
         or an AndorError of TIMEDOUT will be raised. If the timeout is None,
         then the call will block until an image becomes available.
 
+        Images are waited for and converted in the background as soon as the
+        camera delivers them, so this only has to collect the next finished
+        frame (in acquisition order).
+
         Returns the image, timestamp, and frame number.
         """
-        if read_timeout_ms is None:
-            read_timeout_ms = lowlevel.ANDOR_INFINITE
-        else:
+        if read_timeout_ms is not None:
             read_timeout_ms = int(round(read_timeout_ms))
-        self._buffer_maker.queue_if_needed()
-        lowlevel.WaitBuffer(read_timeout_ms)
-        self._update_image_data(*self._buffer_maker.convert_buffer())
+        self._update_image_data(*self._sequence_reader.next_frame(read_timeout_ms))
         return self.latest_image()
 
     def next_image(self, read_timeout_ms=None):
@@ -710,11 +749,12 @@ class Camera(property_device.PropertyDevice):
 
     def end_image_sequence_acquisition(self):
         """Stop an image-acquisition sequence and perform necessary cleanup."""
+        self._sequence_reader.stop() # must stop waiting on buffers before the acquisition is stopped
         lowlevel.Command('AcquisitionStop')
         lowlevel.Flush()
         self.pop_state() # need to pop twice because we pushed twice in start_image_sequence_acquisition() (see above)
         self.pop_state()
-        del self._buffer_maker
+        del self._sequence_reader
 
     @contextlib.contextmanager
     def image_sequence_acquisition(self, frame_count=1, trigger_mode='Internal', **camera_params):
@@ -797,19 +837,30 @@ class Camera(property_device.PropertyDevice):
 
         Returns: images, timestamps, attempted_frame_rate
 
+        """
+        frames, frame_rate = streaming.collect(self.iter_stream_acquire(frame_count, frame_rate, **camera_params))
+        image_names = [name for name, timestamp in frames]
+        timestamps = [timestamp for name, timestamp in frames]
+        return image_names, timestamps, frame_rate
+
+    def iter_stream_acquire(self, frame_count, frame_rate, **camera_params):
+        """Acquire images as for stream_acquire(), but yield (image_name, timestamp)
+        for each frame as soon as it has been read out, so that images can be
+        retrieved while the acquisition continues. (Called over RPC, the
+        results are streamed to the client.)
+
+        Returns: attempted_frame_rate, once all frames have been acquired.
         """
         frame_rate, overlap = self.calculate_streaming_mode(frame_count, frame_rate,
             trigger_mode='Internal', **camera_params)
-        image_names = []
-        timestamps = []
         with self.image_sequence_acquisition(frame_count, frame_rate=frame_rate,
                 trigger_mode='Internal', overlap_enabled=overlap, **camera_params):
             read_time = 1/min(self.get_max_interface_fps(), frame_rate)
             for _ in range(frame_count):
+                cancellation.check() # stop early if the acquisition is no longer wanted
                 name, timestamp, frame = self.next_image_and_metadata(3 * read_time * 1000)
-                image_names.append(name)
-                timestamps.append(timestamp)
-        return image_names, timestamps, frame_rate
+                yield name, timestamp
+        return frame_rate
 
     def get_iotool_trigger_command(self):
         """Get a sequence of IOTool commands to trigger the camera"""
@@ -822,21 +873,15 @@ class Camera(property_device.PropertyDevice):
 UINT8_P = ctypes.POINTER(ctypes.c_uint8)
 
 class BufferFactory:
-    def __init__(self, namebase, frame_count=1, cycle=False):
+    def __init__(self, frame_count=1):
         width, height, stride = map(lowlevel.GetInt, ('AOIWidth', 'AOIHeight', 'AOIStride'))
         self.buffer_shape = (width, height)
         input_encoding = lowlevel.GetEnumStringByIndex('PixelEncoding', lowlevel.GetEnumIndex('PixelEncoding'))
         self.convert_buffer_args = (width, height, stride, input_encoding, 'Mono16')
         image_bytes = lowlevel.GetInt('ImageSizeBytes')
         self.queued_buffers = collections.deque()
-        if cycle:
-            self.buffers = itertools.cycle([numpy.empty(image_bytes, dtype=numpy.uint8) for i in range(frame_count)])
-        else:
-            self.buffers = self._new_buffer_iter(image_bytes, frame_count)
-        if frame_count == 1 and not cycle:
-            self.names = iter([namebase])
-        else:
-            self.names = self._name_iter(namebase)
+        self.free_buffers = collections.deque() # buffers converted by convert_and_recycle(), ready for reuse
+        self.buffers = self._new_buffer_iter(image_bytes, frame_count)
 
     def _new_buffer_iter(self, image_bytes, frame_count):
         i = 0
@@ -846,26 +891,39 @@ class BufferFactory:
             if frame_count is not None and i == frame_count:
                 return
 
-    def _name_iter(self, namebase):
-        i = 0
-        while True:
-            yield namebase + str(i)
-            i += 1
-
-    def queue_buffer(self):
-        buffer = next(self.buffers)
+    def queue_buffer(self, buffer=None):
+        """Queue a new (or recycled) buffer with the camera, or re-queue the given buffer."""
+        if buffer is None:
+            buffer = self.free_buffers.pop() if self.free_buffers else next(self.buffers)
         lowlevel.QueueBuffer(buffer.ctypes.data_as(UINT8_P), len(buffer))
         self.queued_buffers.append(buffer)
 
-    def queue_if_needed(self):
-        if not self.queued_buffers:
-            self.queue_buffer()
+    def skip_buffer(self):
+        """Re-queue the oldest filled buffer without converting its contents."""
+        self.queue_buffer(self.queued_buffers.popleft())
 
-    def convert_buffer(self):
-        name = next(self.names)
-        output_array = transfer_ism_buffer.create_array(name, shape=self.buffer_shape,
-            dtype=numpy.uint16, order='F')
+    def convert_buffer(self, requeue=False):
+        """Convert the oldest filled buffer into a new array, and return the
+        array's name, the array, and the frame timestamp. If requeue is True,
+        queue the buffer with the camera again once it has been converted."""
         buffer = self.queued_buffers.popleft()
+        result = self.convert(buffer)
+        if requeue:
+            self.queue_buffer(buffer)
+        return result
+
+    def convert_and_recycle(self, buffer):
+        """Convert a filled buffer that has already been removed from
+        queued_buffers, and then make it available for reuse by queue_buffer().
+        Safe to call from a worker thread."""
+        try:
+            return self.convert(buffer)
+        finally:
+            self.free_buffers.append(buffer)
+
+    def convert(self, buffer):
+        name, output_array = transfer_ism_buffer.new_pooled_array(shape=self.buffer_shape,
+            dtype=numpy.uint16, order='F')
         timestamp = parse_buffer_metadata(buffer, 1) # timestamp is metadata CID 1
         if timestamp is not None:
             timestamp = timestamp.view('<u8')[0] # timestamp is 8 bytes of little-endian unsigned int
@@ -926,6 +984,104 @@ class LiveModeThread(threading.Thread):
     def loop(self):
         raise NotImplementedError()
 
+class SequenceReader(LiveModeThread):
+    POLL_INTERVAL_MS = 250
+
+    def __init__(self, buffer_maker, frame_count, max_queue, max_pending, convert_pool):
+        """Wait on buffers filled by an image-sequence acquisition and hand
+        them off to convert_pool for conversion, so that waiting on the camera,
+        converting, and sending images to the client all overlap.
+
+        Parameters
+            buffer_maker: BufferFactory for the acquisition
+            frame_count: number of frames to read, or None to read until stopped
+            max_queue: maximum number of buffers to keep queued with the camera
+            max_pending: maximum number of frames that may be converted (or
+                in conversion) but not yet retrieved with next_frame(). Beyond
+                this, frames are left in the camera RAM until there is room.
+            convert_pool: concurrent.futures.Executor to run conversions in.
+        """
+        self.buffer_maker = buffer_maker
+        self.frames_to_read = frame_count
+        self.convert_pool = convert_pool
+        self.frames = queue.Queue() # futures for converted frames, in acquisition order
+        self.pending = threading.Semaphore(max_pending)
+        self.next_future = None
+        queue_count = max_pending if frame_count is None else min(max_queue, frame_count)
+        self.frames_to_queue = None if frame_count is None else frame_count - queue_count
+        for i in range(queue_count):
+            buffer_maker.queue_buffer()
+        super().__init__()
+
+    def stop(self):
+        super().stop()
+        # release the pooled arrays of any frames converted but never retrieved
+        futures = [] if self.next_future is None else [self.next_future]
+        self.next_future = None
+        while True:
+            try:
+                futures.append(self.frames.get_nowait())
+            except queue.Empty:
+                break
+        for future in futures:
+            future.cancel()
+        concurrent.futures.wait(futures)
+
+    def loop(self):
+        try:
+            self._read_frame()
+        except Exception as e:
+            # don't leave anyone waiting forever for a frame that will never come
+            self._fail(e)
+            raise
+
+    def _fail(self, exception):
+        # pass the error on to whoever is waiting for the next frame
+        future = concurrent.futures.Future()
+        future.set_exception(exception)
+        self.frames.put(future)
+        self.running = False
+
+    def _read_frame(self):
+        if self.frames_to_read == 0:
+            self.running = False
+            return
+        if not self.pending.acquire(timeout=self.POLL_INTERVAL_MS / 1000):
+            return
+        try:
+            lowlevel.WaitBuffer(self.POLL_INTERVAL_MS)
+        except lowlevel.AndorError as e:
+            self.pending.release()
+            if e.args[0].startswith('TIMEDOUT'):
+                return
+            self._fail(e)
+            return
+        buffer = self.buffer_maker.queued_buffers.popleft()
+        self.frames.put(self.convert_pool.submit(self.buffer_maker.convert_and_recycle, buffer))
+        if self.frames_to_read is not None:
+            self.frames_to_read -= 1
+        if self.frames_to_queue is None or self.frames_to_queue > 0:
+            self.buffer_maker.queue_buffer()
+            if self.frames_to_queue is not None:
+                self.frames_to_queue -= 1
+
+    def next_frame(self, timeout_ms=None):
+        """Return the name, array, and timestamp of the next frame, waiting up
+        to timeout_ms (or forever if None) for it to be acquired and converted."""
+        timeout = None if timeout_ms is None else timeout_ms / 1000
+        t0 = time.time()
+        try:
+            if self.next_future is None:
+                self.next_future = self.frames.get(timeout=timeout)
+                if timeout is not None:
+                    timeout = max(0, timeout - (time.time() - t0))
+            result = self.next_future.result(timeout)
+        except (queue.Empty, concurrent.futures.TimeoutError):
+            raise lowlevel.AndorError(f'TIMEDOUT error when waiting {timeout_ms} ms for next image')
+        self.next_future = None
+        self.pending.release()
+        return result
+
 class LiveTrigger(LiveModeThread):
     def __init__(self, trigger_interval, live_reader):
         self.trigger_interval = trigger_interval
@@ -950,31 +1106,37 @@ class LiveTrigger(LiveModeThread):
 
 
 class LiveReader(LiveModeThread):
-    def __init__(self, queue_buffer, update, trigger_interval):
-        """Repeatedly queue a buffer with the given queue_buffer() function,
-        wait for it to be filled via the Andor API, then call
-        update() which (presumably) will deal with the buffer
-        contents. The argument image_count is the index of the frame retrieved
-        since the start of this round of live imaging.
+    def __init__(self, buffer_maker, buffer_count, update, set_dropped_frames, trigger_interval):
+        """Keep buffer_count buffers from the given BufferFactory queued with
+        the Andor API, and as each is filled, convert it and call
+        update(name, array, timestamp) with the results. If several buffers have
+        been filled by the time the reader gets to them, only the newest is
+        converted, and set_dropped_frames() is called with the total number of
+        frames skipped so far.
         NB: update() is called in this background thread, so any operations
         therein must be thread-safe."""
-        self.queue_buffer = queue_buffer
+        self.buffer_maker = buffer_maker
+        self.buffer_count = buffer_count
         self.update = update
+        self.set_dropped_frames = set_dropped_frames
         self.latest_intervals = collections.deque(maxlen=10) # cyclic buffer containing intervals between recent image reads (for FPS calculations)
         self.image_count = 0 # number of frames retrieved
+        self.dropped_count = 0 # number of frames retrieved but skipped
         self.ready = threading.Event()
         self.set_timeout(trigger_interval)
         self.timeout_count = 0
         super().__init__()
-        self.ready.wait() # don't return from init until a buffer is queued
+        self.ready.wait() # don't return from init until buffers are queued
 
     def set_timeout(self, trigger_interval):
         self.timeout = 250 + int(1000 * trigger_interval) * 3 # convert to ms and triple plus add 250 ms for safety margin
 
     def loop(self):
         t = time.time()
-        self.queue_buffer()
-        self.ready.set()
+        if not self.ready.is_set():
+            for i in range(self.buffer_count):
+                self.buffer_maker.queue_buffer()
+            self.ready.set()
         try:
             # with no timeout, we would have to make sure to stop the reader thread before
             # the trigger thread -- otherwise the reader would just block forever waiting
@@ -995,7 +1157,25 @@ class LiveReader(LiveModeThread):
                 return
             else:
                 raise
-        self.update()
-        self.image_count += 1
+        # live mode only needs the newest frame, so if more frames are already
+        # waiting, skip straight to the last of them
+        dropped = 0
+        while self._next_buffer_ready():
+            self.buffer_maker.skip_buffer()
+            dropped += 1
+        self.update(*self.buffer_maker.convert_buffer(requeue=True))
+        self.image_count += 1 + dropped
+        if dropped:
+            self.dropped_count += dropped
+            self.set_dropped_frames(self.dropped_count)
         self.latest_intervals.append(time.time() - t)
 
+    def _next_buffer_ready(self):
+        try:
+            lowlevel.WaitBuffer(0)
+            return True
+        except lowlevel.AndorError as e:
+            if e.args[0].startswith('TIMEDOUT'):
+                return False
+            raise
+
@@ -146,6 +146,21 @@ def initialize():
     software_version = _string_for_handle(_AT_HANDLE_SYSTEM, 'SoftwareVersion')
     return camera_name, software_version
 
+def initialize_simulated(core_lib, util_lib):
+    """Initialize the andor wrapper to use pure-python stand-ins for the
+    andor libraries (see simulated.py) in place of the real ones."""
+    if wrapper._at_core_lib is None:
+        wrapper._at_core_lib = core_lib
+        wrapper._at_core_lib.AT_InitialiseLibrary()
+        atexit.register(wrapper._at_core_lib.AT_FinaliseLibrary)
+    if wrapper._at_util_lib is None:
+        wrapper._at_util_lib = util_lib
+        wrapper._at_util_lib.AT_InitialiseUtilityLibrary()
+        atexit.register(wrapper._at_util_lib.AT_FinaliseUtilityLibrary)
+    camera_name = _init_camera()
+    software_version = _string_for_handle(_AT_HANDLE_SYSTEM, 'SoftwareVersion')
+    return camera_name, software_version
+
 def close_camera():
     if wrapper._at_camera_handle is not None:
         wrapper._at_core_lib.AT_Close(wrapper._at_camera_handle)
@@ -0,0 +1,792 @@
+# This code is licensed under the MIT License (see LICENSE file for details)
+
+"""Pure-python stand-ins for the Andor SDK3 core and utility libraries, so that
+the camera classes can run (and be profiled) without any camera hardware.
+
+The lowlevel wrapper functions call into the SDK only via the ctypes function
+objects of wrapper._at_core_lib and wrapper._at_util_lib. SimulatedCoreLib and
+SimulatedUtilLib provide methods with the same names and calling conventions
+(i.e. input parameters in, output parameters returned), backed by a model of
+the camera's features, its trigger modes, overlap and frame-rate constraints,
+sensor readout timing, on-head RAM, and the metadata chunks appended to each
+image buffer. Errors are raised as AndorErrors formatted just like those that
+wrapper._at_errcheck produces.
+
+To run the scope server with a simulated camera, use one of the classes below
+in the configuration's driver list, e.g.:
+    ('camera', 'andor.simulated.SimulatedZyla'),
+
+The full-frame sensor readout time (in ms, at the fastest pixel readout rate)
+can be set with camera.SIMULATED_READOUT_TIME_MS in the configuration file.
+
+As there is no hardware to send trigger pulses, the external trigger modes are
+simulated as internal triggering at the current frame rate.
+"""
+
+import collections
+import ctypes
+import random
+import struct
+import threading
+import time
+
+import numpy
+
+from . import camera
+from . import common
+from . import lowlevel
+from ...config import scope_configuration
+
+UINT8_P = ctypes.POINTER(ctypes.c_uint8)
+UINT16_P = ctypes.POINTER(ctypes.c_uint16)
+
+_SYSTEM_HANDLE = 1
+_CAMERA_HANDLE = 2
+_TIMESTAMP_HZ = 100000000
+_IMAGE_CID = 0
+_TIMESTAMP_CID = 1
+
+_TRIGGER_MODES = ['Internal', 'Software', 'External', 'External Start', 'External Exposure']
+
+# Feature values that change without any action from the user: the real SDK
+# does not issue feature callbacks for these.
+_UNWATCHED_FEATURES = {'TimestampClock', 'SensorTemperature'}
+
+# Features that may be written while an acquisition is running.
+_WRITABLE_WHILE_ACQUIRING = {'ExposureTime', 'FrameRate', 'IOSelector', 'IOInvert', 'AuxiliaryOutSource'}
+
+ZYLA_MODEL = dict(
+    model_name='ZYLA-5.5-CL10',
+    interface_type='CL 10 Tap',
+    interface_bytes_per_sec=850e6,
+    sensor_size=(2560, 2160),
+    temperature='0.00',
+    io_pins=camera.Zyla._IO_PINS,
+    features=dict(
+        AccumulateCount=('Int', 1),
+        ElectronicShutteringMode=('Enum', ['Rolling', 'Global']),
+        PixelReadoutRate=('Enum', ['100 MHz', '280 MHz']),
+        SimplePreAmpGainControl=('Enum', list(camera.Zyla._GAIN_TO_ENCODING)),
+        StaticBlemishCorrection=('Bool', True),
+        TemperatureControl=('Enum', ['0.00']),
+    ),
+    readonly=set()
+)
+
+SONA_MODEL = dict(
+    model_name='SONA-4BV11',
+    interface_type='USB3',
+    interface_bytes_per_sec=380e6,
+    sensor_size=(2048, 2048),
+    temperature='-25.0',
+    io_pins=camera.Sona._IO_PINS,
+    features=dict(
+        CameraFamily=('String', 'Sona'),
+        ElectronicShutteringMode=('Enum', ['Rolling']),
+        GainMode=('Enum', list(camera.Sona._GAIN_TO_ENCODING)),
+        PixelReadoutRate=('Enum', ['100 MHz']),
+        TemperatureControl=('Enum', ['-25.0', '-45.0']),
+    ),
+    readonly={'CameraFamily', 'ElectronicShutteringMode', 'PixelReadoutRate'}
+)
+
+def _andor_error(error, function, *args):
+    # same formatting as common._at_errcheck so that callers parsing the error type still work
+    return common.AndorError('{} error when calling {}({})'.format(error, function, ' ,'.join(map(str, args))))
+
+class SimulatedCoreLib:
+    """Stand-in for the Andor SDK3 core library (libatcore.so)."""
+    def __init__(self, model, readout_time_ms=10):
+        """Parameters:
+            model: one of the *_MODEL dicts in this module.
+            readout_time_ms: full-frame sensor readout time at the fastest
+                pixel readout rate.
+        """
+        self._model = model
+        self._full_readout_time = readout_time_ms / 1000
+        self._lock = threading.RLock()
+        self._buffer_ready = threading.Condition(self._lock)
+        self._callbacks = collections.defaultdict(list)
+        self._clock_zero = time.perf_counter()
+        sensor_width, sensor_height = model['sensor_size']
+        self._features = dict(
+            AOIHeight=('Int', sensor_height),
+            AOILeft=('Int', 1),
+            AOIStride=('Int', None),
+            AOITop=('Int', 1),
+            AOIWidth=('Int', sensor_width),
+            AuxiliaryOutSource=('Enum', ['FireRow1', 'FireRowN', 'FireAll', 'FireAny']),
+            AOIBinning=('Enum', ['1x1', '2x2', '3x3', '4x4', '8x8']),
+            BitDepth=('Enum', ['11 Bit or 12 Bit', '16 Bit']),
+            CameraAcquiring=('Bool', None),
+            CameraModel=('String', model['model_name']),
+            CycleMode=('Enum', ['Fixed', 'Continuous']),
+            ExposureTime=('Float', 0.01),
+            FanSpeed=('Enum', ['Off', 'Low', 'On']),
+            FirmwareVersion=('String', 'simulated'),
+            FrameCount=('Int', 1),
+            FrameRate=('Float', 1),
+            ImageSizeBytes=('Int', None),
+            InterfaceType=('String', model['interface_type']),
+            IOInvert=('Bool', None),
+            IOSelector=('Enum', list(model['io_pins'])),
+            MaxInterfaceTransferRate=('Float', None),
+            MetadataEnable=('Bool', False),
+            MetadataTimestamp=('Bool', False),
+            Overlap=('Bool', False),
+            PixelEncoding=('Enum', ['Mono12', 'Mono12Packed', 'Mono16', 'Mono32']),
+            PixelHeight=('Float', 6.5),
+            PixelWidth=('Float', 6.5),
+            ReadoutTime=('Float', None),
+            RowReadTime=('Float', None),
+            SensorCooling=('Bool', False),
+            SensorHeight=('Int', sensor_height),
+            SensorTemperature=('Float', None),
+            SensorWidth=('Int', sensor_width),
+            SerialNumber=('String', 'SIM-00001'),
+            SpuriousNoiseFilter=('Bool', False),
+            TemperatureStatus=('Enum', ['Cooler Off', 'Stabilised', 'Cooling', 'Drift', 'Not Stabilised', 'Fault']),
+            TimestampClock=('Int', None),
+            TimestampClockFrequency=('Int', _TIMESTAMP_HZ),
+            TriggerMode=('Enum', _TRIGGER_MODES),
+            AcquisitionStart=('Command', None),
+            AcquisitionStop=('Command', None),
+            SoftwareTrigger=('Command', None),
+            TimestampClockReset=('Command', None),
+        )
+        self._features.update(model['features'])
+        self._readonly = {'AOIStride', 'BitDepth', 'CameraAcquiring', 'CameraModel', 'FirmwareVersion',
+            'ImageSizeBytes', 'InterfaceType', 'MaxInterfaceTransferRate', 'PixelHeight', 'PixelWidth',
+            'ReadoutTime', 'RowReadTime', 'SensorHeight', 'SensorTemperature', 'SensorWidth',
+            'SerialNumber', 'TemperatureStatus', 'TimestampClock', 'TimestampClockFrequency'}
+        self._readonly.update(model['readonly'])
+        self._values = {}
+        for feature, (at_type, value) in self._features.items():
+            if at_type == 'Enum':
+                value = value[0]
+            self._values[feature] = value
+        self._values['TemperatureControl'] = model['temperature']
+        self._values['TemperatureStatus'] = 'Stabilised'
+        self._values['PixelEncoding'] = 'Mono16'
+        self._io_inverted = dict.fromkeys(model['io_pins'], False)
+        self._computed = dict(
+            AOIStride=self._get_stride,
+            BitDepth=self._get_bit_depth,
+            CameraAcquiring=lambda: self._acquiring,
+            FrameRate=self._get_frame_rate,
+            ImageSizeBytes=self._get_image_bytes,
+            IOInvert=lambda: self._io_inverted[self._values['IOSelector']],
+            MaxInterfaceTransferRate=lambda: model['interface_bytes_per_sec'] / self._get_image_bytes(),
+            Overlap=self._get_overlap,
+            ReadoutTime=self._get_readout_time,
+            RowReadTime=self._get_row_read_time,
+            SensorTemperature=lambda: float(self._values['TemperatureControl']) + random.gauss(0, 0.05),
+            TimestampClock=self._get_timestamp
+        )
+        self._ranges = dict(
+            AccumulateCount=lambda: (1, 2**31-1),
+            AOIHeight=lambda: (1, self._sensor_aoi_limit(1) - self._values['AOITop'] + 1),
+            AOILeft=lambda: (1, self._sensor_aoi_limit(0) - self._values['AOIWidth'] + 1),
+            AOITop=lambda: (1, self._sensor_aoi_limit(1) - self._values['AOIHeight'] + 1),
+            AOIWidth=lambda: (1, self._sensor_aoi_limit(0) - self._values['AOILeft'] + 1),
+            ExposureTime=self._get_exposure_range,
+            FrameCount=lambda: (1, 2**31-1),
+            FrameRate=self._get_frame_rate_range
+        )
+
+        # acquisition state: guarded by self._lock
+        self._acquiring = False
+        self._acquisition_thread = None
+        self._queued = collections.deque() # (address, size) of buffers queued by QueueBuffer
+        self._filled = collections.deque() # (address, size) of buffers ready for WaitBuffer
+        self._camera_ram = collections.deque() # timestamps of acquired frames waiting for a queued buffer
+        self._pending_triggers = collections.deque() # completion times of software-triggered frames
+        self._next_trigger_allowed = 0
+        self._overflowed = False
+        self._frame_templates = {}
+
+    # library setup / teardown
+    def AT_InitialiseLibrary(self):
+        pass
+
+    def AT_FinaliseLibrary(self):
+        self._stop_acquisition()
+
+    def AT_Open(self, index):
+        if index != 0:
+            raise _andor_error('INVALIDHANDLE', 'AT_Open', index)
+        return _CAMERA_HANDLE
+
+    def AT_Close(self, handle):
+        self._stop_acquisition()
+
+    # feature callbacks
+    def AT_RegisterFeatureCallback(self, handle, feature, callback, context):
+        self._check_feature('AT_RegisterFeatureCallback', handle, feature)
+        with self._lock:
+            self._callbacks[feature].append((callback, context))
+
+    def AT_UnregisterFeatureCallback(self, handle, feature, callback, context):
+        with self._lock:
+            try:
+                self._callbacks[feature].remove((callback, context))
+            except ValueError:
+                raise _andor_error('NULL_EVCALLBACK', 'AT_UnregisterFeatureCallback', handle, feature)
+
+    # feature introspection
+    def AT_IsImplemented(self, handle, feature):
+        return self._is_implemented(handle, feature)
+
+    def AT_IsReadable(self, handle, feature):
+        return self._is_implemented(handle, feature) and self._features[feature][0] != 'Command'
+
+    def AT_IsWritable(self, handle, feature):
+        return self._is_writable(handle, feature)
+
+    def AT_IsReadOnly(self, handle, feature):
+        return feature in self._readonly
+
+    # numeric features
+    def AT_SetInt(self, handle, feature, value):
+        self._set_numeric('AT_SetInt', handle, feature, int(value))
+
+    def AT_GetInt(self, handle, feature):
+        return int(self._get('AT_GetInt', handle, feature, ('Int', 'Float')))
+
+    def AT_GetIntMax(self, handle, feature):
+        return int(self._get_range('AT_GetIntMax', handle, feature)[1])
+
+    def AT_GetIntMin(self, handle, feature):
+        return int(self._get_range('AT_GetIntMin', handle, feature)[0])
+
+    def AT_SetFloat(self, handle, feature, value):
+        self._set_numeric('AT_SetFloat', handle, feature, float(value))
+
+    def AT_GetFloat(self, handle, feature):
+        return float(self._get('AT_GetFloat', handle, feature, ('Int', 'Float')))
+
+    def AT_GetFloatMax(self, handle, feature):
+        return float(self._get_range('AT_GetFloatMax', handle, feature)[1])
+
+    def AT_GetFloatMin(self, handle, feature):
+        return float(self._get_range('AT_GetFloatMin', handle, feature)[0])
+
+    # boolean features
+    def AT_SetBool(self, handle, feature, value):
+        self._check_writable('AT_SetBool', handle, feature, ('Bool',))
+        with self._notifying():
+            if feature == 'IOInvert':
+                self._io_inverted[self._values['IOSelector']] = bool(value)
+            else:
+                self._values[feature] = bool(value)
+            if feature == 'Overlap' and value and self._values['ElectronicShutteringMode'] == 'Global':
+                # global-shutter overlap mode forces the exposure to be at least the readout time
+                self._values['ExposureTime'] = max(self._values['ExposureTime'], self._get_readout_time())
+
+    def AT_GetBool(self, handle, feature):
+        return int(bool(self._get('AT_GetBool', handle, feature, ('Bool',))))
+
+    # enumerated features
+    def AT_SetEnumIndex(self, handle, feature, index):
+        self._check_writable('AT_SetEnumIndex', handle, feature, ('Enum',))
+        values = self._features[feature][1]
+        if not 0 <= index < len(values):
+            raise _andor_error('INDEXNOTAVAILABLE', 'AT_SetEnumIndex', handle, feature, index)
+        self._set_enum(feature, values[index])
+
+    def AT_SetEnumString(self, handle, feature, string):
+        self._check_writable('AT_SetEnumString', handle, feature, ('Enum',))
+        if string not in self._features[feature][1]:
+            raise _andor_error('STRINGNOTAVAILABLE', 'AT_SetEnumString', handle, feature, string)
+        self._set_enum(feature, string)
+
+    def AT_GetEnumIndex(self, handle, feature):
+        value = self._get('AT_GetEnumIndex', handle, feature, ('Enum',))
+        return self._features[feature][1].index(value)
+
+    def AT_GetEnumCount(self, handle, feature):
+        self._check_feature('AT_GetEnumCount', handle, feature, ('Enum',))
+        return len(self._features[feature][1])
+
+    def AT_IsEnumIndexAvailable(self, handle, feature, index):
+        return self.AT_IsEnumIndexImplemented(handle, feature, index)
+
+    def AT_IsEnumIndexImplemented(self, handle, feature, index):
+        self._check_feature('AT_IsEnumIndexImplemented', handle, feature, ('Enum',))
+        return 0 <= index < len(self._features[feature][1])
+
+    def AT_GetEnumStringByIndex(self, handle, feature, index, string, length):
+        self._check_feature('AT_GetEnumStringByIndex', handle, feature, ('Enum',))
+        values = self._features[feature][1]
+        if not 0 <= index < len(values):
+            raise _andor_error('INDEXNOTIMPLEMENTED', 'AT_GetEnumStringByIndex', handle, feature, index)
+        string.value = values[index]
+
+    # string features
+    def AT_SetString(self, handle, feature, string):
+        self._check_writable('AT_SetString', handle, feature, ('String',))
+        with self._notifying():
+            self._values[feature] = string
+
+    def AT_GetString(self, handle, feature, string, length):
+        if handle == _SYSTEM_HANDLE and feature == 'SoftwareVersion':
+            value = 'simulated'
+        else:
+            value = self._get('AT_GetString', handle, feature, ('String',))
+        if len(value) >= length:
+            raise _andor_error('EXCEEDEDMAXSTRINGLENGTH', 'AT_GetString', handle, feature)
+        string.value = value
+
+    def AT_GetStringMaxLength(self, handle, feature):
+        self._check_feature('AT_GetStringMaxLength', handle, feature, ('String',))
+        return 255
+
+    # commands
+    def AT_Command(self, handle, feature):
+        self._check_feature('AT_Command', handle, feature, ('Command',))
+        if feature == 'AcquisitionStart':
+            with self._notifying():
+                self._start_acquisition()
+        elif feature == 'AcquisitionStop':
+            with self._notifying():
+                thread = self._end_acquisition()
+            self._join_acquisition_thread(thread)
+        elif feature == 'SoftwareTrigger':
+            self._software_trigger()
+        elif feature == 'TimestampClockReset':
+            self._clock_zero = time.perf_counter()
+
+    # buffer handling
+    def AT_QueueBuffer(self, handle, ptr, size):
+        self._check_handle('AT_QueueBuffer', handle)
+        address = ctypes.cast(ptr, ctypes.c_void_p).value
+        if address is None:
+            raise _andor_error('NULL_QUEUE_PTR', 'AT_QueueBuffer', handle, ptr, size)
+        with self._lock:
+            layout = self._layout if self._acquiring else self._get_layout()
+            if size < layout['image_bytes']:
+                raise _andor_error('INVALIDSIZE', 'AT_QueueBuffer', handle, ptr, size)
+            self._queued.append((address, size))
+            if self._camera_ram:
+                self._fill_buffer(self._camera_ram.popleft())
+
+    def AT_WaitBuffer(self, handle, timeout):
+        self._check_handle('AT_WaitBuffer', handle)
+        wait_time = None if timeout == lowlevel.ANDOR_INFINITE else timeout / 1000
+        with self._lock:
+            if not self._buffer_ready.wait_for(lambda: self._filled or self._overflowed, wait_time):
+                raise _andor_error('TIMEDOUT', 'AT_WaitBuffer', handle, timeout)
+            if not self._filled:
+                self._overflowed = False
+                raise _andor_error('HARDWARE_OVERFLOW', 'AT_WaitBuffer', handle, timeout)
+            address, size = self._filled.popleft()
+        return ctypes.cast(address, UINT8_P), size
+
+    def AT_Flush(self, handle):
+        self._check_handle('AT_Flush', handle)
+        with self._lock:
+            self._queued.clear()
+            self._filled.clear()
+            self._camera_ram.clear()
+            self._overflowed = False
+
+    # feature-model internals
+    def _check_handle(self, function, handle, *args):
+        if handle != _CAMERA_HANDLE:
+            raise _andor_error('INVALIDHANDLE', function, handle, *args)
+
+    def _is_implemented(self, handle, feature):
+        if handle == _SYSTEM_HANDLE:
+            return feature in {'DeviceCount', 'SoftwareVersion'}
+        if handle != _CAMERA_HANDLE or feature not in self._features:
+            return False
+        if feature == 'FrameCount':
+            return self._values['CycleMode'] == 'Fixed'
+        return True
+
+    def _is_writable(self, handle, feature):
+        if not self._is_implemented(handle, feature) or feature in self._readonly:
+            return False
+        if self._acquiring and feature not in _WRITABLE_WHILE_ACQUIRING:
+            return False
+        if feature == 'FrameRate':
+            return self._values['TriggerMode'] in {'Internal', 'Software', 'External Start'}
+        if feature == 'Overlap':
+            return not (self._values['ElectronicShutteringMode'] == 'Rolling' and self._values['TriggerMode'] == 'Software')
+        return True
+
+    def _check_feature(self, function, handle, feature, at_types=None):
+        if handle == _SYSTEM_HANDLE and feature in {'DeviceCount', 'SoftwareVersion'}:
+            return
+        self._check_handle(function, handle, feature)
+        if not self._is_implemented(handle, feature) or (at_types is not None and self._features[feature][0] not in at_types):
+            raise _andor_error('NOTIMPLEMENTED', function, handle, feature)
+
+    def _check_writable(self, function, handle, feature, at_types):
+        self._check_feature(function, handle, feature, at_types)
+        if feature in self._readonly:
+            raise _andor_error('READONLY', function, handle, feature)
+        if not self._is_writable(handle, feature):
+            raise _andor_error('NOTWRITABLE', function, handle, feature)
+
+    def _get(self, function, handle, feature, at_types):
+        if handle == _SYSTEM_HANDLE and feature == 'DeviceCount':
+            return 3 # the andor SDK always lists two virtual cameras in addition to any real ones
+        self._check_feature(function, handle, feature, at_types)
+        with self._lock:
+            return self._read(feature)
+
+    def _read(self, feature):
+        if feature in self._computed:
+            return self._computed[feature]()
+        return self._values[feature]
+
+    def _get_range(self, function, handle, feature):
+        self._check_feature(function, handle, feature, ('Int', 'Float'))
+        with self._lock:
+            if feature in self._ranges:
+                return self._ranges[feature]()
+            value = self._read(feature)
+            return value, value
+
+    def _set_numeric(self, function, handle, feature, value):
+        self._check_writable(function, handle, feature, ('Int', 'Float'))
+        with self._notifying():
+            if feature in self._ranges:
+                low, high = self._ranges[feature]()
+                tolerance = 1e-9 * abs(high)
+                if not low - tolerance <= value <= high + tolerance:
+                    raise _andor_error('OUTOFRANGE', function, _CAMERA_HANDLE, feature, value)
+            self._values[feature] = value
+            if feature == 'ExposureTime' and self._get_overlap() and self._values['ElectronicShutteringMode'] == 'Global':
+                self._values['ExposureTime'] = max(value, self._get_readout_time())
+
+    def _set_enum(self, feature, value):
+        with self._notifying():
+            if feature == 'AOIBinning':
+                self._rebin(value)
+            self._values[feature] = value
+
+    def _rebin(self, new_binning):
+        # keep the same sensor area, as best as possible, in the new superpixel units
+        old_bin = int(self._values['AOIBinning'].split('x')[0])
+        new_bin = int(new_binning.split('x')[0])
+        sensor_width, sensor_height = self._model['sensor_size']
+        for start, size, sensor_size in (('AOILeft', 'AOIWidth', sensor_width), ('AOITop', 'AOIHeight', sensor_height)):
+            pixel_start = (self._values[start] - 1) * old_bin
+            pixel_size = self._values[size] * old_bin
+            limit = sensor_size // new_bin
+            self._values[start] = min(pixel_start // new_bin, limit - 1) + 1
+            self._values[size] = max(1, min(pixel_size // new_bin, limit - self._values[start] + 1))
+
+    def _sensor_aoi_limit(self, axis):
+        binning = int(self._values['AOIBinning'].split('x')[0])
+        return self._model['sensor_size'][axis] // binning
+
+    def _get_stride(self):
+        width = self._values['AOIWidth']
+        encoding = self._values['PixelEncoding']
+        if encoding == 'Mono12Packed':
+            return (width + 1) // 2 * 3
+        elif encoding == 'Mono32':
+            return width * 4
+        else:
+            return width * 2
+
+    def _get_bit_depth(self):
+        return '16 Bit' if self._values['PixelEncoding'] in {'Mono16', 'Mono32'} else '11 Bit or 12 Bit'
+
+    def _get_image_bytes(self):
+        image_bytes = self._get_stride() * self._values['AOIHeight']
+        if self._values['MetadataEnable']:
+            image_bytes += 8 # CID and length of the image-data chunk
+            if self._values['MetadataTimestamp']:
+                image_bytes += 16 # 8-byte timestamp plus CID and length
+        return image_bytes
+
+    def _get_row_read_time(self):
+        rates = self._features['PixelReadoutRate'][1]
+        fastest = max(float(rate.split()[0]) for rate in rates)
+        rate = float(self._values['PixelReadoutRate'].split()[0])
+        half_height = self._model['sensor_size'][1] / 2
+        return self._full_readout_time / half_height * fastest / rate
+
+    def _get_readout_time(self):
+        # the two sensor halves are read out simultaneously, so readout time
+        # depends on the maximum number of rows above or below the midline
+        binning = int(self._values['AOIBinning'].split('x')[0])
+        midline = self._model['sensor_size'][1] // 2
+        top = (self._values['AOITop'] - 1) * binning
+        bottom = top + self._values['AOIHeight'] * binning
+        if bottom <= midline or top >= midline:
+            rows = bottom - top
+        else:
+            rows = max(midline - top, bottom - midline)
+        return rows * self._get_row_read_time()
+
+    def _get_overlap(self):
+        if self._values['ElectronicShutteringMode'] == 'Rolling' and self._values['TriggerMode'] == 'Software':
+            return False
+        return self._values['Overlap']
+
+    def _get_exposure_range(self):
+        if self._values['ElectronicShutteringMode'] == 'Global' and self._get_overlap():
+            return self._get_readout_time(), 30
+        return 0.00001, 30
+
+    def _get_frame_rate_range(self):
+        # see the frame rate constraints in the camera_base module docstring
+        exposure = self._values['ExposureTime']
+        readout = self._get_readout_time()
+        delta = self._get_row_read_time()
+        if self._values['ElectronicShutteringMode'] == 'Rolling':
+            if self._get_overlap():
+                return 1 / (exposure + readout), 1 / max(exposure, readout)
+            return 0.00005, 1 / (exposure + readout)
+        if self._get_overlap():
+            return 0.00005, 1 / (max(exposure, 2 * readout) + delta)
+        if exposure < readout:
+            return 0.00005, 1 / (exposure + 2 * readout + delta)
+        return 0.00005, 1 / (exposure + readout + delta)
+
+    def _get_frame_rate(self):
+        low, high = self._get_frame_rate_range()
+        if self._values['TriggerMode'] not in {'Internal', 'External Start'}:
+            return high
+        return float(numpy.clip(self._values['FrameRate'], low, high))
+
+    def _get_timestamp(self):
+        return int((time.perf_counter() - self._clock_zero) * _TIMESTAMP_HZ)
+
+    def _notifying(self):
+        return _CallbackNotifier(self)
+
+    def _watched_values(self):
+        values = {}
+        for feature, callbacks in self._callbacks.items():
+            if callbacks and feature not in _UNWATCHED_FEATURES:
+                try:
+                    values[feature] = self._read(feature)
+                except (KeyError, common.AndorError):
+                    values[feature] = None
+        return values
+
+    # acquisition internals
+    def _get_layout(self):
+        width, height = self._values['AOIWidth'], self._values['AOIHeight']
+        return dict(width=width, height=height, stride=self._get_stride(),
+            encoding=self._values['PixelEncoding'], bit_depth=self._get_bit_depth(),
+            image_bytes=self._get_image_bytes(), metadata=self._values['MetadataEnable'],
+            timestamp=self._values['MetadataEnable'] and self._values['MetadataTimestamp'])
+
+    def _get_ram_capacity(self):
+        # on-head RAM holds fewer frames for taller AOIs: see Camera.get_safe_image_count_to_queue()
+        binning = int(self._values['AOIBinning'].split('x')[0])
+        midline = self._model['sensor_size'][1] // 2
+        top = (self._values['AOITop'] - 1) * binning
+        height = self._values['AOIHeight'] * binning
+        bottom = top + height
+        if bottom <= midline or top >= midline:
+            lines = height
+        else:
+            lines = max(midline - top, bottom - midline)
+        return int(126464 / lines + 29)
+
+    def _start_acquisition(self):
+        if self._acquiring:
+            raise _andor_error('NOTWRITABLE', 'AT_Command', _CAMERA_HANDLE, 'AcquisitionStart')
+        self._layout = self._get_layout()
+        self._templates = self._get_frame_templates(self._layout)
+        self._template_index = 0
+        self._ram_capacity = self._get_ram_capacity()
+        self._trigger_mode = self._values['TriggerMode']
+        self._frame_limit = self._values['FrameCount'] if self._values['CycleMode'] == 'Fixed' else None
+        self._frames_acquired = 0
+        self._pending_triggers.clear()
+        self._next_trigger_allowed = 0
+        self._start_time = time.perf_counter()
+        self._acquiring = True
+        self._acquisition_thread = threading.Thread(target=self._run_acquisition, name='SimulatedCamera', daemon=True)
+        self._acquisition_thread.start()
+
+    def _end_acquisition(self):
+        with self._lock:
+            self._acquiring = False
+            self._buffer_ready.notify_all()
+            thread = self._acquisition_thread
+            self._acquisition_thread = None
+            return thread
+
+    def _join_acquisition_thread(self, thread):
+        # must be called without holding self._lock, which the thread needs to finish
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+    def _stop_acquisition(self):
+        self._join_acquisition_thread(self._end_acquisition())
+
+    def _software_trigger(self):
+        with self._lock:
+            if not self._acquiring or self._trigger_mode != 'Software':
+                return
+            now = time.perf_counter()
+            if now < self._next_trigger_allowed:
+                # triggers faster than the maximum frame rate are ignored, not queued
+                return
+            exposure, readout = self._values['ExposureTime'], self._get_readout_time()
+            self._next_trigger_allowed = now + 1 / self._get_frame_rate_range()[1]
+            self._pending_triggers.append(now + exposure + readout)
+            self._buffer_ready.notify_all()
+
+    def _next_frame_due(self):
+        if self._frame_limit is not None and self._frames_acquired >= self._frame_limit:
+            return None
+        if self._trigger_mode == 'Software':
+            return self._pending_triggers[0] if self._pending_triggers else None
+        # internal triggering, and external triggering simulated as internal
+        interval = 1 / self._get_frame_rate()
+        exposure, readout = self._values['ExposureTime'], self._get_readout_time()
+        return self._start_time + self._frames_acquired * interval + exposure + readout
+
+    def _run_acquisition(self):
+        with self._lock:
+            while self._acquiring:
+                due = self._next_frame_due()
+                if due is None:
+                    self._buffer_ready.wait()
+                    continue
+                wait_time = due - time.perf_counter()
+                if wait_time > 0:
+                    self._buffer_ready.wait(wait_time)
+                    continue
+                if self._trigger_mode == 'Software':
+                    self._pending_triggers.popleft()
+                self._frames_acquired += 1
+                exposure_start = due - self._values['ExposureTime'] - self._get_readout_time()
+                timestamp = max(0, int((exposure_start - self._clock_zero) * _TIMESTAMP_HZ))
+                if self._queued:
+                    self._fill_buffer(timestamp)
+                elif len(self._camera_ram) < self._ram_capacity:
+                    self._camera_ram.append(timestamp)
+                else:
+                    self._overflowed = True
+                    self._buffer_ready.notify_all()
+
+    def _fill_buffer(self, timestamp):
+        address, size = self._queued.popleft()
+        layout = self._layout
+        template = self._templates[self._template_index]
+        self._template_index = (self._template_index + 1) % len(self._templates)
+        image_bytes = len(template)
+        ctypes.memmove(address, template.ctypes.data, image_bytes)
+        if layout['metadata']:
+            # chunk layout: [chunk][CID][length], where length is the size of chunk+CID
+            footer = struct.pack('<II', _IMAGE_CID, image_bytes + 4)
+            if layout['timestamp']:
+                footer += struct.pack('<QII', timestamp, _TIMESTAMP_CID, 12)
+            ctypes.memmove(address + image_bytes, footer, len(footer))
+        self._filled.append((address, size))
+        self._buffer_ready.notify_all()
+
+    def _get_frame_templates(self, layout, count=3):
+        """Return raw, encoded image data (without metadata) for a few frames
+        of a synthetic scene with noise. Cached, since generating full-frame
+        images is much slower than the camera's frame rate."""
+        key = layout['width'], layout['height'], layout['stride'], layout['encoding'], layout['bit_depth']
+        if key not in self._frame_templates:
+            width, height, stride, encoding, bit_depth = key
+            y, x = numpy.ogrid[0:height, 0:width]
+            scene = 1000 + 300 * numpy.sin(x / 60) * numpy.cos(y / 45)
+            rng = numpy.random.default_rng()
+            templates = []
+            for i in range(count):
+                image = (scene + rng.integers(0, 100, size=(height, width))).astype(numpy.uint16)
+                templates.append(_encode_image(image, stride, encoding))
+            self._frame_templates = {key: templates} # only keep the current layout around
+        return self._frame_templates[key]
+
+class _CallbackNotifier:
+    """Context manager that holds the library lock while a feature is changed,
+    then calls the registered callbacks of any features whose values changed."""
+    def __init__(self, core_lib):
+        self.core_lib = core_lib
+
+    def __enter__(self):
+        self.core_lib._lock.acquire()
+        self.old_values = self.core_lib._watched_values()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            new_values = self.core_lib._watched_values()
+            changed = [feature for feature, value in new_values.items() if value != self.old_values.get(feature)]
+            callbacks = [(feature, list(self.core_lib._callbacks[feature])) for feature in changed]
+        finally:
+            self.core_lib._lock.release()
+        for feature, feature_callbacks in callbacks:
+            for callback, context in feature_callbacks:
+                callback(_CAMERA_HANDLE, feature, context)
+
+def _encode_image(image, stride, encoding):
+    """Encode a (height, width) uint16 image into raw bytes with the given
+    row stride and Andor pixel encoding."""
+    height, width = image.shape
+    raw = numpy.zeros((height, stride), dtype=numpy.uint8)
+    if encoding == 'Mono12Packed':
+        # two 12-bit pixels in three bytes: [A high 8 bits][B low 4 bits, A low 4 bits][B high 8 bits]
+        image = numpy.minimum(image, 4095)
+        if width % 2:
+            image = numpy.concatenate([image, numpy.zeros((height, 1), dtype=numpy.uint16)], axis=1)
+        a, b = image[:, 0::2], image[:, 1::2]
+        packed = numpy.stack([a >> 4, (a & 0xF) | ((b & 0xF) << 4), b >> 4], axis=-1).astype(numpy.uint8)
+        raw[:, :packed.shape[1]*3] = packed.reshape(height, -1)
+    else:
+        dtype = '<u4' if encoding == 'Mono32' else '<u2'
+        if encoding == 'Mono12':
+            image = numpy.minimum(image, 4095)
+        pixels = image.astype(dtype).view(numpy.uint8)
+        raw[:, :pixels.shape[1]] = pixels
+    return raw.reshape(-1)
+
+class SimulatedUtilLib:
+    """Stand-in for the Andor SDK3 utility library (libatutility.so)."""
+    def AT_InitialiseUtilityLibrary(self):
+        pass
+
+    def AT_FinaliseUtilityLibrary(self):
+        pass
+
+    def AT_ConvertBuffer(self, input_buffer, output_buffer, width, height, stride, input_encoding, output_encoding):
+        args = input_buffer, output_buffer, width, height, stride, input_encoding, output_encoding
+        if output_encoding != 'Mono16':
+            raise _andor_error('AT_ERR_INVALIDOUTPUTPIXELENCODING', 'AT_ConvertBuffer', *args)
+        raw = numpy.ctypeslib.as_array(input_buffer, shape=(height * stride,)).reshape(height, stride)
+        output = numpy.ctypeslib.as_array(ctypes.cast(output_buffer, UINT16_P), shape=(height, width))
+        if input_encoding in {'Mono12', 'Mono16'}:
+            output[:] = raw[:, :width*2].view('<u2')
+        elif input_encoding == 'Mono32':
+            output[:] = raw[:, :width*4].view('<u4')
+        elif input_encoding == 'Mono12Packed':
+            triples = raw[:, :(width + 1) // 2 * 3].reshape(height, -1, 3).astype(numpy.uint16)
+            output[:, 0::2] = (triples[..., 0] << 4) | (triples[..., 1] & 0xF)
+            output[:, 1::2] = ((triples[..., 2] << 4) | (triples[..., 1] >> 4))[:, :width//2]
+        else:
+            raise _andor_error('AT_ERR_INVALIDINPUTPIXELENCODING', 'AT_ConvertBuffer', *args)
+
+def _initialize_simulated(model):
+    config = scope_configuration.get_config()
+    readout_time_ms = config.get('camera', {}).get('SIMULATED_READOUT_TIME_MS', 10)
+    return lowlevel.initialize_simulated(SimulatedCoreLib(model, readout_time_ms), SimulatedUtilLib())
+
+class SimulatedZyla(camera.Zyla):
+    _DESCRIPTION = 'simulated Andor Zyla'
+    _EXPECTED_INIT_ERRORS = ()
+
+    def _initialize_lowlevel(self):
+        return _initialize_simulated(ZYLA_MODEL)
+
+class SimulatedSona(camera.Sona):
+    _DESCRIPTION = 'simulated Andor Sona'
+    _EXPECTED_INIT_ERRORS = ()
+
+    def _initialize_lowlevel(self):
+        return _initialize_simulated(SONA_MODEL)
@@ -6,12 +6,15 @@ from concurrent import futures
 import threading
 import functools
 import runpy
+import queue
 
 import freeimage
 from zplib.image import fast_fft
 
 from ..util import transfer_ism_buffer
 from ..util import logging
+from ..simple_rpc import cancellation
+from ..simple_rpc import streaming
 from ..config import scope_configuration
 from . import andor
 from .leica import stage
@@ -130,7 +133,7 @@ class Autofocus:
         best_i, z_scores = metric.find_best_focus_index()
         best_z = z_positions[best_i]
         self._stage.z_from_offset(best_z, direction)
-        return best_z, zip(z_positions, z_scores)
+        return best_z, list(zip(z_positions, z_scores))
 
     def autofocus(self, start, end, steps, metric='brenner', metric_kws=None,
             metric_mask=None, metric_filter_period_range=None,
@@ -172,6 +175,20 @@ class Autofocus:
             images: if return_images is True, a list of images acquired, otherwise
                 an empty list.
         """
+        image_names, (best_z, positions_and_scores) = streaming.collect(self.iter_autofocus(start, end, steps,
+            metric, metric_kws, metric_mask, metric_filter_period_range, return_images, **camera_state))
+        return best_z, positions_and_scores, image_names
+
+    def iter_autofocus(self, start, end, steps, metric='brenner', metric_kws=None,
+            metric_mask=None, metric_filter_period_range=None,
+            return_images=True, **camera_state):
+        """Focus as for autofocus(), but if return_images is True, yield each
+        image as soon as it has been acquired, so that images can be retrieved
+        while focusing continues. (Called over RPC, the images are streamed to
+        the client.)
+
+        Returns: best_z, positions_and_scores, once focusing is complete.
+        """
         metric = self._start_autofocus(metric, metric_kws, metric_mask, metric_filter_period_range)
         with self._camera.in_state(live_mode=False, trigger_mode='Software'):
             frame_rate, overlap = self._camera.calculate_streaming_mode(steps, desired_frame_rate=1000) # try to get the max possible frame rate...
@@ -186,16 +203,16 @@ class Autofocus:
                 runner.start()
                 next_trigger = time.time() # start triggering immediately
                 for z in z_positions:
+                    cancellation.check() # stop early if the result is no longer wanted
                     self._stage.set_z(z)
                     time.sleep(max(0, next_trigger - time.time()))
                     self._camera.send_software_trigger()
                     next_trigger = time.time() + 1/frame_rate # don't trigger again before it's time
                     time.sleep(exposure_time) # don't move stage until exposure is done
+                    yield from runner.new_image_names()
                 image_names, camera_timestamps = runner.join()
-        best_z, positions_and_scores = self._finish_autofocus(metric, z_positions, direction)
-        if not return_images:
-            image_names = []
-        return best_z, positions_and_scores, image_names
+                yield from runner.new_image_names()
+        return self._finish_autofocus(metric, z_positions, direction)
 
     def autofocus_continuous_move(self, start, end, steps=None, max_speed=0.2,
             metric='brenner', metric_kws=None, metric_mask=None,
@@ -241,6 +258,20 @@ class Autofocus:
             images: if return_images is True, a list of images acquired, otherwise
                 an empty list
         """
+        image_names, (best_z, positions_and_scores) = streaming.collect(self.iter_autofocus_continuous_move(start,
+            end, steps, max_speed, metric, metric_kws, metric_mask, metric_filter_period_range, return_images))
+        return best_z, positions_and_scores, image_names
+
+    def iter_autofocus_continuous_move(self, start, end, steps=None, max_speed=0.2,
+            metric='brenner', metric_kws=None, metric_mask=None,
+            metric_filter_period_range=None, return_images=True):
+        """Focus as for autofocus_continuous_move(), but if return_images is
+        True, yield each image as soon as it has been acquired, so that images
+        can be retrieved while focusing continues. (Called over RPC, the images
+        are streamed to the client.)
+
+        Returns: best_z, positions_and_scores, once focusing is complete.
+        """
         metric = self._start_autofocus(metric, metric_kws, metric_mask, metric_filter_period_range)
         direction = numpy.sign(start-end)
         with self._camera.in_state(live_mode=False, trigger_mode='Internal'):
@@ -250,6 +281,7 @@ class Autofocus:
             self._stage.z_from_offset(start, direction) # move to start position at original speed
             self._stage.wait()
             cam_state = dict(trigger_mode='External Start', frame_rate=frame_rate, overlap_enabled=overlap)
+            cancellation.check() # once the stage starts moving, focusing must run to completion
             with self._stage.in_state(async_=True, z_speed=speed), self._camera.image_sequence_acquisition(steps, **cam_state):
                 self._stage.set_z(end)
                 while abs(self._stage.get_z() - start) < 0.0005: # wait for at least a micron of movement
@@ -257,16 +289,15 @@ class Autofocus:
                 zrecorder.start()
                 self._iotool.execute(*self._cam_trigger)
                 runner.start()
+                yield from runner.new_image_names(wait=True)
                 self._stage.wait()
                 zrecorder.stop()
                 image_names, camera_timestamps = runner.join()
+                yield from runner.new_image_names()
         if len(camera_timestamps) != steps:
             raise RuntimeError('Autofocus image acquisition failed: Expected {} images, got {}.'.format(steps, len(camera_timestamps)))
         z_positions = zrecorder.interpolate_zs(camera_timestamps)
-        best_z, positions_and_scores = self._finish_autofocus(metric, z_positions, direction)
-        if not return_images:
-            image_names = []
-        return best_z, positions_and_scores, image_names
+        return self._finish_autofocus(metric, z_positions, direction)
 
     def _calculate_autofocus_continuous_move_state(self, end, start, steps, max_speed):
         states = 'binning', 'bit_depth', 'exposure_time', 'readout_rate', 'shutter_mode', 'aoi_height', 'aoi_left', 'aoi_top', 'aoi_width'
@@ -311,6 +342,7 @@ class MetricRunner(threading.Thread):
         self.camera_timestamps = []
         self.image_names = []
         self.retain_images = retain_images
+        self._new_image_names = queue.SimpleQueue() # retained images not yet returned by new_image_names()
         self.threadpool = futures.ThreadPoolExecutor(1)
         # want to run metrics in a single background thread:
         # fftw is already multithreaded so we let it handle that, and just run
@@ -326,6 +358,17 @@ class MetricRunner(threading.Thread):
             future.result() # make sure all metric evals are done, and raise errors if any of them did
         return self.image_names, self.camera_timestamps
 
+    def new_image_names(self, wait=False):
+        """Yield the names of retained images acquired since the last call. If
+        'wait' is True, continue to yield names as images are acquired, until
+        the runner has finished."""
+        while True:
+            try:
+                yield self._new_image_names.get(timeout=0.1) if wait else self._new_image_names.get_nowait()
+            except queue.Empty:
+                if not wait or not self.is_alive():
+                    return
+
     def run(self):
         try:
             self.exception = None
@@ -334,6 +377,7 @@ class MetricRunner(threading.Thread):
                 self.camera_timestamps.append(timestamp)
                 if self.retain_images:
                     self.image_names.append(name)
+                    self._new_image_names.put(name)
                     array = transfer_ism_buffer.borrow_array(name)
                 else:
                     array = transfer_ism_buffer.release_array(name)
@@ -34,6 +34,7 @@ class HumidityController(property_device.PropertyDevice):
     _DESCRIPTION = 'humidity controller'
     _EXPECTED_INIT_ERRORS = (smart_serial.SerialException,)
     _UPDATE_INTERVAL = 10
+    _VOLATILE_PROPERTIES = ('temperature', 'humidity')
     _RECORD_DAYS = 14
 
     def __init__(self, property_server=None, property_prefix=''):
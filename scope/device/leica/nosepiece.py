@@ -3,6 +3,7 @@
 import collections
 
 from ...messaging import message_device
+from ...simple_rpc import cacheable
 from . import stand
 from . import microscopy_method_names
 
@@ -56,6 +57,7 @@ class ManualNosepiece(stand.LeicaComponent):
         between objective positions.'''
         return int(self.send_message(GET_POS_OBJ, async_=False, intent="get current objective turret position").response)
 
+    @cacheable.cacheable
     def get_position_min_max(self):
         return self._minp, self._maxp
 
@@ -65,6 +67,7 @@ class ManualNosepiece(stand.LeicaComponent):
         this value will be None.'''
         return _parse_mag_string(self._get_objpar(self.get_position(), 1))
 
+    @cacheable.cacheable
     def get_magnification_values(self):
         return list(sorted(filter(lambda m: m is not None, self._mags_to_positions.keys())))
 
@@ -81,6 +84,7 @@ class ManualNosepiece(stand.LeicaComponent):
             medium = 'D'
         self.send_message(SET_IMM_DRY, medium, intent="change to objective medium")
 
+    @cacheable.cacheable
     def get_all_objectives(self):
         '''Returns a list of objective magnifications. List index corresponds to objective position. None values
         in the list represent empty objective turret positions. For example, [None, 10, 5] indicates that there
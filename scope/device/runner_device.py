@@ -6,6 +6,7 @@ from .. import scope_job_runner
 
 class JobRunner(property_device.PropertyDevice):
     _DESCRIPTION = 'job runner'
+    _VOLATILE_PROPERTIES = ('queued_jobs', 'errored_jobs', 'current_job', 'running', 'duty_cycle')
 
     def __init__(self, property_server=None, property_prefix=''):
         super().__init__(property_server, property_prefix)
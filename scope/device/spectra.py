@@ -7,6 +7,7 @@ from ..util import smart_serial
 from ..util import property_device
 from ..util import state_stack
 from ..util import timer
+from ..simple_rpc import cacheable
 from ..config import scope_configuration
 from . import iotool
 
@@ -35,6 +36,7 @@ class SpectraError(Exception):
 class _BaseSpectra(property_device.PropertyDevice):
     _EXPECTED_INIT_ERRORS = (smart_serial.SerialException, SpectraError)
     _UPDATE_INTERVAL = 10
+    _VOLATILE_PROPERTIES = ('temperature',)
 
     def __init__(self, iotool: iotool.IOTool, property_server=None, property_prefix=''):
         super().__init__(property_server, property_prefix)
@@ -101,6 +103,7 @@ class _BaseSpectra(property_device.PropertyDevice):
                 commands.append(self._iotool.commands.set_low(pin))
         return commands
 
+    @cacheable.cacheable
     def get_lamp_specs(self):
         """Return a dict mapping lamp names to tuples of (peak_wavelength, bandwidth), in nm,
         where bandwidth is the minimum width required to contain 75% of the spectral intensity
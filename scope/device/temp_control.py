@@ -11,6 +11,7 @@ class TemperatureController(property_device.PropertyDevice):
     _DESCRIPTION = 'temperature controller'
     _EXPECTED_INIT_ERRORS = (smart_serial.SerialException,)
     _SERIAL_CONFIG = None
+    _VOLATILE_PROPERTIES = ('temperature',)
 
     def __init__(self, property_server=None, property_prefix=''):
         super().__init__(property_server, property_prefix)
@@ -31,12 +31,12 @@ def gui_main(host):
     main_window = scope_widgets.WidgetWindow(scope, WIDGETS, window_title=title)
     shared_resources.run_qapplication()
 
-def monitor_main(hosts, downsample=None, fps_max=None):
+def monitor_main(hosts, downsample=None, fps_max=None, pyramid_level=None):
     shared_resources.init_qapplication(icon_resource_path=(__name__, 'icon.svg'))
     viewers = []
     for host in hosts:
         scope = scope_client.ScopeClient(host, allow_interrupt=False, auto_connect=False)
         app_prefs_name = 'viewer-{}'.format(host)
-        viewer = scope_viewer_widget.MonitorWidget(scope, host, downsample, fps_max, app_prefs_name)
+        viewer = scope_viewer_widget.MonitorWidget(scope, host, downsample, fps_max, app_prefs_name, pyramid_level=pyramid_level)
         viewers.append(viewer)
     shared_resources.run_qapplication()
@@ -111,10 +111,19 @@ class ScopeViewerWidget(ris_widget.RisWidgetQtObject):
             freeimage.write(self.image.data, fn)
 
 class MonitorWidget(ScopeViewerWidget):
-    def __init__(self, scope, window_title='Viewer', downsample=None, fps_max=None, app_prefs_name='scope-viewer', parent=None):
+    AUTO_TARGET_FPS = 10 # frame rate for automatic downsampling if fps_max is not set
+
+    def __init__(self, scope, window_title='Viewer', downsample=None, fps_max=None, app_prefs_name='scope-viewer', parent=None, pyramid_level=None):
+        """Viewer for monitoring a (possibly remote) microscope. If 'downsample'
+        is 'auto', images from a remote microscope are compressed and
+        downsampled as needed to reach 'fps_max' frames per second over the
+        available network bandwidth. If 'pyramid_level' is n, images are shown
+        mean-binned by 2**n, as computed on the server."""
         super().__init__(scope, window_title, fps_max, app_prefs_name, parent)
         self.live_streamer.image_ready_callback = None # don't allow image callbacks until scope is connected
         self.downsample = downsample
+        self.fps_max = fps_max
+        self.live_streamer.pyramid_level = pyramid_level
         self.removeToolBar(self.scope_toolbar)
         self.show_over_exposed_action.setChecked(False)
         self.histogram_dock_widget.hide()
@@ -143,6 +152,10 @@ class MonitorWidget(ScopeViewerWidget):
             self.scope._connect()
         self.timer.stop()
         if not self.scope._is_local:
-            self.scope._get_data.downsample = self.downsample
+            if self.downsample == 'auto':
+                # choose compression and downsampling to keep up with the frame rate
+                self.scope._get_data.set_target_fps(self.fps_max or self.AUTO_TARGET_FPS)
+            else:
+                self.scope._get_data.downsample = self.downsample
         self.live_streamer.image_ready_callback = self.post_new_image_event
-        self.scope.rebroadcast_properties()
+        self.scope.synchronize_properties()
@@ -18,8 +18,16 @@ class Scope(message_device.AsyncDeviceNamespace):
         self._property_server = property_server
         if property_server is not None:
             self.rebroadcast_properties = property_server.rebroadcast_properties
+            self.get_property_server_stats = property_server.get_stats
+            self.get_property_snapshot = property_server.get_snapshot
+            self.get_property_sequence = property_server.get_sequence
+            self.get_cacheable_properties = property_server.get_cacheable_properties
 
         self._components = []
+        # map component attribute names to the names of all the components they
+        # use, which the RPC server uses as lock groups (see rpc_server.CommandLocks)
+        self._lock_groups = {}
+        self._component_lock_groups = {}
 
         self.get_configuration = scope_configuration.get_config
         config = self.get_configuration()
@@ -41,6 +49,7 @@ class Scope(message_device.AsyncDeviceNamespace):
             if kwarg not in kws:
                 logger.warning('Could not initialize {}: requires {}', component_class.__name__, requires_class.__name__)
                 return False
+        dependencies = list(kws.values())
 
         if issubclass(component_class, property_device.PropertyDevice):
             kws['property_server'] = self._property_server
@@ -76,4 +85,9 @@ class Scope(message_device.AsyncDeviceNamespace):
                 owner = namespace
         setattr(owner, name, component)
         self._components.append(component)
+        lock_groups = {attr_name}
+        for dependency in dependencies:
+            lock_groups.update(self._component_lock_groups[id(dependency)])
+        self._component_lock_groups[id(component)] = lock_groups
+        self._lock_groups[attr_name] = sorted(lock_groups)
         return True
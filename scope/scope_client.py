@@ -6,31 +6,52 @@ import collections
 import numpy
 import threading
 import contextlib
+import os
+import pathlib
 
 from .simple_rpc import rpc_client, property_client
 from .util import transfer_ism_buffer
+from .util import live_broadcast
 from .config import scope_configuration
 
+# saved copies of the server's namespace description, which is slow to fetch
+_DESCRIPTION_CACHE_DIR = pathlib.Path.home() / '.cache' / 'rpc_scope'
+
 class ScopeClient:
     _HEARTBEAT_SEC = 3
     _scope = None # set to not none in instances when connected
 
-    def __init__(self, host='127.0.0.1', allow_interrupt=True, auto_connect=True):
+    def __init__(self, host='127.0.0.1', allow_interrupt=True, auto_connect=True, cache_properties=True):
+        """Client for the microscope server on the given host.
+
+        If cache_properties is True, reads of properties that the server
+        publishes (e.g. scope.stage.z) are served from a local copy maintained
+        from the property updates, rather than with an RPC call, whenever that
+        copy is known to be current.
+
+        Clients on the same host as the server switch to its ipc:// (Unix domain
+        socket) endpoints once connected, if the server provides them, avoiding
+        the overhead of the TCP stack."""
         self.host = host
         self._allow_interrupt = allow_interrupt
+        self._cache_properties = cache_properties
 
         context = zmq.Context()
+        self._context = context
         addresses = scope_configuration.get_addresses(host)
+        self._live_broadcast_address = addresses['live_broadcast']
         interrupt_addr = addresses['interrupt'] if allow_interrupt else None
         kws = dict(heartbeat_sec=self._HEARTBEAT_SEC, timeout_sec=5, context=context)
         self._rpc_client = rpc_client.ZMQClient(addresses['rpc'], interrupt_addr, **kws)
         self._image_transfer_client = rpc_client.ZMQClient(addresses['image_transfer_rpc'], **kws)
         del kws['timeout_sec'] # no timeout for property_client since it's a receive channel
-        self.properties = property_client.ZMQClient(addresses['property'], **kws)
+        # call property callbacks (often GUI updates) from a separate thread so they can't hold up receiving updates
+        self.properties = property_client.ZMQClient(addresses['property'], callback_threads=1, **kws)
 
         self._ping = self._rpc_client.proxy_function('_ping')
         self._sleep = self._rpc_client.proxy_function('_sleep')
         self.send_interrupt = self._rpc_client.send_interrupt
+        self.batch = self._rpc_client.batch
         if auto_connect:
             self._connect()
 
@@ -47,14 +68,17 @@ class ScopeClient:
     def _connect(self):
         if not self._can_connect():
             raise RuntimeError(f'Cannot communicate with microscope server at {self.host}.')
+        is_local, get_data = transfer_ism_buffer.client_get_data_getter(self._image_transfer_client)
+        if is_local:
+            self._use_ipc()
         # now set a 60-second default timeout to allow long blocking rpc calls
         self._rpc_client._timeout_sec = 60
 
         # do this after setting the longer timeout, since this can take ~10 sec
         no_property = {'iotool.commands.set_' + val for val in ('high', 'low', 'tristate')}
-        scope = self._rpc_client.proxy_namespace(no_property)
-
-        is_local, get_data = transfer_ism_buffer.client_get_data_getter(self._image_transfer_client)
+        rpc_port = scope_configuration.get_addresses(self.host)['rpc'].rsplit(':', 1)[-1]
+        description_cache = _DESCRIPTION_CACHE_DIR / f'{self.host}_{rpc_port}.json'
+        scope = self._rpc_client.proxy_namespace(no_property, description_cache)
 
         if hasattr(scope, 'camera'):
             _patch_camera(scope.camera, get_data, self._image_transfer_client)
@@ -66,6 +90,9 @@ class ScopeClient:
                 # autofocus might be a bit slow too
                 scope.camera.autofocus.autofocus._timeout_sec = 2*60
                 scope.camera.autofocus.autofocus_continuous_move._timeout_sec = 2*60
+                # for streamed autofocus, the timeout applies to each image
+                scope.camera.autofocus.iter_autofocus._timeout_sec = 2*60
+                scope.camera.autofocus.iter_autofocus_continuous_move._timeout_sec = 2*60
 
         if hasattr(scope, 'stage'):
             # stage init can take more than our usual 60-second timeout
@@ -78,25 +105,83 @@ class ScopeClient:
 
         scope._get_configuration._output_handler = scope_configuration.ConfigDict
 
+        # NB: proxy_namespace() makes getters into properties, leaving the functions as _get_*
+        if self._cache_properties and hasattr(scope, '_get_cacheable_properties'):
+            get_sequence = lambda: scope._get_property_sequence(with_epoch=True)
+            self._property_cache = _PropertyCache(self.properties, self._rpc_client, get_sequence, self.synchronize_properties)
+            cached = _install_property_cache(scope, self._property_cache, set(scope._get_cacheable_properties()))
+            # receive updates only for the properties that are read from the cache (and
+            # not e.g. the frame number, which changes with every live image), subscribing
+            # before the initial snapshot of property values is taken below
+            for property_name in sorted(cached):
+                self.properties.mirror(property_name)
+
         scope._lock_attrs() # prevent unwary users from setting new attributes that won't get communicated to the server
         self._get_data = get_data
         self._is_local = is_local
+        # remote clients receive live images from the server's broadcast, if it has one (see LiveStreamer)
+        self._live_broadcast = False
+        if not is_local:
+            try:
+                self._live_broadcast = self._image_transfer_client('_has_live_broadcast')
+            except rpc_client.RPCError:
+                pass
         self._functions_proxied = scope._functions_proxied
         self._scope = scope
+        self.synchronize_properties()
+
+    def _use_ipc(self):
+        """Reconnect to the server's ipc:// endpoints, if it has them and they
+        are accessible to this process; otherwise carry on with TCP."""
+        try:
+            ipc_addresses = self._image_transfer_client('_get_ipc_addresses')
+            if not ipc_addresses:
+                return
+            server_uid = self._image_transfer_client('_get_uid')
+        except rpc_client.RPCError:
+            return # server doesn't provide ipc:// endpoints
+        paths = [address[len('ipc://'):] for address in ipc_addresses.values()]
+        # only connect to endpoints (in a directory) that the server itself created,
+        # rather than ones that someone else might have put in their place
+        for path in paths + [os.path.dirname(path) for path in paths]:
+            try:
+                owner = os.stat(path).st_uid
+            except OSError:
+                return # e.g. the server is in a separate container
+            if owner != server_uid:
+                return
+        if not all(os.access(path, os.R_OK | os.W_OK) for path in paths):
+            return # e.g. the sockets are not permitted to this user
+        self._rpc_client.rpc_addr = ipc_addresses['rpc']
+        if self._allow_interrupt:
+            self._rpc_client.interrupt_addr = ipc_addresses['interrupt']
+        self._image_transfer_client.rpc_addr = ipc_addresses['image_transfer_rpc']
+        self.properties.addr = ipc_addresses['property']
+        self.reconnect()
+
+    def synchronize_properties(self):
+        """Bring the local property values up to date with a snapshot from the
+        server, calling any subscribed callbacks with the current values."""
+        # NB: proxy_namespace() makes getters into properties, leaving the functions as _get_*
+        if hasattr(self._scope, '_get_property_snapshot'):
+            self.properties.synchronize(*self._scope._get_property_snapshot())
 
     def reconnect(self):
         self._rpc_client.reconnect()
         self._image_transfer_client.reconnect()
         self.properties.reconnect()
+        if self._is_connected():
+            self.synchronize_properties() # updates may have been missed while disconnected
 
     def _clone(self):
         """Create an identical client with distinct ZMQ sockets, so that it may be safely used
         from a separate thread."""
-        return type(self)(self.host, self._allow_interrupt, auto_connect=self._is_connected())
+        return type(self)(self.host, self._allow_interrupt, auto_connect=self._is_connected(),
+            cache_properties=self._cache_properties)
 
     def __setattr__(self, name, value):
         if self._scope is not None:
-            if hasattr(self._scope, name):
+            if hasattr(type(self._scope), name) or name in self._scope.__dict__:
                 setattr(self._scope, name, value)
             elif not hasattr(self, name):
                 raise AttributeError(f"Attribute '{name}' is not known, so its state cannot be communicated to the server.")
@@ -119,13 +204,93 @@ class ScopeClient:
         return listing
 
 
+class _PropertyCache:
+    """Serve reads of published properties from the local copy maintained by a
+    PropertyClient, falling back to the RPC getter when the copy is not known
+    to be current.
+
+    Beyond the PropertyClient's own checks, any RPC call made by this client
+    may have changed property values on the server. So after each such call,
+    the server's property sequence number and epoch are fetched with the
+    'get_sequence' function, and local values are used only once all updates
+    through that point have been received from the server with that epoch.
+    (Changes made by other clients are seen as soon as their updates arrive.)
+
+    If the PropertyClient reports that updates were missed, or that the server
+    was restarted (i.e. its epoch changed), a new snapshot of the property
+    values is fetched with the 'resynchronize' function.
+    """
+    def __init__(self, property_client, rpc_client, get_sequence, resynchronize):
+        self._property_client = property_client
+        self._rpc_client = rpc_client
+        self._get_sequence = get_sequence
+        self._resynchronize = resynchronize
+        self._call_count = None # rpc_client.call_count when the sequence barrier was last brought up to date
+        self._barrier = 0
+        self._epoch = None # epoch of the server when the barrier was fetched
+        self.hits = 0
+        self.misses = 0
+
+    def local_getter(self, property_name):
+        def local_getter(getter):
+            return self.get(property_name, getter)
+        return local_getter
+
+    def get(self, property_name, getter):
+        property_client = self._property_client
+        if not property_client.is_synchronized():
+            self._resynchronize()
+        if property_client.is_current(property_name):
+            if self._rpc_client.call_count != self._call_count:
+                self._barrier, self._epoch = self._get_sequence()
+                self._call_count = self._rpc_client.call_count
+                if self._epoch != property_client.epoch:
+                    # the server was restarted since the snapshot was taken
+                    self._resynchronize()
+            # sequence numbers from different epochs can't be compared
+            if self._epoch == property_client.epoch and property_client.current_through >= self._barrier:
+                try:
+                    value = property_client.properties[property_name]
+                    self.hits += 1
+                    return value
+                except KeyError:
+                    pass
+        self.misses += 1
+        barrier_current = self._rpc_client.call_count == self._call_count
+        value = getter()
+        if barrier_current:
+            # a getter doesn't change anything, so no need to fetch a new barrier
+            self._call_count = self._rpc_client.call_count
+        return value
+
+def _install_property_cache(scope, property_cache, cacheable):
+    # use the cache for all property accessors whose getters return a cacheable
+    # published property, and return the names of those properties
+    cached = set()
+    namespaces = [scope]
+    while namespaces:
+        namespace = namespaces.pop()
+        for value in vars(namespace).values():
+            if isinstance(value, rpc_client._ClientNamespace):
+                namespaces.append(value)
+        for accessor in vars(type(namespace)).values():
+            if not isinstance(accessor, rpc_client._AccessorProperty) or accessor.getter is None:
+                continue
+            *parents, name = accessor.getter._rpc_function.split('.')
+            # property names are formed as in scope.Scope.initialize_component()
+            path = ['scope'] + [parent for parent in parents if not parent.startswith('_')] + [name[len('get_'):]]
+            property_name = '.'.join(path)
+            if property_name in cacheable:
+                accessor.local_getter = property_cache.local_getter(property_name)
+                cached.add(property_name)
+    return cached
+
 def _patch_camera(camera, get_data, image_transfer_client):
     # ensure that the camera uses the proper data-transfer channels, and
     # monkeypatch the sequence acquisition context manager
 
-    # define image transfer wrapper functions
-    def get_many_data(image_names):
-        return [get_data(name) for name in image_names]
+    # define image transfer wrapper functions; lists of images are fetched with a single call
+    get_many_data = get_data.many
     def get_data_and_metadata(return_values):
         image_name, timestamp, frame_number = return_values
         return get_data(image_name), timestamp, frame_number
@@ -135,27 +300,51 @@ def _patch_camera(camera, get_data, image_transfer_client):
     def get_autofocus_data(return_values):
         best_z, positions_and_scores, image_names = return_values
         return best_z, positions_and_scores, get_many_data(image_names)
+    def get_stream_item_data(item):
+        image_name, timestamp = item
+        return get_data(image_name), timestamp
 
     camera.acquire_image._output_handler = get_data
     camera.next_image._output_handler = get_data
     camera.next_image_and_metadata._output_handler = get_data_and_metadata
     camera.stream_acquire._output_handler = get_stream_data
+    # output handlers for streamed calls are applied to each item as it arrives,
+    # so images are transferred while the acquisition continues
+    camera.iter_stream_acquire._output_handler = get_stream_item_data
     if hasattr(camera, 'acquisition_sequencer'):
         camera.acquisition_sequencer.run._output_handler = get_many_data
+        camera.acquisition_sequencer.iter_run._output_handler = get_data
     if hasattr(camera, 'autofocus'):
         camera.autofocus.autofocus._output_handler = get_autofocus_data
         camera.autofocus.autofocus_continuous_move._output_handler = get_autofocus_data
+        camera.autofocus.iter_autofocus._output_handler = get_data
+        camera.autofocus.iter_autofocus_continuous_move._output_handler = get_data
 
     # use a special RPC channel (the "image transfer" connection) devoted to just
     # getting image names and images from the server. This allows us to grab the
     # latest image from the camera, even when the main connection to the scope
     # is tied up with a blocking call (like autofocus).
-    def latest_image():
+    def latest_image(region=None, pyramid_level=None):
         name, timestamp, frame_number = image_transfer_client('latest_image')
-        return get_data(name), timestamp, frame_number
-    latest_image.__doc__ = camera.latest_image.__doc__
+        return get_data(name, region=region, pyramid_level=pyramid_level), timestamp, frame_number
+    latest_image.__doc__ = (camera.latest_image.__doc__ or "") + """
+
+        To obtain only part of the image, or a mean-binned version of it, pass
+        'region' and/or 'pyramid_level' (see transfer_ism_buffer.reduce_array()).
+        For remote clients, only the reduced image is transferred."""
     camera.latest_image = latest_image
 
+    def next_images(count, read_timeout_ms=None):
+        """Retrieve the next 'count' images in an image sequence acquisition,
+        as with calling next_image() repeatedly, but with a single round trip
+        to the server to wait for the images, and another to transfer them."""
+        rpc_client = camera.next_image._rpc_client
+        with rpc_client.batch() as image_names:
+            for i in range(count):
+                rpc_client(camera.next_image._rpc_function, read_timeout_ms)
+        return get_many_data([image_name.value for image_name in image_names])
+    camera.next_images = next_images
+
     # monkeypatch image sequence acquisition context manager to work on client side
     @contextlib.contextmanager
     def image_sequence_acquisition(frame_count=1, trigger_mode='Internal', **camera_params):
@@ -213,6 +402,10 @@ class LiveStreamer:
         Useful properties:
           live: is the camera in live mode?
           bit_depth: is the camera in 12 vs. 16 bit mode?
+          region, pyramid_level: if not None, get_image() returns only this
+              region of each image, or this mean-binned level of the image
+              pyramid (see transfer_ism_buffer.reduce_array()), which for
+              remote clients is much faster to transfer than the full image.
 
         Simple usage example: the following will pull down ten frames from the
         live image stream; streamer.get_image() will block until an image is
@@ -236,6 +429,11 @@ class LiveStreamer:
             self.bit_depth = '16 Bit'
         self.latest_intervals = collections.deque(maxlen=10)
         self._last_time = time.time()
+        self._frame_number = -1
+        self._subscriber = None
+        self._subscribed_time = None # time.monotonic() when the subscriber was created
+        self.region = None
+        self.pyramid_level = None
         self.scope.properties.subscribe('scope.camera.live_mode', self._live_change, valueonly=True)
         self.scope.properties.subscribe('scope.camera.frame_number', self._image_update, valueonly=True)
         self.scope.properties.subscribe('scope.camera.bit_depth', self._depth_update, valueonly=True)
@@ -245,6 +443,9 @@ class LiveStreamer:
         self.scope.properties.unsubscribe('scope.camera.live_mode', self._live_change, valueonly=True)
         self.scope.properties.unsubscribe('scope.camera.frame_number', self._image_update, valueonly=True)
         self.scope.properties.unsubscribe('scope.camera.bit_depth', self._depth_update, valueonly=True)
+        if self._subscriber is not None:
+            self._subscriber.close()
+            self._subscriber = None
 
     def get_image(self, timeout=None):
         """Return the latest image retrieved from the camera, along with a
@@ -257,11 +458,33 @@ class LiveStreamer:
         no timeout is specified, the wait may not ever return if there is no next
         image.
 
-        To determine whether an image is ready, use image_ready()"""
+        To determine whether an image is ready, use image_ready()
+
+        Clients on a different host from the server receive images from the
+        server's live broadcast (see util.live_broadcast), which is much faster
+        than fetching each image. If the image does not arrive promptly (e.g.
+        because it was broadcast before this client subscribed), it is fetched
+        as usual. (Reduced images, with a region or pyramid level, are always
+        fetched: the broadcast carries whole images.) When the compression or
+        downsampling settings change, the broadcast is not switched over to the
+        new settings until some time after the previous switch, as each switch
+        holds up an image or two."""
         self.image_received.wait()
         # get image before re-enabling image-receiving because if this is over the network, it could take a while
         try:
-            image, timestamp, frame_number = self.scope.camera.latest_image()
+            received = None
+            reduced = self.region is not None or bool(self.pyramid_level)
+            subscriber = None if reduced else self._get_subscriber()
+            if subscriber is not None:
+                t0 = time.perf_counter()
+                received = subscriber.receive(self._BROADCAST_WAIT_SEC, min_frame_number=self._frame_number)
+                get_data = self.scope._get_data
+                if received is not None and (subscriber.compressor, subscriber.downsample) == (get_data.compressor, get_data.downsample):
+                    # let automatic compression settings take account of the broadcast's speed
+                    get_data.record_transfer_time(time.perf_counter() - t0)
+            if received is None:
+                received = self.scope.camera.latest_image(region=self.region, pyramid_level=self.pyramid_level)
+            image, timestamp, frame_number = received
             t = time.time()
             self.latest_intervals.append(t - self._last_time)
             self._last_time = t
@@ -269,6 +492,29 @@ class LiveStreamer:
             self.image_received.clear()
         return image, timestamp, frame_number
 
+    _BROADCAST_WAIT_SEC = 0.5
+    _MIN_RESUBSCRIBE_SEC = 10 # minimum time between switches of the broadcast subscription to new settings
+
+    def _get_subscriber(self):
+        """Return a LiveSubscriber for images with the client's current
+        compression and downsampling (or with the previous settings, if the
+        subscription was switched too recently), or None if the client does
+        not use the live broadcast."""
+        if not getattr(self.scope, '_live_broadcast', False):
+            return None
+        get_data = self.scope._get_data
+        subscriber = self._subscriber
+        if subscriber is not None and (subscriber.compressor, subscriber.downsample) != (get_data.compressor, get_data.downsample):
+            # automatic settings near a threshold may switch back and forth: don't follow every switch
+            if time.monotonic() - self._subscribed_time >= self._MIN_RESUBSCRIBE_SEC:
+                subscriber.close()
+                subscriber = None
+        if subscriber is None:
+            subscriber = self._subscriber = live_broadcast.LiveSubscriber(self.scope._live_broadcast_address,
+                get_data.compressor, get_data.downsample, context=self.scope._context)
+            self._subscribed_time = time.monotonic()
+        return subscriber
+
     def image_ready(self):
         """Return whether an image is ready to be retrieved. If False, a
         call to get_image() will block until an image is ready."""
@@ -290,6 +536,7 @@ class LiveStreamer:
         # called in property client's thread: note we can't do RPC calls
         if frame_number == -1:
             return
+        self._frame_number = frame_number
         self.image_received.set()
         if self.image_ready_callback is not None:
             self.image_ready_callback()
@@ -1,9 +1,12 @@
 # This code is licensed under the MIT License (see LICENSE file for details)
 
 import zmq
+import os
+import stat
 import time
 import threading
 import json
+import pathlib
 
 from .util import logging
 from .util import base_daemon
@@ -58,11 +61,16 @@ class ScopeServer(base_daemon.Runner):
         from . import scope
         from .simple_rpc import rpc_server
         from .simple_rpc import property_server
+        from .simple_rpc import reactor
         from .util import transfer_ism_buffer
+        from .util import live_broadcast
 
         addresses = scope_configuration.get_addresses(self.host)
         self.context = zmq.Context()
-        self.property_server = property_server.ZMQServer(addresses['property'], context=self.context)
+        # all the server sockets are handled from the main thread by a single reactor
+        self.reactor = reactor.Reactor()
+        self.property_server = property_server.ZMQServer(addresses['property'], context=self.context,
+            max_rates=self.config.server.get('PROPERTY_MAX_RATES'), reactor=self.reactor)
         scope_controller = scope.Scope(self.property_server)
         # Provide some basic RPC calls for testing...
         scope_controller._sleep = time.sleep
@@ -73,22 +81,70 @@ class ScopeServer(base_daemon.Runner):
         image_transfer_namespace = Namespace()
         # add transfer_ism_buffer as hidden elements of the namespace, which RPC clients can use for seamless buffer sharing
         image_transfer_namespace._transfer_ism_buffer = transfer_ism_buffer
+        # let clients on the same host find the ipc:// endpoints, if they were bound
+        self.ipc_addresses = None
+        image_transfer_namespace._get_ipc_addresses = lambda: self.ipc_addresses
+        image_transfer_namespace._get_uid = lambda: os.getuid() # so clients can check who owns the endpoints
+        self.live_publisher = None
         if hasattr(scope_controller, 'camera'):
             image_transfer_namespace.latest_image = scope_controller.camera.latest_image
-        self.image_transfer_server = rpc_server.BackgroundBaseZMQServer(image_transfer_namespace,
-            addresses['image_transfer_rpc'], context=self.context)
-        interrupter = rpc_server.ZMQInterrupter(addresses['interrupt'], context=self.context)
+            # each new image is packed once for all remote viewers, and pushed to them
+            self.live_publisher = live_broadcast.LivePublisher(addresses['live_broadcast'], context=self.context,
+                reactor=self.reactor, priority=1)
+            scope_controller.camera._add_image_listener(self.live_publisher.publish)
+        image_transfer_namespace._has_live_broadcast = lambda: self.live_publisher is not None
+        max_workers = self.config.server.get('RPC_WORKERS', 8)
+        # the transfer registry and array pool do their own locking, so calls
+        # need not be serialized here. Image transfer traffic is handled before
+        # RPC traffic (but after interrupts), so that clients waiting for images
+        # are not held up by other calls.
+        self.image_transfer_server = rpc_server.BaseZMQServer(image_transfer_namespace,
+            addresses['image_transfer_rpc'], context=self.context, max_workers=max_workers, lock_groups={'': None},
+            reactor=self.reactor, priority=1)
+        interrupter = rpc_server.ZMQInterrupter(addresses['interrupt'], context=self.context, reactor=self.reactor, priority=2)
+        # commands on each scope component are serialized with calls to any component it uses
         self.scope_server = rpc_server.ZMQServer(scope_controller, interrupter,
-            addresses['rpc'], context=self.context)
+            addresses['rpc'], context=self.context, max_workers=max_workers, lock_groups=scope_controller._lock_groups,
+            reactor=self.reactor)
+        ipc_addresses = scope_configuration.get_ipc_addresses(self.config)
+        if ipc_addresses is not None:
+            self._bind_ipc(ipc_addresses)
+        self.scope_server.describe() # cache the namespace description now, rather than on first client connection
+        metrics_interval = self.config.server.get('METRICS_LOG_INTERVAL')
+        if metrics_interval:
+            self.scope_server.log_metrics_every(metrics_interval, 'Scope server')
+            self.image_transfer_server.log_metrics_every(metrics_interval, 'Image transfer server')
         logger.info('Scope Server Ready (Listening on {})', self.host)
 
+    def _bind_ipc(self, ipc_addresses):
+        """Also bind each server to an ipc:// address, which clients on the same
+        host use in preference to TCP (see ScopeClient)."""
+        servers = dict(rpc=self.scope_server, interrupt=self.scope_server.interrupter,
+            property=self.property_server, image_transfer_rpc=self.image_transfer_server)
+        try:
+            for name, address in ipc_addresses.items():
+                path = pathlib.Path(address[len('ipc://'):])
+                _make_ipc_dir(path.parent)
+                servers[name].socket.bind(address)
+                path.chmod(0o666) # any local user can connect over TCP, so likewise over IPC
+        except (OSError, RuntimeError, zmq.ZMQError) as e:
+            logger.warning('Could not bind ipc:// addresses, so local clients will use TCP: {}', e)
+            return
+        self.ipc_addresses = ipc_addresses
+        logger.info('Also listening on {}', ', '.join(ipc_addresses.values()))
+
     def run_daemon(self):
         try:
-            self.scope_server.run()
+            self.reactor.run()
         finally:
-            self.property_server.stop()
+            # the reactor has stopped, so the servers can now clean up
+            self.scope_server.stop()
             self.image_transfer_server.stop()
             self.scope_server.interrupter.stop()
+            self.property_server.stop()
+            if self.live_publisher is not None:
+                self.live_publisher.stop()
+            self.reactor.close()
             self.context.term()
 
 
@@ -109,6 +165,20 @@ class ScopeClientTester(threading.Thread):
 class Namespace:
     pass
 
+def _make_ipc_dir(path):
+    """Create the directory for ipc:// endpoints if it does not exist. If it
+    does, make sure that it is owned by this user and writable by nobody else,
+    as otherwise someone else could replace the endpoints with their own."""
+    try:
+        path.mkdir(parents=True)
+    except FileExistsError:
+        pass
+    else:
+        path.chmod(0o755) # regardless of the umask
+    path_stat = path.lstat() # not following any symlink put in its place
+    if not stat.S_ISDIR(path_stat.st_mode) or path_stat.st_uid != os.getuid() or path_stat.st_mode & 0o022:
+        raise RuntimeError('{} must be a directory owned by this user, and writable by nobody else'.format(path))
+
 def _wait_for_it(wait_condition, message, wait_time=15, output_interval=0.5, sleep_time=0.1):
     wait_iters = int(wait_time // sleep_time)
     output_iters = int(output_interval // sleep_time)
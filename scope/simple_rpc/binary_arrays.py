@@ -0,0 +1,105 @@
+# This code is licensed under the MIT License (see LICENSE file for details)
+
+"""Transfer of numeric arrays in RPC replies as binary data.
+
+JSON-encoding large numpy arrays or long lists of numbers produces very large
+text payloads, which are slow to produce on the server and slow to parse on
+the client. Instead, the server replaces them with small placeholder objects in
+the JSON reply, and sends the raw array data as additional binary frames
+(see rpc_server.ZMQServerMixin._reply). The client then decodes the reply with
+loads(), which reconstitutes the placeholders from the binary frames.
+
+Numpy arrays are returned to the client as numpy arrays; lists of numbers
+(including nested lists of equal lengths, e.g. lists of (x, y) pairs) are
+returned as lists, as they would be if JSON-encoded. Only lists whose numbers
+are all of the same type (e.g. all ints, or all floats) are sent this way, so
+that a mixture of ints and floats does not come back as all floats.
+
+Clients that cannot decode such replies (e.g. from before this was added) are
+sent plain JSON instead, with numpy arrays converted by arrays_to_lists().
+"""
+
+import json
+import numpy
+
+# shorter lists are JSON-encoded as usual, as it isn't worth checking whether they are numeric
+_MIN_LIST_LENGTH = 32
+_NUMERIC_KINDS = 'biuf' # bool, signed and unsigned integer, and floating-point dtypes
+_PLACEHOLDER_KEY = '__binary_array__'
+
+def extract_arrays(value):
+    """Replace numeric numpy arrays and long lists of numbers within 'value'
+    (which may be nested in lists, tuples and dicts) with placeholders.
+
+    Returns (value, buffers), where 'buffers' is the list of array data
+    referred to by the placeholders, or an empty list if there were no arrays.
+    """
+    buffers = []
+    value = _extract(value, buffers)
+    return value, buffers
+
+def _extract(value, buffers):
+    if isinstance(value, numpy.ndarray):
+        if value.dtype.kind in _NUMERIC_KINDS and value.size > 0:
+            return _placeholder(value, buffers, is_list=False)
+        return value
+    if isinstance(value, (list, tuple)):
+        if len(value) >= _MIN_LIST_LENGTH:
+            array = _as_numeric_array(value)
+            if array is not None:
+                return _placeholder(array, buffers, is_list=True)
+        return [_extract(item, buffers) for item in value]
+    if isinstance(value, dict):
+        return {key: _extract(item, buffers) for key, item in value.items()}
+    return value
+
+def arrays_to_lists(value):
+    """Replace numpy arrays within 'value' (which may be nested in lists, tuples
+    and dicts) with the equivalent lists, so that it can be JSON-encoded."""
+    if isinstance(value, numpy.ndarray):
+        return value.tolist()
+    if isinstance(value, (list, tuple)):
+        return [arrays_to_lists(item) for item in value]
+    if isinstance(value, dict):
+        return {key: arrays_to_lists(item) for key, item in value.items()}
+    return value
+
+def _as_numeric_array(values):
+    try:
+        array = numpy.asarray(values)
+    except (ValueError, TypeError, OverflowError):
+        return None # e.g. lists of unequal lengths
+    if array.dtype.kind not in _NUMERIC_KINDS:
+        return None # e.g. strings, or a mix of numbers and other objects
+    if len(_item_types(values, array.ndim)) != 1:
+        return None # e.g. a mix of ints and floats, which would all become floats
+    return array
+
+def _item_types(values, ndim):
+    # the set of types of the items of a list nested to the given depth
+    if ndim == 1:
+        return set(map(type, values))
+    return set().union(*[_item_types(item, ndim - 1) for item in values])
+
+def _placeholder(array, buffers, is_list):
+    buffers.append(numpy.ascontiguousarray(array))
+    return {_PLACEHOLDER_KEY: len(buffers) - 1, 'dtype': array.dtype.str,
+        'shape': list(array.shape), 'list': is_list}
+
+def loads(json_bytes, buffers):
+    """Decode a JSON reply produced with extract_arrays(), replacing the
+    placeholders with the array data from the list of buffers."""
+    def object_hook(obj):
+        if _PLACEHOLDER_KEY in obj:
+            return _restore(obj, buffers)
+        return obj
+    return json.loads(bytes(json_bytes).decode('utf8'), object_hook=object_hook)
+
+def _restore(placeholder, buffers):
+    array = numpy.frombuffer(buffers[placeholder[_PLACEHOLDER_KEY]], dtype=placeholder['dtype'])
+    array = array.reshape(placeholder['shape'])
+    if placeholder['list']:
+        return array.tolist()
+    if not array.flags.writeable:
+        array = array.copy() # arrays backed by received messages are read-only
+    return array
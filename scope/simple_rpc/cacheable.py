@@ -0,0 +1,37 @@
+# This code is licensed under the MIT License (see LICENSE file for details)
+
+"""Annotations that let functions exposed over RPC declare that their results
+may be memoized by clients.
+
+Example:
+    class Nosepiece:
+        @cacheable
+        def get_all_objectives(self):
+            return self._mags
+
+        @cacheable(max_age_sec=60)
+        def get_slowly_changing_thing(self):
+            ...
+
+The annotation is included in the server's __DESCRIBE__ output (see
+rpc_server.RPCServer.gather_descriptions), and the proxy functions created by
+rpc_client.RPCClient.proxy_namespace() then reuse earlier results for calls
+with the same arguments.
+"""
+
+def cacheable(function=None, max_age_sec=None):
+    """Decorator to declare that a function's result depends only on its
+    arguments, so that clients may memoize it: indefinitely (the default), or
+    for at most max_age_sec seconds. May be used as @cacheable or, to provide
+    a maximum age, as @cacheable(max_age_sec=...)."""
+    def decorator(function):
+        function._rpc_cache = dict(max_age_sec=max_age_sec)
+        return function
+    if function is None:
+        return decorator
+    return decorator(function)
+
+def get_cache_info(function):
+    """Return the cacheable() parameters of a function as a dict, or None if
+    the function is not cacheable."""
+    return getattr(function, '_rpc_cache', None)
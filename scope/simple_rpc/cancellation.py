@@ -0,0 +1,86 @@
+# This code is licensed under the MIT License (see LICENSE file for details)
+
+"""Cooperative cancellation of RPC calls that clients are no longer waiting for.
+
+Clients send their timeout with each request, and the server runs the call with
+a corresponding deadline (see rpc_server.BaseRPCServer). Calls whose deadline
+has passed before they can be started are dropped. Clients can also cancel a
+call outright (e.g. when a streamed call is closed before all its results have
+been received), which sets the call's cancel event. Long-running operations
+should call check() periodically, at points where it is safe to stop, so that
+they can be abandoned once the client has given up on them.
+
+Example:
+    def acquire_many(self, count):
+        images = []
+        for i in range(count):
+            cancellation.check()
+            images.append(self.acquire())
+        return images
+
+Outside of an RPC call with a deadline or cancel event (e.g. when a device is
+used directly), check() does nothing.
+"""
+
+import contextlib
+import threading
+import time
+
+class Cancelled(RuntimeError):
+    pass
+
+class DeadlineExceeded(Cancelled):
+    pass
+
+_local = threading.local()
+
+@contextlib.contextmanager
+def deadline(deadline):
+    """Context manager to run code in the current thread with the given
+    deadline, as a time.monotonic() value, or None for no deadline. If there
+    is already a deadline in effect, the earlier of the two applies."""
+    old_deadline = getattr(_local, 'deadline', None)
+    if deadline is None or (old_deadline is not None and old_deadline < deadline):
+        deadline = old_deadline
+    _local.deadline = deadline
+    try:
+        yield
+    finally:
+        _local.deadline = old_deadline
+
+@contextlib.contextmanager
+def cancel_event(event):
+    """Context manager to run code in the current thread such that check()
+    raises Cancelled once the given threading.Event is set."""
+    old_event = getattr(_local, 'cancel_event', None)
+    _local.cancel_event = event
+    try:
+        yield
+    finally:
+        _local.cancel_event = old_event
+
+def remaining():
+    """Return the number of seconds until the current deadline, or None if
+    there is no deadline in effect."""
+    deadline = getattr(_local, 'deadline', None)
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+def expired():
+    """Return True if the current deadline has passed."""
+    time_left = remaining()
+    return time_left is not None and time_left < 0
+
+def cancelled():
+    """Return True if the current call has been cancelled by the client."""
+    event = getattr(_local, 'cancel_event', None)
+    return event is not None and event.is_set()
+
+def check():
+    """Raise DeadlineExceeded if the current deadline has passed, or Cancelled
+    if the current call has been cancelled."""
+    if expired():
+        raise DeadlineExceeded('Deadline passed: the client is no longer waiting for the result.')
+    if cancelled():
+        raise Cancelled('Cancelled: the client is no longer waiting for the result.')
@@ -0,0 +1,208 @@
+# This code is licensed under the MIT License (see LICENSE file for details)
+
+"""Per-command counts, latencies, payload sizes and error rates for RPC calls.
+
+Both the server (see rpc_server.BaseRPCServer) and the clients (see
+rpc_client.RPCClient) record each call in a CommandMetrics instance, available
+as their 'metrics' attribute. The server's statistics can be fetched by clients
+with the special '__STATS__' command (see rpc_client.RPCClient.server_stats()),
+and can also be logged periodically.
+
+Recording a call takes no locks, so that it does not disturb the timing of
+the calls being measured: each thread records into its own table, and the
+tables are only combined when the statistics are read. Statistics read while
+calls are in progress may thus be very slightly out of date.
+"""
+
+import bisect
+import contextlib
+import threading
+import time
+
+# upper bounds of the latency histogram bins, in ms; the last bin is unbounded
+LATENCY_BINS_MS = (0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000, 60000)
+_LATENCY_BINS_SEC = tuple(bound / 1000 for bound in LATENCY_BINS_MS)
+
+class _Call:
+    __slots__ = ('command', 'start', 'request_bytes', 'reply_bytes', 'error')
+    def __init__(self, command, request_bytes):
+        self.command = command
+        self.start = time.perf_counter()
+        self.request_bytes = request_bytes
+        self.reply_bytes = 0
+        self.error = False
+
+class _CommandStats:
+    __slots__ = ('count', 'errors', 'total_sec', 'max_sec', 'request_bytes', 'reply_bytes', 'histogram')
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total_sec = 0
+        self.max_sec = 0
+        self.request_bytes = 0
+        self.reply_bytes = 0
+        self.histogram = [0] * (len(_LATENCY_BINS_SEC) + 1)
+
+class CommandMetrics:
+    """Record statistics for calls to named commands.
+
+    Calls are recorded either with the measure() context manager, or, when a
+    call is started and finished in different threads, with start() and
+    finish().
+    """
+    def __init__(self):
+        self.start_time = time.time()
+        self._local = threading.local()
+        self._tables = [] # one dict of command name -> _CommandStats per recording thread
+        self._tables_lock = threading.Lock() # only used when a thread records its first call
+
+    def start(self, command, request_bytes=0):
+        """Start timing a call to the named command, and return an object to
+        pass to finish() when the call is complete. Reply sizes can be added
+        to the returned object's 'reply_bytes' attribute in the meantime."""
+        return _Call(command, request_bytes)
+
+    def finish(self, call, error=False):
+        """Record a call started with start(). May be called from any thread."""
+        elapsed = time.perf_counter() - call.start
+        table = self._thread_table()
+        stats = table.get(call.command)
+        if stats is None:
+            stats = table[call.command] = _CommandStats()
+        stats.count += 1
+        if error or call.error:
+            stats.errors += 1
+        stats.total_sec += elapsed
+        if elapsed > stats.max_sec:
+            stats.max_sec = elapsed
+        stats.request_bytes += call.request_bytes
+        stats.reply_bytes += call.reply_bytes
+        stats.histogram[bisect.bisect_left(_LATENCY_BINS_SEC, elapsed)] += 1
+
+    @contextlib.contextmanager
+    def measure(self, command, request_bytes=0):
+        """Context manager to record a call to the named command, made within
+        the context. The call counts as an error if an exception is raised, or
+        if add_reply() is called with error=True."""
+        call = self.start(command, request_bytes)
+        error = True
+        try:
+            with self.recording(call):
+                yield call
+            error = False
+        finally:
+            self.finish(call, error)
+
+    @contextlib.contextmanager
+    def recording(self, call):
+        """Context manager to direct add_request() and add_reply() calls made
+        within the context, in this thread, to a call started with start()."""
+        old_call = getattr(self._local, 'call', None)
+        self._local.call = call
+        try:
+            yield call
+        finally:
+            self._local.call = old_call
+
+    def add_request(self, request_bytes):
+        """Add to the request size of the call being measured in this thread, if any."""
+        call = getattr(self._local, 'call', None)
+        if call is not None:
+            call.request_bytes += request_bytes
+
+    def add_reply(self, reply_bytes, error=False):
+        """Add to the reply size of the call being measured in this thread, if
+        any, and mark it as failed if 'error' is True."""
+        call = getattr(self._local, 'call', None)
+        if call is not None:
+            call.reply_bytes += reply_bytes
+            call.error |= error
+
+    def _thread_table(self):
+        try:
+            return self._local.table
+        except AttributeError:
+            table = self._local.table = {}
+            with self._tables_lock:
+                self._tables.append(table)
+            return table
+
+    def stats(self):
+        """Return a dict mapping command names to dicts of statistics for each
+        command called so far:
+            count: number of calls
+            errors: number of calls that failed
+            error_rate: fraction of calls that failed
+            total_sec: total time taken by the calls
+            mean_ms, max_ms: mean and maximum time per call
+            p50_ms, p95_ms, p99_ms: percentiles of the time per call, estimated
+                from the histogram (as the upper bound of the bin containing
+                the percentile, or None if that bin is unbounded)
+            request_bytes, reply_bytes: total sizes of requests and replies
+            histogram: list of call counts for each bin of LATENCY_BINS_MS,
+                followed by the count of calls slower than the last bin.
+        """
+        with self._tables_lock:
+            tables = list(self._tables)
+        combined = {}
+        for table in tables:
+            for command, stats in list(table.items()):
+                totals = combined.get(command)
+                if totals is None:
+                    totals = combined[command] = dict(count=0, errors=0, total_sec=0, max_sec=0,
+                        request_bytes=0, reply_bytes=0, histogram=[0] * len(stats.histogram))
+                totals['count'] += stats.count
+                totals['errors'] += stats.errors
+                totals['total_sec'] += stats.total_sec
+                totals['max_sec'] = max(totals['max_sec'], stats.max_sec)
+                totals['request_bytes'] += stats.request_bytes
+                totals['reply_bytes'] += stats.reply_bytes
+                totals['histogram'] = [a + b for a, b in zip(totals['histogram'], stats.histogram)]
+        for totals in combined.values():
+            count = totals['count']
+            totals['error_rate'] = totals['errors'] / count if count else 0
+            totals['mean_ms'] = 1000 * totals['total_sec'] / count if count else 0
+            totals['max_ms'] = 1000 * totals.pop('max_sec')
+            for percentile in (50, 95, 99):
+                totals['p{}_ms'.format(percentile)] = _histogram_percentile(totals['histogram'], percentile)
+        return combined
+
+    def summary(self, previous_stats=None, max_commands=10):
+        """Return (summary, stats), where 'stats' is the result of stats(), and
+        'summary' is a string describing the calls that took the most time
+        since 'previous_stats' was obtained (or since the start, if it is
+        None), or None if no calls were made in that time."""
+        stats = self.stats()
+        previous_stats = previous_stats or {}
+        recent = []
+        for command, totals in stats.items():
+            previous = previous_stats.get(command, {})
+            count = totals['count'] - previous.get('count', 0)
+            if count == 0:
+                continue
+            errors = totals['errors'] - previous.get('errors', 0)
+            total_sec = totals['total_sec'] - previous.get('total_sec', 0)
+            reply_bytes = totals['reply_bytes'] - previous.get('reply_bytes', 0)
+            recent.append((total_sec, command, count, errors, reply_bytes))
+        if not recent:
+            return None, stats
+        recent.sort(reverse=True)
+        lines = ['{} calls to {} commands:'.format(sum(entry[2] for entry in recent), len(recent))]
+        for total_sec, command, count, errors, reply_bytes in recent[:max_commands]:
+            lines.append('    {}: {} calls ({} failed), {:.3f} s total, {:.2f} ms mean, {} reply bytes'.format(
+                command, count, errors, total_sec, 1000 * total_sec / count, reply_bytes))
+        if len(recent) > max_commands:
+            lines.append('    ({} more commands)'.format(len(recent) - max_commands))
+        return '\n'.join(lines), stats
+
+def _histogram_percentile(histogram, percentile):
+    total = sum(histogram)
+    if total == 0:
+        return None
+    threshold = total * percentile / 100
+    cumulative = 0
+    for i, count in enumerate(histogram):
+        cumulative += count
+        if cumulative >= threshold:
+            break
+    return LATENCY_BINS_MS[i] if i < len(LATENCY_BINS_MS) else None
@@ -1,7 +1,10 @@
 # This code is licensed under the MIT License (see LICENSE file for details)
 
 import collections
+import queue
 import threading
+import json
+import struct
 import traceback
 import zmq
 from ..util import trie
@@ -11,8 +14,32 @@ class PropertyClient(threading.Thread):
 
     The background thread is automatically started when this object is constructed.
     To stop the thread, set the 'running' attribute to False.
+
+    To start from a consistent state, pass a snapshot of all property values
+    from the server (see property_server.PropertyServer.get_snapshot()) to
+    synchronize(). Updates older than the snapshot are then discarded, and if
+    the server sends an update that shows that a previous update to the same
+    property was missed, gap_count is incremented. (In that case the new value
+    is still current, but other properties may be out of date, so calling
+    synchronize() again is recommended.)
+
+    If updates or snapshots arrive from a server with a different epoch (i.e.
+    the server was restarted, so its sequence numbers started over), or if
+    the client reconnects, the previous snapshot and sequence numbers no
+    longer apply, and synchronize() must be called again. Updates and
+    snapshots from the server's previous epochs are discarded.
+
+    To keep an up-to-date copy of properties in the 'properties' attribute
+    without registering callbacks, use mirror(). Whether a mirrored property
+    is known to be current can be checked with is_current().
+
+    By default, callbacks are called from the background thread that receives
+    updates, so a slow callback delays the receipt of further updates. If
+    callback_threads is greater than zero, callbacks are instead called from
+    that many dispatcher threads. Callbacks for any one property are always
+    called in order, from the same thread.
     """
-    def __init__(self, daemon=True):
+    def __init__(self, daemon=True, callback_threads=0):
         # properties is a local copy of tracked properties, in case that's useful
         self.properties = {}
         # callbacks is a dict mapping property names to lists of callbacks
@@ -20,6 +47,20 @@ class PropertyClient(threading.Thread):
         # prefix_callbacks is a trie used to match property names to prefixes
         # which were registered for "wildcard" callbacks.
         self.prefix_callbacks = trie.trie()
+        # resolved_callbacks caches the list of all callbacks for each property
+        # name, and is cleared whenever subscriptions change.
+        self._resolved_callbacks = {}
+        self._dispatch_queues = [queue.SimpleQueue() for i in range(callback_threads)]
+        for dispatch_queue in self._dispatch_queues:
+            threading.Thread(target=self._dispatch, args=(dispatch_queue,), name='PropertyClientDispatcher', daemon=True).start()
+        self.gap_count = 0 # number of missed updates detected since the last snapshot
+        self.current_through = 0 # sequence number through which all updates have been received
+        self.mirrored_prefixes = set()
+        self._snapshot_sequence = None # sequence number of the most recent snapshot
+        self._sequences = {} # property name -> sequence number of last update received
+        self.epoch = None # epoch of the server that sent the updates and snapshot, if known
+        self._old_epochs = set() # epochs of servers that have since been replaced
+        self._update_lock = threading.RLock()
         super().__init__(name='PropertyClient', daemon=daemon)
         self.start()
 
@@ -36,22 +77,138 @@ class PropertyClient(threading.Thread):
         """Thread target: do not call directly."""
         self.running = True
         while True:
-            property_name, value = self._receive_update()
-            self.properties[property_name] = value
-            for callbacks in [self.callbacks[property_name]] + list(self.prefix_callbacks.values(property_name)):
-                for callback, valueonly in callbacks:
-                    try:
-                        if valueonly:
-                            callback(value)
-                        else:
-                            callback(property_name, value)
-                    except Exception as e:
-                        print('Caught exception in PropertyClient callback:')
-                        traceback.print_exception(type(e), e, e.__traceback__)
+            property_name, value, sequence, previous, published_through, epoch = self._receive_update()
+            if sequence is None:
+                # from a server that does not number its updates: nothing to check
+                self._update(property_name, value)
+                continue
+            with self._update_lock:
+                if not self._check_epoch(epoch):
+                    continue # from a server that has since been replaced
+                self.current_through = max(self.current_through, published_through)
+                if self._snapshot_sequence is not None:
+                    last_seen = max(self._sequences.get(property_name, 0), self._snapshot_sequence)
+                    if sequence <= last_seen:
+                        continue # stale: the snapshot already reflects this update
+                    if previous > last_seen:
+                        self.gap_count += 1
+                self._sequences[property_name] = sequence
+                self._update(property_name, value)
+
+    def synchronize(self, sequence, properties, epoch=None):
+        """Apply a snapshot of property values, as returned by the server's
+        get_snapshot() method. Callbacks are called for all properties in the
+        snapshot that have not since been updated."""
+        with self._update_lock:
+            if not self._check_epoch(epoch):
+                return # from a server that has since been replaced
+            if self._snapshot_sequence is not None and sequence < self._snapshot_sequence:
+                return # a more recent snapshot has already been applied
+            self._snapshot_sequence = sequence
+            self.current_through = max(self.current_through, sequence)
+            self.gap_count = 0
+            for property_name, value in properties.items():
+                if self._sequences.get(property_name, 0) <= sequence:
+                    self._update(property_name, value)
+
+    def _check_epoch(self, epoch):
+        # must be called with self._update_lock held. Returns False if the epoch
+        # is that of a replaced server, and starts over if it is a new one.
+        if epoch is None or epoch == self.epoch:
+            return True
+        if epoch in self._old_epochs:
+            return False
+        if self.epoch is not None:
+            self._old_epochs.add(self.epoch)
+            self._reset_sequences()
+        self.epoch = epoch
+        return True
+
+    def _reset_sequences(self):
+        # must be called with self._update_lock held
+        self.epoch = None
+        self._snapshot_sequence = None
+        self._sequences = {}
+        self.current_through = 0
+        self.gap_count = 0
+
+    def mirror(self, property_prefix):
+        """Receive updates to all properties starting with property_prefix
+        (or all properties, if it is ''), so that the 'properties' attribute
+        tracks their values."""
+        self.mirrored_prefixes.add(property_prefix)
+
+    def is_synchronized(self):
+        """Return whether a snapshot has been applied (since the server was last
+        restarted, or the client reconnected) and no updates have been missed
+        since."""
+        return self._snapshot_sequence is not None and self.gap_count == 0
+
+    def is_current(self, property_name):
+        """Return whether the local value of a mirrored property is known to be
+        current as of the last update received: i.e. a snapshot has been applied
+        and no updates have been missed since."""
+        return (self.is_synchronized() and property_name in self.properties
+            and any(property_name.startswith(prefix) for prefix in self.mirrored_prefixes))
+
+    def _update(self, property_name, value):
+        self.properties[property_name] = value
+        callbacks = self._resolve_callbacks(property_name)
+        if not callbacks:
+            return
+        if self._dispatch_queues:
+            # always use the same queue for a given property so that its updates stay in order
+            dispatch_queue = self._dispatch_queues[hash(property_name) % len(self._dispatch_queues)]
+            dispatch_queue.put((callbacks, property_name, value))
+        else:
+            self._call_callbacks(callbacks, property_name, value)
+
+    def _resolve_callbacks(self, property_name):
+        # grab the cache before resolving: if subscriptions change meanwhile,
+        # the result goes into the discarded cache rather than the new one
+        resolved_callbacks = self._resolved_callbacks
+        try:
+            return resolved_callbacks[property_name]
+        except KeyError:
+            pass
+        callbacks = list(self.callbacks.get(property_name, ()))
+        for prefix_callbacks in self.prefix_callbacks.values(property_name):
+            callbacks.extend(prefix_callbacks)
+        resolved_callbacks[property_name] = callbacks
+        return callbacks
+
+    def _subscriptions_changed(self):
+        self._resolved_callbacks = {}
+
+    def _dispatch(self, dispatch_queue):
+        while True:
+            item = dispatch_queue.get()
+            if item is None:
+                return
+            self._call_callbacks(*item)
+
+    @staticmethod
+    def _call_callbacks(callbacks, property_name, value):
+        for callback, valueonly in callbacks:
+            try:
+                if valueonly:
+                    callback(value)
+                else:
+                    callback(property_name, value)
+            except Exception as e:
+                print('Caught exception in PropertyClient callback:')
+                traceback.print_exception(type(e), e, e.__traceback__)
+
+    def get_dispatch_backlog(self):
+        """Return the number of updates waiting to be passed to callbacks by
+        the dispatcher threads (if any)."""
+        return sum(dispatch_queue.qsize() for dispatch_queue in self._dispatch_queues)
 
     def stop(self):
         self.running = False
         self.join()
+        for dispatch_queue in self._dispatch_queues:
+            dispatch_queue.put(None)
 
     def subscribe(self, property_name, callback, valueonly=False):
         """Register a callback to be called any time the named property is updated.
@@ -61,6 +218,7 @@ class PropertyClient(threading.Thread):
         Multiple callbacks can be registered for a single property_name.
         """
         self.callbacks[property_name].add((callback, valueonly))
+        self._subscriptions_changed()
 
     def unsubscribe(self, property_name, callback, valueonly=False):
         """Unregister an exactly matching, previously registered callback.  If
@@ -75,6 +233,7 @@ class PropertyClient(threading.Thread):
             raise KeyError('No matching subscription found for property name "{}".'.format(property_name)) from None
         if not callbacks:
             del self.callbacks[property_name]
+        self._subscriptions_changed()
 
     def subscribe_prefix(self, property_prefix, callback):
         """Register a callback to be called any time a named property which is
@@ -90,6 +249,7 @@ class PropertyClient(threading.Thread):
         if property_prefix not in self.prefix_callbacks:
             self.prefix_callbacks[property_prefix] = set()
         self.prefix_callbacks[property_prefix].add((callback, False))
+        self._subscriptions_changed()
 
     def unsubscribe_prefix(self, property_prefix, callback):
         """Unregister an exactly matching, previously registered callback.  If
@@ -104,25 +264,31 @@ class PropertyClient(threading.Thread):
             raise KeyError('No matching subscription found for property name "{}".'.format(property_prefix))
         if not callbacks:
             del self.prefix_callbacks[property_prefix]
+        self._subscriptions_changed()
 
     def _receive_update(self):
-        """Receive an update from the server, or raise an error if self.running
-        goes False."""
+        """Receive an update from the server as (property_name, value, sequence,
+        previous_sequence, published_through, epoch), or raise an error if
+        self.running goes False. The sequence numbers may be None, for servers
+        that do not provide them, and the epoch may be None for servers that
+        do not provide it."""
         raise NotImplementedError()
 
 class ZMQClient(PropertyClient):
-    def __init__(self, addr, heartbeat_sec=None, context=None, daemon=True):
+    def __init__(self, addr, heartbeat_sec=None, context=None, daemon=True, callback_threads=0):
         """PropertyClient subclass that uses ZeroMQ PUB/SUB to receive out updates.
         Parameters:
             addr: a string ZeroMQ port identifier, like 'tcp://127.0.0.1:5555'.
             context: a ZeroMQ context to share, if one already exists.
             daemon: exit the client when the foreground thread exits.
+            callback_threads: number of threads to call callbacks from, or 0
+                to call them from the thread that receives updates.
         """
         self.context = context if context is not None else zmq.Context()
         self.addr = addr
         self.heartbeat_sec = heartbeat_sec
         self.connected = threading.Event()
-        super().__init__(daemon)
+        super().__init__(daemon, callback_threads)
 
     def run(self):
         self._connect()
@@ -132,6 +298,9 @@ class ZMQClient(PropertyClient):
             self.socket.close()
 
     def reconnect(self):
+        with self._update_lock:
+            # the server may have been restarted: a new snapshot is needed
+            self._reset_sequences()
         self.connected.clear()
         self.connected.wait()
 
@@ -145,7 +314,7 @@ class ZMQClient(PropertyClient):
             self.socket.HEARTBEAT_TIMEOUT = heartbeat_ms * 2
             self.socket.HEARTBEAT_TTL = heartbeat_ms * 2
         self.socket.connect(self.addr)
-        for property_name in list(self.callbacks) + list(self.prefix_callbacks):
+        for property_name in list(self.callbacks) + list(self.prefix_callbacks) + list(self.mirrored_prefixes):
             self.socket.setsockopt_string(zmq.SUBSCRIBE, property_name)
         self.connected.set()
 
@@ -173,6 +342,12 @@ class ZMQClient(PropertyClient):
         self.socket.unsubscribe(property_prefix)
     unsubscribe_prefix.__doc__ = PropertyClient.unsubscribe_prefix.__doc__
 
+    def mirror(self, property_prefix):
+        self.connected.wait()
+        self.socket.subscribe(property_prefix)
+        super().mirror(property_prefix)
+    mirror.__doc__ = PropertyClient.mirror.__doc__
+
     def _receive_update(self):
         while not self.socket.poll(500): # 500 ms wait before checking self.running again
             if not self.running:
@@ -182,8 +357,13 @@ class ZMQClient(PropertyClient):
                 self.socket.close()
                 self._connect()
         # poll returned true: socket has data to recv
-        property_name = self.socket.recv_string()
-        assert(self.socket.getsockopt(zmq.RCVMORE))
-        value = self.socket.recv_json()
-        return property_name, value
+        property_name, value, *sequences = self.socket.recv_multipart()
+        # older versions of the protocol lack the epoch, or the sequence
+        # numbers too (see property_server.PROTOCOL_VERSION)
+        epoch = struct.unpack('<Q', sequences[1])[0] if len(sequences) > 1 else None
+        if sequences:
+            sequence, previous, published_through = struct.unpack('<QQQ', sequences[0])
+        else:
+            sequence = previous = published_through = None
+        return property_name.decode('utf8'), json.loads(value.decode('utf8')), sequence, previous, published_through, epoch
 
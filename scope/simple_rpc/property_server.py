@@ -1,17 +1,28 @@
 # This code is licensed under the MIT License (see LICENSE file for details)
 
 import zmq
+import os
 import threading
-import queue
+import time
+import struct
 
 from zplib import datafile
 
+from .reactor import Reactor
 from ..util import logging
 logger = logging.get_logger(__name__)
 
 _NOTHING = object() # will compare false to anything, even None
 
-class PropertyServer(threading.Thread):
+# Version 1 messages had two parts: the property name and the JSON-encoded value.
+# Version 2 adds a third part with the update's sequence numbers (see ZMQServer).
+# Version 1 clients cannot read version 2 messages, so must be upgraded along
+# with the server; version 2 clients can read messages from either version.
+# Version 3 adds a fourth part with the server's epoch (see ZMQServer), which
+# version 2 clients ignore; version 3 clients can read messages from any version.
+PROTOCOL_VERSION = 3
+
+class PropertyServer:
     """Server for publishing changes to properties (i.e. (key, value) pairs) to
     other clients.
 
@@ -37,32 +48,173 @@ class PropertyServer(threading.Thread):
             def x(self, value):
                 self._x = value
 
+    Updates are conflated: if a property changes several times before the
+    server thread gets around to publishing it, only the latest value is sent.
+    In addition, the maximum rate at which properties are published can be
+    limited, so that rapidly-changing properties do not swamp subscribers.
+    Property values held back by a rate limit are not lost: the latest value
+    is published as soon as the limit allows.
+
+    Each property update is given a sequence number, which increases by one
+    with every update. A publication carries the sequence number of the update
+    it contains (numbers of conflated updates are thus skipped), along with the
+    sequence number of the previous publication of the same property, and the
+    number up to which all updates have now been published. A client can thus
+    start from a consistent snapshot of all properties (see get_snapshot()),
+    discard any updates that are older than the snapshot, detect when it has
+    missed an update, and tell when it has received all updates up to a given
+    point (see get_sequence()).
+
+    Sequence numbers start again from zero when the server is restarted, so
+    each server also has a random 'epoch' number, which is sent with every
+    update and snapshot. When the epoch changes, clients know to start over.
+
+    Properties that are only refreshed periodically (and thus whose published
+    value may be out of date) can be marked with add_volatile().
+
+    Updates are published from the thread of a reactor.Reactor, which is woken
+    whenever there are new updates, and otherwise sleeps until a rate-limited
+    update is due.
+
+    Parameters:
+        max_rates: dict mapping property-name prefixes to the maximum number
+            of times per second that each property starting with that prefix
+            may be published, or None for no limit. The longest matching prefix
+            applies, e.g.: {'scope.camera.': None, 'scope.camera.frame_number': 30}
+            Rates must be positive; ValueError is raised otherwise.
+        reactor: a Reactor to share, if any. Otherwise, the server runs its
+            own reactor in a background thread.
     """
-    def __init__(self):
-        super().__init__(daemon=True)
+    def __init__(self, max_rates=None, reactor=None):
         self.properties = {}
-        self.task_queue = queue.Queue()
-        self.running = True
-        self.start()
+        self.max_rates = {} if max_rates is None else dict(max_rates)
+        for prefix, max_rate in self.max_rates.items():
+            if max_rate is not None and not max_rate > 0:
+                raise ValueError('Maximum publication rate for "{}" must be positive or None, not {!r}.'.format(prefix, max_rate))
+        self._min_intervals = {} # memoized per-property minimum interval between publications
+        self._last_published = {} # property name -> time of last publication
+        self._pending = {} # property name -> (value, sequence, first unpublished sequence), in order of first update
+        self._sequence = 0 # sequence number of the most recent update
+        self.epoch = int.from_bytes(os.urandom(8), 'little') # identifies this server's run of sequence numbers
+        self._property_sequences = {} # property name -> sequence number of its most recent publication
+        self.volatile_properties = set()
+        self._lock = threading.Lock()
+        self._stats = dict(updates=0, published=0, conflated=0, max_pending=0)
+        self._own_reactor = reactor is None
+        self.reactor = Reactor() if reactor is None else reactor
+        self.reactor.add_timer(self._publish_ready_updates)
+        if self._own_reactor:
+            self._thread = self.reactor.run_in_thread('PropertyServer')
 
-    def run(self):
-        while self.running:
+    def _publish_ready_updates(self):
+        # reactor timer: returns the time until the next rate-limited update is due
+        updates, delay = self._next_updates()
+        for property_name, value, sequence, previous, published_through in updates:
             try:
-                property_name, value = self.task_queue.get(timeout=0.5) # wake up if something in queue, or if it's time to check self.running
-                self._publish_update(property_name, value)
-            except queue.Empty:
-                pass
+                self._publish_update(property_name, value, sequence, previous, published_through)
+            except Exception:
+                # don't lose the rest of the updates, or the timer, to one that can't be sent
+                logger.log_exception('Could not publish update of property {}:'.format(property_name))
+        return delay
+
+    def _next_updates(self):
+        """Remove and return the pending updates that may be published now, as
+        (updates, delay), where updates is a list of (property_name, value,
+        sequence, previous_sequence, published_through) tuples, and delay is
+        the number of seconds until the next held-back update may be published,
+        or None if there are no others."""
+        with self._lock:
+            now = time.monotonic()
+            delay = None
+            ready = []
+            for property_name in self._pending:
+                next_time = self._last_published.get(property_name, 0) + self._min_interval(property_name)
+                if next_time <= now:
+                    ready.append(property_name)
+                elif delay is None or next_time - now < delay:
+                    delay = next_time - now
+            updates = []
+            for property_name in ready:
+                self._last_published[property_name] = now
+                value, sequence, first_sequence = self._pending.pop(property_name)
+                previous = self._property_sequences.get(property_name, 0)
+                self._property_sequences[property_name] = sequence
+                updates.append((property_name, value, sequence, previous, first_sequence))
+            self._stats['published'] += len(ready)
+            # Each message reports the sequence number through which all updates
+            # will have been published once it is sent: i.e. up to the oldest
+            # update still waiting, either in the pending dict or later in this list.
+            published_through = min((first for value, sequence, first in self._pending.values()), default=self._sequence + 1) - 1
+            for i in reversed(range(len(updates))):
+                property_name, value, sequence, previous, first_sequence = updates[i]
+                updates[i] = property_name, value, sequence, previous, published_through
+                published_through = min(published_through, first_sequence - 1)
+            return updates, delay
+
+    def _min_interval(self, property_name):
+        try:
+            return self._min_intervals[property_name]
+        except KeyError:
+            pass
+        prefixes = [prefix for prefix in self.max_rates if property_name.startswith(prefix)]
+        max_rate = self.max_rates[max(prefixes, key=len)] if prefixes else None
+        min_interval = self._min_intervals[property_name] = 0 if max_rate is None else 1 / max_rate
+        return min_interval
 
     def stop(self):
-        self.running = False
-        self.join()
+        """Stop publishing updates. If the server uses a shared reactor, that
+        reactor must have stopped already."""
+        if self._own_reactor:
+            self.reactor.stop()
+            self._thread.join()
+            self.reactor.close()
+        self.close()
+
+    def close(self):
+        pass
+
+    def get_stats(self):
+        """Return a dict of publication statistics: the number of property
+        updates received and published, the number of updates that were
+        superseded by a newer value before they could be published, and the
+        current and maximum number of properties waiting to be published."""
+        with self._lock:
+            return dict(self._stats, pending=len(self._pending))
+
+    def get_snapshot(self):
+        """Return (sequence, properties, epoch), where properties is a dict of
+        the current values of all properties, sequence is the sequence number
+        of the most recent update, and epoch is the server's epoch. Any
+        published update with a sequence number no greater than this is
+        already reflected in the snapshot."""
+        with self._lock:
+            return self._sequence, dict(self.properties), self.epoch
+
+    def get_sequence(self, with_epoch=False):
+        """Return the sequence number of the most recent property update, or
+        (sequence, epoch) if with_epoch is True."""
+        with self._lock:
+            return (self._sequence, self.epoch) if with_epoch else self._sequence
+
+    def add_volatile(self, property_name):
+        """Mark the named property as volatile: i.e. its value is only published
+        periodically, so that the latest published value may be out of date."""
+        self.volatile_properties.add(property_name)
+
+    def get_cacheable_properties(self):
+        """Return a list of the names of properties whose latest published
+        value is always current (i.e. that are not volatile)."""
+        with self._lock:
+            return sorted(set(self.properties) - self.volatile_properties)
 
     def rebroadcast_properties(self):
-        """Re-send an update about all known property values. Useful for
-        clients that have just connected and want to learn about the current
-        state."""
-        for property_name, value in self.properties.items():
-            self.task_queue.put((property_name, value))
+        """Re-send an update about all known property values to all clients.
+        Clients that have just connected and want to learn about the current
+        state should generally use get_snapshot() instead, which does not
+        bother the other clients."""
+        with self._lock:
+            for property_name, value in self.properties.items():
+                self._enqueue(property_name, value)
 
     def add_property(self, property_name, value):
         """Add a named property and provide an initial value.
@@ -74,12 +226,26 @@ class PropertyServer(threading.Thread):
 
     def update_property(self, property_name, value):
         """Inform the server that the property has a new value"""
-        if self.properties.get(property_name, _NOTHING) == value: # don't use None as the default since the value might be None
-            # don't update if we already have this precise value
-            return
-        self.properties[property_name] = value
-        logger.debug('updating property: {} to {}', property_name, value)
-        self.task_queue.put((property_name, value))
+        with self._lock:
+            if self.properties.get(property_name, _NOTHING) == value: # don't use None as the default since the value might be None
+                # don't update if we already have this precise value
+                return
+            self.properties[property_name] = value
+            logger.debug('updating property: {} to {}', property_name, value)
+            self._enqueue(property_name, value)
+
+    def _enqueue(self, property_name, value):
+        # must be called with self._lock held
+        self._stats['updates'] += 1
+        self._sequence += 1
+        if property_name in self._pending:
+            self._stats['conflated'] += 1
+            first_sequence = self._pending[property_name][2]
+        else:
+            first_sequence = self._sequence
+        self._pending[property_name] = value, self._sequence, first_sequence
+        self._stats['max_pending'] = max(self._stats['max_pending'], len(self._pending))
+        self.reactor.wakeup()
 
     def property_decorator(self, property_name):
         """Return a property decorator that will auto-update the named
@@ -92,29 +258,37 @@ class PropertyServer(threading.Thread):
                 propertyserver.update_property(property_name, value)
         return serverproperty
 
-    def _publish_update(self, property_name, value):
+    def _publish_update(self, property_name, value, sequence, previous_sequence, published_through):
         raise NotImplementedError()
 
 class ZMQServer(PropertyServer):
-    def __init__(self, port, context=None):
+    def __init__(self, port, context=None, max_rates=None, reactor=None):
         """PropertyServer subclass that uses ZeroMQ PUB/SUB to send out updates.
+
+        Each update is sent as a four-part message: the property name (which
+        is the subscription topic), the JSON-encoded value, the sequence
+        number of the update, the sequence number of the previous publication
+        of the same property, and the sequence number through which all
+        updates have been published, packed as three little-endian uint64s,
+        and finally the server's epoch, packed as a little-endian uint64.
+        (See PROTOCOL_VERSION.)
+
         Parameters:
             port: a string ZeroMQ port identifier, like 'tcp://127.0.0.1:5555'.
             context: a ZeroMQ context to share, if one already exists.
+            max_rates: per-prefix publication rate limits (see PropertyServer).
+            reactor: a Reactor to share, if any (see PropertyServer).
         """
         self.context = context if context is not None else zmq.Context()
         self.socket = self.context.socket(zmq.PUB)
         self.socket.bind(port)
-        super().__init__()
+        super().__init__(max_rates, reactor)
 
-    def run(self):
-        try:
-            super().run()
-        finally:
-            self.socket.close()
+    def close(self):
+        self.socket.close()
 
-    def _publish_update(self, property_name, value):
-        # dump json first to catch "not serializable" errors before sending the first part of a two-part message
+    def _publish_update(self, property_name, value, sequence, previous_sequence, published_through):
+        # dump json first to catch "not serializable" errors before sending the first part of a multipart message
         json = datafile.json_encode_compact_to_bytes(value)
-        self.socket.send_string(property_name, flags=zmq.SNDMORE)
-        self.socket.send(json)
+        sequences = struct.pack('<QQQ', sequence, previous_sequence, published_through)
+        self.socket.send_multipart([property_name.encode('utf8'), json, sequences, struct.pack('<Q', self.epoch)])
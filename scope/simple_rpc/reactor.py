@@ -0,0 +1,130 @@
+# This code is licensed under the MIT License (see LICENSE file for details)
+
+import socket
+import threading
+import time
+import zmq
+
+from ..util import logging
+logger = logging.get_logger(__name__)
+
+class Reactor:
+    """Run the handlers for any number of ZeroMQ sockets, and for timed tasks,
+    from a single thread.
+
+    Rather than each server running its own thread that wakes up periodically
+    to check for work (and whether it should stop), servers register their
+    sockets with a reactor, which waits on all of them at once, and sleeps
+    until there is something to do. Other threads can wake the reactor
+    immediately with wakeup(), e.g. to let a timer handler know it has work,
+    or to stop it.
+
+    When several sockets are ready at once, their handlers are called in order
+    of decreasing priority, so that (for example) image transfers need not
+    wait behind other traffic.
+
+    Handlers must not block: socket handlers should receive all available
+    messages with zmq.NOBLOCK, and pass any lengthy work to other threads.
+    Exceptions from handlers are logged, and do not stop the reactor.
+    """
+    def __init__(self):
+        self._poller = zmq.Poller()
+        self._handlers = [] # (priority, socket, handler) in order of decreasing priority
+        self._timers = {} # timer handler -> time.monotonic() time when next due, or None
+        # a socket pair rather than a ZeroMQ socket, so that any thread can wake the reactor
+        self._wakeup_receiver, self._wakeup_sender = socket.socketpair()
+        self._wakeup_receiver.setblocking(False)
+        # the poller reports non-ZeroMQ sockets by their file descriptors
+        self._wakeup_fd = self._wakeup_receiver.fileno()
+        self._poller.register(self._wakeup_fd, zmq.POLLIN)
+        self._wakeup_lock = threading.Lock()
+        self._wakeup_pending = False
+        self.running = False
+
+    def register(self, zmq_socket, handler, priority=0):
+        """Call handler() from the reactor thread whenever the socket has
+        messages ready to receive. Must be called before run(), or from
+        a handler."""
+        self._handlers.append((priority, zmq_socket, handler))
+        self._handlers.sort(key=lambda entry: -entry[0]) # stable sort: equal priorities run in order of registration
+        self._poller.register(zmq_socket, zmq.POLLIN)
+
+    def add_timer(self, handler):
+        """Call handler() from the reactor thread when the reactor starts,
+        whenever it is woken with wakeup(), and when it is next due. The handler
+        must return the number of seconds until it is next due, or None if it
+        need not be called again until the next wakeup. Must be called before
+        run(), or from a handler."""
+        self._timers[handler] = 0
+
+    def wakeup(self):
+        """Wake the reactor, so that timer handlers are called without delay.
+        May be called from any thread."""
+        with self._wakeup_lock:
+            if self._wakeup_pending:
+                return # the reactor has not yet seen the previous wakeup
+            self._wakeup_pending = True
+        self._wakeup_sender.send(b'\0')
+
+    def run(self):
+        """Run the reactor in the calling thread until stop() is called."""
+        self.running = True
+        while self.running:
+            ready = dict(self._poller.poll(self._poll_timeout_ms()))
+            woken = self._wakeup_fd in ready
+            if woken:
+                self._clear_wakeup()
+            for priority, zmq_socket, handler in self._handlers:
+                if zmq_socket in ready:
+                    self._call(handler)
+            self._run_timers(woken)
+
+    def run_in_thread(self, name):
+        """Run the reactor in a new daemon thread, which is returned."""
+        thread = threading.Thread(target=self.run, name=name, daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        """Stop the reactor: run() returns once any handlers currently running
+        have finished. May be called from any thread."""
+        self.running = False
+        self.wakeup()
+
+    def close(self):
+        """Release the reactor's resources, once it has stopped. Registered
+        sockets are not closed."""
+        with self._wakeup_lock:
+            self._wakeup_pending = True # so that any further wakeup() calls do nothing
+        self._wakeup_receiver.close()
+        self._wakeup_sender.close()
+
+    def _clear_wakeup(self):
+        # drain before clearing the flag: a wakeup() that comes in between
+        # skips sending, but its caller's work is seen by the timers run next
+        try:
+            while self._wakeup_receiver.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        with self._wakeup_lock:
+            self._wakeup_pending = False
+
+    def _poll_timeout_ms(self):
+        due = [due_time for due_time in self._timers.values() if due_time is not None]
+        if not due:
+            return None # nothing to do until a socket is ready or wakeup() is called
+        return max(0, min(due) - time.monotonic()) * 1000
+
+    def _run_timers(self, woken):
+        now = time.monotonic()
+        for handler, due_time in list(self._timers.items()):
+            if woken or (due_time is not None and due_time <= now):
+                delay = self._call(handler)
+                self._timers[handler] = None if delay is None else time.monotonic() + delay
+
+    def _call(self, handler):
+        try:
+            return handler()
+        except Exception:
+            logger.log_exception('Error in reactor handler {}:'.format(handler))
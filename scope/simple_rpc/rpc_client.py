@@ -3,13 +3,28 @@
 import zmq
 import collections
 import contextlib
+import concurrent.futures
+import copy
+import itertools
+import json
+import pathlib
+import queue
+import struct
+import threading
 import time
+import uuid
 
 from zplib import datafile
 
+from . import binary_arrays
+from . import metrics
+
 class RPCError(RuntimeError):
     pass
 
+# sent with the request id of a streamed call to stop the server producing its results
+_CANCEL_REQUEST = datafile.json_encode_compact_to_bytes(['__CANCEL__', [], {}])
+
 class RPCClient:
     """Client for simple remote procedure calls. RPC calls can be dispatched
     in three ways, given a client object 'client', and the desire to call
@@ -24,28 +39,208 @@ class RPCClient:
     and appropriate argument names, defaults, etc., for run-time introspection.
     In contrast, client.proxy_function() merely returns a simplistic function that
     takes *args and **kwargs parameters.
+
+    Several calls can be sent to the server in a single request with the batch()
+    context manager; see its documentation.
+
+    Server-side generator functions can send their results incrementally: see
+    stream(). Proxy functions for generator functions do this automatically.
+
+    The timeout for calls (see timeout_sec()) is also sent to the server, which
+    drops calls that it can't start before the client stops waiting for them,
+    and lets long-running commands stop early (see cancellation). Servers that
+    predate this can't decode requests that include the timeout, so before the
+    first such request, the client checks that the server accepts it.
+
+    The count, latency, payload sizes and errors of the calls made with each
+    command are recorded in the client's 'metrics' attribute (see
+    metrics.CommandMetrics); server_stats() returns the corresponding
+    statistics recorded by the server, for calls from all clients.
     """
+    _batch = None # list of pending calls while batching, otherwise None
+    call_count = 0 # number of requests sent, so callers can tell if any calls were made since some point
+
     def __call__(self, command, *args, **kwargs):
-        self._send(command, args, kwargs)
-        try:
-            retval, is_error = self._receive_reply()
-        except KeyboardInterrupt:
-            self.send_interrupt()
-            retval, is_error = self._receive_reply()
-        if is_error:
-            raise RPCError(retval)
+        if self._batch is not None:
+            return self._add_to_batch(command, args, kwargs)
+        self.call_count += 1
+        with self.metrics.measure(command):
+            self._send(command, args, kwargs)
+            try:
+                retval, is_error = self._receive_reply()
+            except KeyboardInterrupt:
+                self.send_interrupt()
+                retval, is_error = self._receive_reply()
+            if is_error:
+                raise RPCError(retval)
         return retval
 
+    def stream(self, command, *args, **kwargs):
+        """Call a command that produces its results incrementally (i.e. a
+        server-side generator function), and return a ReplyStream that yields
+        each item as soon as the server sends it. Once all the items have been
+        received, the stream's 'value' attribute contains the generator's
+        return value, if any.
+
+        The timeout applies to each item individually, rather than to the
+        whole call. If the stream is closed (or garbage-collected, or times
+        out) before all the items have been received, the server is told to
+        cancel the call (see cancellation)."""
+        if self._batch is not None:
+            raise RPCError('Streamed calls cannot be made within a batch.')
+        self.call_count += 1
+        receive, cancel = self._send_stream(command, args, kwargs)
+        return ReplyStream(command, receive, cancel)
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Context manager to send all RPC calls (including property assignments
+        on proxy namespaces) made within the context as a single request, saving
+        a network round-trip for each call.
+
+        The server runs the calls in order, and holds the locks for all of the
+        devices involved until the whole batch is complete. If any call fails,
+        the remaining calls are not run and RPCError is raised on leaving the
+        context.
+
+        As results are not available until the batch has been sent, calls within
+        the context return BatchResult placeholders, whose 'value' attribute
+        can be read after the context exits. The context manager also yields the
+        list of these placeholders.
+
+        Example:
+            with client.batch() as results:
+                scope.il.shutter_open = True
+                scope.camera.exposure_time = 10
+                exposure = scope.camera.get_exposure_time()
+            print(exposure.value)
+        """
+        if self._batch is not None:
+            raise RuntimeError('Batches cannot be nested.')
+        batch = self._batch = []
+        try:
+            yield batch
+        finally:
+            self._batch = None
+        if not batch:
+            return
+        calls = [batch_result._call for batch_result in batch]
+        timeouts = [batch_result._timeout_sec for batch_result in batch]
+        total_timeout = None
+        if self._timeout_sec is not None and any(timeout is not None for timeout in timeouts):
+            # the batch may take as long as all its calls together
+            total_timeout = sum(self._timeout_sec if timeout is None else timeout for timeout in timeouts)
+        with self.timeout_sec(total_timeout):
+            values = self._result_value(self('__BATCH__', calls))
+        for batch_result, value in zip(batch, values):
+            batch_result._set_value(value)
+
+    def _add_to_batch(self, command, args, kwargs, output_handler=None, timeout_sec=None):
+        batch_result = BatchResult(command, args, kwargs, output_handler, timeout_sec)
+        self._batch.append(batch_result)
+        return batch_result
+
+    _timeout_sec = None
+
+    @contextlib.contextmanager
+    def timeout_sec(self, timeout_sec):
+        """Context manager to alter the timeout time."""
+        old_timeout = self._timeout_sec
+        if timeout_sec is not None:
+            self._timeout_sec = timeout_sec
+        try:
+            yield
+        finally:
+            self._timeout_sec = old_timeout
+
+    _result_cache = None # dict of memoized results of cacheable commands
+
+    def clear_result_cache(self):
+        """Forget the memoized results of commands that the server has declared
+        cacheable (see cacheable.cacheable())."""
+        self._result_cache = {}
+
+    def _call_cacheable(self, command, args, kwargs, max_age_sec):
+        """Call a command that the server has declared cacheable, reusing the
+        result of an earlier call with the same arguments if it has not expired."""
+        if self._result_cache is None:
+            self._result_cache = {}
+        key = command, datafile.json_encode_compact_to_bytes((args, kwargs))
+        if key in self._result_cache:
+            expires, result = self._result_cache[key]
+            if expires is None or time.monotonic() < expires:
+                return copy.deepcopy(result) # don't let callers modify the memoized copy
+        result = self(command, *args, **kwargs)
+        if not isinstance(result, concurrent.futures.Future): # results of async calls are not memoized
+            expires = None if max_age_sec is None else time.monotonic() + max_age_sec
+            self._result_cache[key] = expires, copy.deepcopy(result)
+        return result
+
+    def _handle_output(self, result, output_handler):
+        """Apply an output handler to the result of a call. Subclasses that
+        return placeholders for results (e.g. futures) can override this to
+        apply the handler when the result is available."""
+        return output_handler(result)
+
+    def _result_value(self, result):
+        """Return the value of a call's result, waiting for it if necessary."""
+        return result
+
     def _send(self, command, args, kwargs):
         raise NotImplementedError()
 
+    def _encode_request(self, command, args, kwargs):
+        """Encode a call for sending to the server, including the current
+        timeout, so that the server can abandon calls that are no longer being
+        waited for (see cancellation), and asking for numeric arrays in the
+        reply to be sent as binary data (see binary_arrays)."""
+        request = [command, args, kwargs]
+        if command != '__OPTIONS__':
+            accepted = self._server_accepts_options()
+            options = {}
+            # the timeout of a streamed call applies to each item, not to the whole call
+            if self._timeout_sec is not None and command != '__STREAM__' and 'timeout_sec' in accepted:
+                options['timeout_sec'] = self._timeout_sec
+            if 'binary_arrays' in accepted:
+                options['binary_arrays'] = True
+            if options:
+                request.append(options)
+        return datafile.json_encode_compact_to_bytes(request)
+
+    _accepts_options = None # the set of request options the server accepts, once known
+
+    def _server_accepts_options(self):
+        """Return the set of names of the options that the server accepts
+        following a request's arguments (see rpc_server.ZMQServerMixin),
+        asking it if not yet known."""
+        if self._accepts_options is None:
+            try:
+                self._accepts_options = set(self._result_value(self('__OPTIONS__')))
+            except RPCError as e:
+                if not str(e).startswith('No such command'):
+                    raise # e.g. the server is not responding, so the call itself would fail too
+                self._accepts_options = set() # an older server
+        return self._accepts_options
+
     def _receive_reply(self):
         raise NotImplementedError()
 
+    def _send_stream(self, command, args, kwargs):
+        """Send a streamed call, and return (receive, cancel): a function that
+        waits for the next reply and returns (is_partial, value), or raises
+        RPCError if the server replied with an error, and a function that asks
+        the server to stop the call, if it has not finished."""
+        raise NotImplementedError()
+
     def send_interrupt(self):
         """Raise a KeyboardInterrupt exception in the server process"""
         raise NotImplementedError()
 
+    def server_stats(self):
+        """Return the server's per-command call statistics (see
+        rpc_server.RPCServer.stats())."""
+        return self._result_value(self('__STATS__'))
+
     def proxy_function(self, command):
         """Return a proxy function for server-side command 'command'."""
         def func(*args, **kwargs):
@@ -53,7 +248,43 @@ class RPCClient:
         func.__name__ = func.__qualname__ = command
         return func
 
-    def proxy_namespace(self, no_property={}):
+    def describe(self, description_cache=None):
+        """Return the server's list of command descriptions (see rpc_server.RPCServer).
+
+        Parameter:
+            description_cache: if not None, path to a file in which to save the
+                descriptions. If the file exists and the server reports that its
+                descriptions are unchanged, the saved copy is used instead of
+                fetching and transferring the full descriptions again.
+        """
+        if description_cache is None:
+            return self._result_value(self('__DESCRIBE__'))
+        description_cache = pathlib.Path(description_cache)
+        try:
+            description_hash = self._result_value(self('__DESCRIBE_HASH__'))
+        except RPCError:
+            # server doesn't support description hashes
+            return self._result_value(self('__DESCRIBE__'))
+        try:
+            with description_cache.open('r') as f:
+                cached = json.load(f)
+            if cached['hash'] == description_hash:
+                return cached['descriptions']
+        except (OSError, ValueError, KeyError, TypeError):
+            pass # missing or bad cache file: just get a new copy
+        descriptions = self._result_value(self('__DESCRIBE__'))
+        try:
+            description_cache.parent.mkdir(parents=True, exist_ok=True)
+            # write to a temp file and rename, so that concurrent clients never see a partial file
+            temp_file = description_cache.with_name(description_cache.name + '.' + uuid.uuid4().hex)
+            with temp_file.open('w') as f:
+                json.dump(dict(hash=description_hash, descriptions=descriptions), f)
+            temp_file.replace(description_cache)
+        except OSError:
+            pass # caching is just an optimization
+        return descriptions
+
+    def proxy_namespace(self, no_property={}, description_cache=None):
         """Use the RPC server's __DESCRIBE__ functionality to reconstitute a
         faxscimile namespace on the client side with well-described functions
         that can be seamlessly called.
@@ -61,14 +292,16 @@ class RPCClient:
         A set of the fully-qualified function names available in the namespace
         is included as the _functions_proxied attribute of this namespace.
 
-        Parameter:
+        Parameters:
             no_property: set of qualified names that should not be made properties,
                 despite starting with 'set_' or 'get_'.
+            description_cache: optional path to a file for saving the namespace
+                description between sessions: see describe().
         """
         # group functions by their namespace
         server_namespaces = collections.defaultdict(list)
         functions_proxied = set()
-        for qualname, doc, argspec in self('__DESCRIBE__'):
+        for qualname, doc, argspec in self.describe(description_cache):
             functions_proxied.add(qualname)
             *parents, name = qualname.split('.')
             parents = tuple(parents)
@@ -91,6 +324,8 @@ class RPCClient:
             accessors = collections.defaultdict(_AccessorProperty)
             for name, qualname, doc, argspec in function_descriptions:
                 client_func = _rich_proxy_function(doc, argspec, name, self, qualname)
+                client_func._cache_info = argspec.get('cache')
+                client_func._stream = argspec.get('stream', False)
                 if qualname not in no_property:
                     if name.startswith('get_'):
                         accessors[name[4:]].getter = client_func
@@ -123,10 +358,107 @@ class RPCClient:
         return root
 
 
+class BatchResult:
+    """Placeholder for the result of an RPC call made within a batch: see
+    RPCClient.batch(). Once the batch has been sent, the 'value' attribute
+    contains the call's return value."""
+    def __init__(self, command, args, kwargs, output_handler=None, timeout_sec=None):
+        self.command = command
+        self._call = command, args, kwargs
+        self._output_handler = output_handler
+        self._timeout_sec = timeout_sec
+        self._ready = False
+
+    def _set_value(self, value):
+        if self._output_handler is not None:
+            value = self._output_handler(value)
+        self._value = value
+        self._ready = True
+
+    @property
+    def value(self):
+        if not self._ready:
+            raise RPCError('Result of "{}" is not available until the batch has been sent.'.format(self.command))
+        return self._value
+
+    def __repr__(self):
+        value = repr(self._value) if self._ready else 'pending'
+        return 'BatchResult({}: {})'.format(self.command, value)
+
+
+class ReplyStream:
+    """Iterator over the items sent by the server for a streamed call: see
+    RPCClient.stream(). Once the iterator is exhausted, the 'value' attribute
+    contains the return value of the server-side generator.
+
+    If an output handler function is set, it is applied to each item.
+
+    To stop early, call close(), or use the stream as a context manager: the
+    server then cancels the call rather than producing the remaining items.
+    Streams that are garbage-collected before they are exhausted are closed
+    likewise. (For a ZMQClient, whose socket may only be used from the thread
+    that made the call, a stream garbage-collected in another thread is
+    instead cancelled when that thread makes its next call.)"""
+    def __init__(self, command, receive, cancel, output_handler=None):
+        self.command = command
+        self._receive = receive
+        self._cancel = cancel
+        self._output_handler = output_handler
+        self._done = False
+        self._closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._done:
+            raise StopIteration
+        is_partial, value = self._receive()
+        if not is_partial:
+            self._done = True
+            self._value = value
+            raise StopIteration
+        if self._output_handler is not None:
+            value = self._output_handler(value)
+        return value
+
+    def close(self):
+        """Stop receiving items, and cancel the call on the server if it is
+        still producing them."""
+        if not self._done:
+            self._done = True
+            self._closed = True
+            self._cancel()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __del__(self):
+        self.close()
+
+    @property
+    def value(self):
+        if self._closed:
+            raise RPCError('Return value of "{}" is not available: the stream was closed before all its results were received.'.format(self.command))
+        if not self._done:
+            raise RPCError('Return value of "{}" is not available until all its results have been received.'.format(self.command))
+        return self._value
+
+    def __repr__(self):
+        state = 'closed' if self._closed else 'complete' if self._done else 'pending'
+        return 'ReplyStream({}: {})'.format(self.command, state)
+
+
 class _AccessorProperty:
     def __init__(self):
         self.getter = None
         self.setter = None
+        # optional function to provide the value locally instead, called as
+        # local_getter(getter) so that it can fall back to the RPC getter
+        self.local_getter = None
 
     def _set_doc(self):
         assert self.getter or self.setter # at least one must not be None!
@@ -137,6 +469,8 @@ class _AccessorProperty:
             return self
         if self.getter is None:
             raise AttributeError('unreadable attribute')
+        if self.local_getter is not None and self.getter._rpc_client._batch is None:
+            return self.local_getter(self.getter)
         return self.getter()
 
     def __set__(self, obj, value):
@@ -156,7 +490,9 @@ class _ClientNamespace:
 
     def __setattr__(self, name, value):
         if self.__attrs_locked:
-            if not hasattr(self, name):
+            # check the class rather than using hasattr(self, name), which would call the
+            # property getter: an unnecessary RPC, and one that would be recorded in a batch
+            if not hasattr(type(self), name) and name not in self.__dict__:
                 raise RPCError('Attribute "{}" is not known, so its state cannot be communicated to the server.'.format(name))
             else:
                 cls = type(self)
@@ -167,7 +503,12 @@ class _ClientNamespace:
 
 class ZMQClient(RPCClient):
     def __init__(self, rpc_addr, interrupt_addr=None, heartbeat_sec=None, timeout_sec=10, context=None):
-        """RPCClient subclass that uses ZeroMQ REQ/REP to communicate.
+        """RPCClient subclass that uses ZeroMQ to communicate, waiting for the
+        reply to each call before returning.
+
+        A DEALER socket is used, with a REQ-style envelope carrying a request id,
+        so that stale replies (to calls that timed out) can be discarded, and
+        so that streamed calls can receive several replies.
         Parameters:
             rpc_addr: a string ZeroMQ port identifier, like 'tcp://127.0.0.1:5555'.
             timeout_sec: timeout in seconds for RPC call to fail.
@@ -178,28 +519,27 @@ class ZMQClient(RPCClient):
         self.interrupt_addr = interrupt_addr
         self.heartbeat_sec = heartbeat_sec
         self._timeout_sec = timeout_sec
+        self.metrics = metrics.CommandMetrics()
         self._connect()
 
     def _connect(self):
-        self.socket = self.context.socket(zmq.REQ)
-        self.socket.RCVTIMEO = 0 # we use poll to determine when a message is ready, so set a zero timeout
+        self.socket = self.context.socket(zmq.DEALER)
         self.socket.LINGER = 0
-        self.socket.REQ_RELAXED = True
-        self.socket.REQ_CORRELATE = True
-        if self.heartbeat_sec is not None:
-            heartbeat_ms = self.heartbeat_sec * 1000
-            self.socket.HEARTBEAT_IVL = heartbeat_ms
-            self.socket.HEARTBEAT_TIMEOUT = heartbeat_ms * 2
-            self.socket.HEARTBEAT_TTL = heartbeat_ms * 2
+        self._request_ids = itertools.count()
+        self._request_id = None # id of the most recent request
+        self._cancel_stream = None # cancel function of a streamed call whose results are still being received
+        # choose our own identity so that interrupts can be targeted at our own commands
+        self.identity = uuid.uuid4().hex.encode('ascii')
+        self.socket.IDENTITY = self.identity
+        _set_heartbeat(self.socket, self.heartbeat_sec)
         self.socket.connect(self.rpc_addr)
+        self._connect_interrupt_socket()
 
+    def _connect_interrupt_socket(self):
         if self.interrupt_addr is not None:
             self.interrupt_socket = self.context.socket(zmq.PUSH)
             self.interrupt_socket.LINGER = 0
-            if self.heartbeat_sec is not None:
-                self.interrupt_socket.HEARTBEAT_IVL = heartbeat_ms
-                self.interrupt_socket.HEARTBEAT_TIMEOUT = heartbeat_ms * 2
-                self.interrupt_socket.HEARTBEAT_TTL = heartbeat_ms * 2
+            _set_heartbeat(self.interrupt_socket, self.heartbeat_sec)
             self.interrupt_socket.connect(self.interrupt_addr)
 
     def reconnect(self):
@@ -207,42 +547,351 @@ class ZMQClient(RPCClient):
         if self.interrupt_addr is not None:
             self.interrupt_socket.close()
         self._connect()
-
-    @contextlib.contextmanager
-    def timeout_sec(self, timeout_sec):
-        """Context manager to alter the timeout time."""
-        old_timeout = self._timeout_sec
-        if timeout_sec is not None:
-            self._timeout_sec = timeout_sec
-        try:
-            yield
-        finally:
-            self._timeout_sec = old_timeout
+        self.clear_result_cache() # the server may have been restarted
+        self._accepts_options = None # ... or replaced with a different version
 
     def _send(self, command, args, kwargs):
-        json = datafile.json_encode_compact_to_bytes((command, args, kwargs))
-        self.socket.send(json)
+        if self._cancel_stream is not None:
+            # the rest of the stream's results will be discarded, so don't let the server produce them
+            self._cancel_stream()
+        json = self._encode_request(command, args, kwargs)
+        self._request_id = struct.pack('<I', next(self._request_ids) % 2**32)
+        self.socket.send_multipart([self._request_id, b'', json])
+        self.metrics.add_request(len(json))
 
     def _receive_reply(self):
-        if not self.socket.poll(self._timeout_sec * 1000):
-            raise RPCError('Timed out waiting for reply from server (is it running?)')
+        reply_type, reply = self._receive_typed_reply(self._request_id)
+        return reply, reply_type == 'error'
+
+    def _receive_typed_reply(self, request_id):
+        """Wait for the next reply to the given request, discarding any replies
+        to earlier requests, and return (reply_type, reply)."""
+        deadline = time.monotonic() + self._timeout_sec
         while True:
+            timeout_ms = max(0, deadline - time.monotonic()) * 1000
+            if not self.socket.poll(timeout_ms):
+                raise RPCError('Timed out waiting for reply from server (is it running?)')
+            reply_request_id, delimiter, reply_type, *reply = self.socket.recv_multipart(copy=False, track=False)
+            if reply_request_id.bytes == request_id:
+                self.metrics.add_reply(sum(len(frame) for frame in reply))
+                reply_type = reply_type.bytes.decode('ascii')
+                return reply_type, _decode_reply(reply_type, reply)
+
+    def _send_stream(self, command, args, kwargs):
+        # the call is recorded in the metrics once its last reply is received
+        call = self.metrics.start(command)
+        with self.metrics.recording(call):
+            self._send('__STREAM__', (command, args, kwargs), {})
+        request_id = self._request_id
+        timeout_sec = self._timeout_sec
+        thread = threading.get_ident()
+        done = False
+        def finish(error=False):
+            nonlocal done
+            done = True
+            self.metrics.finish(call, error)
+            if self._cancel_stream is cancel:
+                self._cancel_stream = None
+        def cancel(error=False):
+            if threading.get_ident() != thread:
+                # e.g. the stream was garbage-collected in another thread, which must
+                # not use the socket: the next call from this thread cancels the stream
+                return
+            if not done:
+                finish(error)
+                if not self.socket.closed:
+                    # sent with the stream's request id, so that the server can tell which call to cancel
+                    self.socket.send_multipart([request_id, b'', _CANCEL_REQUEST])
+        def receive():
+            if self._request_id != request_id:
+                raise RPCError('Results of "{}" are no longer available: another call was made before they were all received.'.format(command))
             try:
-                reply_type = self.socket.recv_string()
-                break
-            except zmq.Again:
-                time.sleep(0.001)
-        assert(self.socket.RCVMORE)
-        if reply_type == 'bindata':
-            reply = self.socket.recv(copy=False, track=False).buffer
-        else:
-            reply = self.socket.recv_json()
-        return reply, reply_type == 'error'
+                with self.timeout_sec(timeout_sec), self.metrics.recording(call):
+                    try:
+                        reply_type, reply = self._receive_typed_reply(request_id)
+                    except KeyboardInterrupt:
+                        self.send_interrupt()
+                        reply_type, reply = self._receive_typed_reply(request_id)
+            except BaseException:
+                # the server may still be running the call, which nobody is waiting for now
+                cancel(error=True)
+                raise
+            if reply_type == 'error':
+                finish(error=True)
+                raise RPCError(reply)
+            is_partial = reply_type.startswith('partial_')
+            if not is_partial:
+                finish()
+            return is_partial, reply
+        self._cancel_stream = cancel
+        return receive, cancel
 
     def send_interrupt(self):
         """Raise a KeyboardInterrupt exception in the server process"""
         if self.interrupt_addr is not None:
-            self.interrupt_socket.send(b'interrupt')
+            self.interrupt_socket.send(b'interrupt ' + self.identity.hex().encode('ascii'))
+
+
+class AsyncZMQClient(RPCClient):
+    def __init__(self, rpc_addr, interrupt_addr=None, heartbeat_sec=None, timeout_sec=10, context=None):
+        """RPCClient subclass that sends calls without waiting for the replies,
+        so that many calls can be in flight at once. Calls return
+        concurrent.futures.Future objects, which can be waited on with their
+        result() method, or wrapped with asyncio.wrap_future() for use from
+        asyncio code.
+
+        Calls may be made from any thread: a background thread owns the ZeroMQ
+        DEALER socket, which sends each request with a unique request id and
+        matches replies to the pending futures, in whatever order the server
+        finishes them. (The server runs calls on different devices
+        concurrently: see rpc_server.BaseRPCServer.) The batch() and
+        timeout_sec() contexts apply only to calls made from the thread that
+        entered them.
+
+        Proxy namespaces built with proxy_namespace() work as for ZMQClient,
+        except that their functions and property getters return futures. Any
+        output handlers run in the background thread when the reply arrives.
+
+        Parameters:
+            rpc_addr: a string ZeroMQ port identifier, like 'tcp://127.0.0.1:5555'.
+            interrupt_addr: a string ZeroMQ port identifier for the interrupt server, if any.
+            heartbeat_sec: interval for ZeroMQ heartbeats, or None.
+            timeout_sec: timeout in seconds for RPC call to fail.
+            context: a ZeroMQ context to share, if one already exists.
+        """
+        self.context = context if context is not None else zmq.Context()
+        self.rpc_addr = rpc_addr
+        self.interrupt_addr = interrupt_addr
+        self.heartbeat_sec = heartbeat_sec
+        self._default_timeout_sec = timeout_sec
+        self._thread_state = threading.local() # per-thread batch and timeout
+        self.metrics = metrics.CommandMetrics()
+        self.identity = uuid.uuid4().hex.encode('ascii')
+        self._pending = {} # maps request ids to (future or stream queue, deadline, timeout_sec, metrics call)
+        self._pending_lock = threading.Lock()
+        self._request_ids = itertools.count()
+        self._send_address = 'inproc://rpc-requests-{}'.format(id(self))
+        self._thread_send_sockets = threading.local()
+        self._send_sockets = []
+        self._running = True
+        # set up the sockets before starting the thread, so that calls can be made immediately
+        self._request_collector = self.context.socket(zmq.PULL)
+        self._request_collector.bind(self._send_address)
+        self.socket = self.context.socket(zmq.DEALER)
+        self.socket.LINGER = 0
+        self.socket.IDENTITY = self.identity
+        _set_heartbeat(self.socket, self.heartbeat_sec)
+        self.socket.connect(self.rpc_addr)
+        self._connect_interrupt_socket()
+        self._thread = threading.Thread(target=self._run, name='AsyncZMQClient', daemon=True)
+        self._thread.start()
+
+    _connect_interrupt_socket = ZMQClient._connect_interrupt_socket
+    send_interrupt = ZMQClient.send_interrupt
+
+    # calls may be made from several threads at once, so the state set up by
+    # the batch() and timeout_sec() contexts is kept per-thread
+    @property
+    def _batch(self):
+        return getattr(self._thread_state, 'batch', None)
+
+    @_batch.setter
+    def _batch(self, batch):
+        self._thread_state.batch = batch
+
+    @property
+    def _timeout_sec(self):
+        return getattr(self._thread_state, 'timeout_sec', self._default_timeout_sec)
+
+    @_timeout_sec.setter
+    def _timeout_sec(self, timeout_sec):
+        self._thread_state.timeout_sec = timeout_sec
+
+    def __call__(self, command, *args, **kwargs):
+        if self._batch is not None:
+            return self._add_to_batch(command, args, kwargs)
+        self.call_count += 1
+        return self._send(command, args, kwargs)
+
+    def close(self):
+        """Stop the background thread and close the sockets. Calls still in
+        flight fail with RPCError."""
+        self._running = False
+        self._thread.join()
+        with self._pending_lock:
+            pending = list(self._pending.items())
+            self._pending.clear()
+        for request_id, (target, deadline, timeout_sec, call) in pending:
+            self.metrics.finish(call, error=True)
+            _set_error(target, 'Client closed before reply was received')
+            if not isinstance(target, concurrent.futures.Future):
+                # the background thread has stopped, so the socket can be used from here
+                self.socket.send_multipart([request_id, b'', _CANCEL_REQUEST])
+        for send_socket in self._send_sockets:
+            send_socket.close()
+        self._request_collector.close()
+        self.socket.close()
+        if self.interrupt_addr is not None:
+            self.interrupt_socket.close()
+
+    def _handle_output(self, future, output_handler):
+        handled = concurrent.futures.Future()
+        def apply_handler(future):
+            try:
+                handled.set_result(output_handler(future.result()))
+            except Exception as e:
+                handled.set_exception(e)
+        future.add_done_callback(apply_handler)
+        return handled
+
+    def _result_value(self, future):
+        return future.result()
+
+    def _send(self, command, args, kwargs, target=None, metrics_name=None, request_id=None):
+        # replies are delivered to the target: a future (the default), or for
+        # streamed calls, a queue of (reply_type, reply) pairs
+        if not self._running:
+            raise RPCError('Client is closed')
+        message = self._encode_request(command, args, kwargs)
+        if target is None:
+            target = concurrent.futures.Future()
+        # the call is recorded in the metrics by the background thread, when its last reply arrives
+        call = self.metrics.start(command if metrics_name is None else metrics_name, len(message))
+        if request_id is None:
+            request_id = self._new_request_id()
+        deadline = time.monotonic() + self._timeout_sec
+        with self._pending_lock:
+            self._pending[request_id] = target, deadline, self._timeout_sec, call
+        self._get_send_socket().send_multipart([request_id, b'', message])
+        return target
+
+    def _send_stream(self, command, args, kwargs):
+        # unlike other calls, the stream is iterated by the caller, so the
+        # items are passed through a queue rather than a future
+        request_id = self._new_request_id()
+        replies = self._send('__STREAM__', (command, args, kwargs), {}, queue.SimpleQueue(), command, request_id)
+        def receive():
+            reply_type, reply = replies.get()
+            if reply_type == 'error':
+                raise RPCError(reply)
+            return reply_type.startswith('partial_'), reply
+        def cancel():
+            with self._pending_lock:
+                pending = self._pending.pop(request_id, None)
+            if pending is not None and self._running:
+                target, deadline, timeout_sec, call = pending
+                self.metrics.finish(call)
+                # sent with the stream's request id, so that the server can tell which call to cancel
+                self._get_send_socket().send_multipart([request_id, b'', _CANCEL_REQUEST])
+        return receive, cancel
+
+    def _new_request_id(self):
+        return struct.pack('<I', next(self._request_ids) % 2**32)
+
+    def _get_send_socket(self):
+        # ZeroMQ sockets aren't thread-safe, so each calling thread passes its
+        # requests to the background thread with its own inproc socket
+        try:
+            return self._thread_send_sockets.socket
+        except AttributeError:
+            send_socket = self.context.socket(zmq.PUSH)
+            send_socket.connect(self._send_address)
+            self._thread_send_sockets.socket = send_socket
+            with self._pending_lock:
+                self._send_sockets.append(send_socket)
+            return send_socket
+
+    def _run(self):
+        poller = zmq.Poller()
+        poller.register(self.socket, zmq.POLLIN)
+        poller.register(self._request_collector, zmq.POLLIN)
+        while self._running:
+            ready = dict(poller.poll(100)) # check for timeouts and stopping every 100 ms
+            if self._request_collector in ready:
+                self._forward_requests()
+            if self.socket in ready:
+                self._receive_replies()
+            self._expire_requests()
+
+    def _forward_requests(self):
+        while True:
+            try:
+                frames = self._request_collector.recv_multipart(flags=zmq.NOBLOCK, copy=False)
+            except zmq.Again:
+                return
+            self.socket.send_multipart(frames, copy=False)
+
+    def _receive_replies(self):
+        while True:
+            try:
+                request_id, delimiter, reply_type, *reply = self.socket.recv_multipart(flags=zmq.NOBLOCK, copy=False)
+            except zmq.Again:
+                return
+            reply_type = reply_type.bytes.decode('ascii')
+            request_id = request_id.bytes
+            is_partial = reply_type.startswith('partial_')
+            with self._pending_lock:
+                target, deadline, timeout_sec, call = self._pending.pop(request_id, (None, None, None, None))
+                if target is not None and is_partial:
+                    # more replies to come: restart the timeout for the next one
+                    self._pending[request_id] = target, time.monotonic() + timeout_sec, timeout_sec, call
+            if target is None:
+                continue # reply to a call that already timed out
+            call.reply_bytes += sum(len(frame) for frame in reply)
+            if not is_partial:
+                self.metrics.finish(call, error=reply_type == 'error')
+            reply = _decode_reply(reply_type, reply)
+            if isinstance(target, concurrent.futures.Future):
+                if reply_type == 'error':
+                    target.set_exception(RPCError(reply))
+                else:
+                    target.set_result(reply)
+            else:
+                target.put((reply_type, reply))
+
+    def _expire_requests(self):
+        now = time.monotonic()
+        with self._pending_lock:
+            expired = [request_id for request_id, (target, deadline, timeout_sec, call) in self._pending.items() if deadline < now]
+            expired = [(request_id, self._pending.pop(request_id)) for request_id in expired]
+        for request_id, (target, deadline, timeout_sec, call) in expired:
+            self.metrics.finish(call, error=True)
+            _set_error(target, 'Timed out waiting for reply from server (is it running?)')
+            if not isinstance(target, concurrent.futures.Future):
+                # streamed calls have no deadline on the server, so cancel them explicitly
+                self.socket.send_multipart([request_id, b'', _CANCEL_REQUEST])
+
+
+def _set_error(target, message):
+    """Fail a pending AsyncZMQClient call, whose replies go to either a
+    future or a stream queue."""
+    if isinstance(target, concurrent.futures.Future):
+        target.set_exception(RPCError(message))
+    else:
+        target.put(('error', message))
+
+def _decode_reply(reply_type, frames):
+    """Decode the payload frames of a reply of the given type."""
+    if reply_type.endswith('bindata'):
+        return _binary_reply(frames)
+    if reply_type.endswith('jsonarrays'):
+        return binary_arrays.loads(frames[0].buffer, [frame.buffer for frame in frames[1:]])
+    return json.loads(frames[0].bytes.decode('utf8'))
+
+
+def _binary_reply(frames):
+    """Return the buffer from a single-frame binary reply, or a list of buffers
+    if the server sent the data as several frames."""
+    if len(frames) == 1:
+        return frames[0].buffer
+    return [frame.buffer for frame in frames]
+
+def _set_heartbeat(socket, heartbeat_sec):
+    if heartbeat_sec is not None:
+        heartbeat_ms = heartbeat_sec * 1000
+        socket.HEARTBEAT_IVL = heartbeat_ms
+        socket.HEARTBEAT_TIMEOUT = heartbeat_ms * 2
+        socket.HEARTBEAT_TTL = heartbeat_ms * 2
 
 
 class _ProxyMethodClass:
@@ -251,11 +900,29 @@ class _ProxyMethodClass:
         self._rpc_function = rpc_function
         self._timeout_sec = None
         self._output_handler = lambda x: x # no-op handler
+        self._cache_info = None # for functions that the server declares cacheable, the cacheable() parameters
+        self._stream = False # True for generator functions, whose results are streamed, and handled item-by-item
 
     def _call_function(self, *args, **kws):
+        if self._rpc_client._batch is not None:
+            output_handler = self._output_handler
+            if self._stream:
+                # in a batch, the server returns the list of all the items
+                item_handler = output_handler
+                output_handler = lambda items: [item_handler(item) for item in items]
+            return self._rpc_client._add_to_batch(self._rpc_function, args, kws,
+                output_handler, self._timeout_sec)
         with self._rpc_client.timeout_sec(self._timeout_sec):
-            result = self._rpc_client(self._rpc_function, *args, **kws)
-        return self._output_handler(result)
+            if self._stream:
+                result = self._rpc_client.stream(self._rpc_function, *args, **kws)
+                result._output_handler = self._output_handler
+                return result
+            if self._cache_info is None:
+                result = self._rpc_client(self._rpc_function, *args, **kws)
+            else:
+                result = self._rpc_client._call_cacheable(self._rpc_function, args, kws,
+                    self._cache_info['max_age_sec'])
+        return self._rpc_client._handle_output(result, self._output_handler)
 
 
 def _rich_proxy_function(doc, argspec, name, rpc_client, rpc_function):
@@ -8,53 +8,278 @@ import zmq.utils.jsonapi
 import traceback
 import inspect
 import threading
-import os
-import signal
+import time
+import ctypes
 import contextlib
+import concurrent.futures
+import hashlib
 
 from zplib import datafile
 
+from . import binary_arrays
+from . import cacheable
+from . import cancellation
+from . import metrics
+from . import streaming
+from .reactor import Reactor
 from ..util import logging
 logger = logging.get_logger(__name__)
 
+# names of the options that may follow a request's arguments (see ZMQServerMixin)
+REQUEST_OPTIONS = ('timeout_sec', 'binary_arrays')
+
+class CommandLocks:
+    """Serialize commands that use the same resources (e.g. a hardware device),
+    while allowing commands that use different resources to run concurrently.
+
+    Each command belongs to one or more named lock groups, and holds the lock
+    for each of its groups while it runs. Groups are assigned by the longest
+    dotted prefix of the command name found in the 'lock_groups' dict, which
+    maps prefixes to a group name, a list of group names, or None (for commands
+    that need no lock). The empty string may be used as a prefix that matches
+    all commands. Commands not matched by any prefix belong to the group named
+    by the first component of the command name: i.e. by default, calls to
+    'stage.get_z' and 'camera.get_exposure_time' can run at the same time, but
+    two calls into 'camera' cannot.
+    """
+    def __init__(self, lock_groups=None):
+        self.lock_groups = {}
+        if lock_groups is not None:
+            for prefix, groups in lock_groups.items():
+                if groups is None:
+                    groups = ()
+                elif isinstance(groups, str):
+                    groups = (groups,)
+                self.lock_groups[prefix] = tuple(sorted(set(groups)))
+        self._command_groups = {} # cache of groups_for() results
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+
+    def groups_for(self, command):
+        """Return the sorted tuple of lock groups for the named command."""
+        try:
+            return self._command_groups[command]
+        except KeyError:
+            pass
+        parts = command.split('.')
+        for i in range(len(parts), -1, -1):
+            prefix = '.'.join(parts[:i])
+            if prefix in self.lock_groups:
+                groups = self.lock_groups[prefix]
+                break
+        else:
+            groups = (parts[0],)
+        self._command_groups[command] = groups
+        return groups
+
+    @contextlib.contextmanager
+    def locked(self, *commands):
+        """Context manager to hold the locks required by all of the named commands."""
+        groups = set()
+        for command in commands:
+            groups.update(self.groups_for(command))
+        with contextlib.ExitStack() as stack:
+            # always acquire in sorted order, so that commands sharing several groups can't deadlock
+            for group in sorted(groups):
+                stack.enter_context(self._get_lock(group))
+            yield
+
+    def _get_lock(self, group):
+        with self._locks_lock:
+            if group not in self._locks:
+                self._locks[group] = threading.Lock()
+            return self._locks[group]
+
+
+def _dispatch_entry(py_command):
+    try:
+        signature = inspect.signature(py_command)
+    except (TypeError, ValueError):
+        signature = None # can't check arguments of some builtins, or non-callables
+    return py_command, signature
+
+
 class BaseRPCServer:
     """Dispatch remote calls to callables specified in a potentially-nested namespace.
+
+    Calls are run by a pool of worker threads, so that a slow command does not
+    hold up others. Commands that use the same resources are serialized by
+    per-group locks: see CommandLocks for how the 'lock_groups' parameter
+    assigns commands to groups.
+
+    Clients may send a timeout with each request. The call is then run with a
+    corresponding deadline: it is dropped if the deadline passes before it can
+    be started (e.g. while waiting for a lock), and long operations can stop
+    early once the deadline has passed, by calling cancellation.check().
+    Clients may also cancel a call that is queued or running (see cancel()),
+    after which cancellation.check() likewise stops it: this is how a client
+    abandons a streamed call.
+
+    Clients may likewise say that they accept numeric arrays in replies as
+    binary data (see binary_arrays). Replies to clients that do not are sent
+    as plain JSON, with any numpy arrays converted to lists.
+
+    The count, latency, payload sizes and errors of the calls to each command
+    are recorded in the 'metrics' attribute (see metrics.CommandMetrics).
     """
-    def __init__(self, namespace):
+    def __init__(self, namespace, max_workers=8, lock_groups=None):
         self.namespace = namespace
-
-    def run(self):
-        """Run the RPC server. To quit the server from another thread,
-        set the 'running' attribute to False."""
-        self.running = True
-        while True:
-            command, args, kwargs = self._receive()
-            logger.debug("Received command: {}\n    args: {}\n    kwargs: {}", command, args, kwargs)
-            self.call(command, args, kwargs)
-
-    def call(self, command, args, kwargs):
-        """Call the named command with *args and **kwargs"""
-        py_command = self.lookup(command)
+        self.max_workers = max_workers
+        self.command_locks = CommandLocks(lock_groups)
+        self._dispatch_table = {}
+        self._cancel_events = {} # maps call ids of queued and running calls to their cancel events
+        self._cancel_events_lock = threading.Lock()
+        self.metrics = metrics.CommandMetrics()
+        self._worker_calls = threading.local() # options of the call each worker thread is running
+        self._workers = concurrent.futures.ThreadPoolExecutor(max_workers, thread_name_prefix='RPCWorker')
+
+    def dispatch(self, client, command, args, kwargs, deadline=None, request_bytes=0, binary_arrays=False):
+        """Run a call received from a client in a worker thread, and reply to
+        the client when it is done. 'client' is whatever _reply() needs to
+        address the reply, 'deadline' is the time.monotonic() time after
+        which the client will no longer be waiting for the result, or None,
+        'request_bytes' is the size of the request, for the metrics, and
+        'binary_arrays' is whether the client accepts numeric arrays in the
+        reply as binary data."""
+        logger.debug("Received command: {}\n    args: {}\n    kwargs: {}", command, args, kwargs)
+        cancel_event = threading.Event()
+        with self._cancel_events_lock:
+            self._cancel_events[self.call_id(client)] = cancel_event
+        self._workers.submit(self._call_in_worker, client, command, args, kwargs, deadline, cancel_event, request_bytes, binary_arrays)
+
+    def cancel(self, client):
+        """Cancel the queued or running call that will reply to 'client', if
+        any: cancellation.check() then raises cancellation.Cancelled in that
+        call, and a streamed call is stopped before its next item."""
+        with self._cancel_events_lock:
+            cancel_event = self._cancel_events.get(self.call_id(client))
+        if cancel_event is not None:
+            logger.debug('Cancelling call for client {}', self.client_name(client))
+            cancel_event.set()
+
+    def call_id(self, client):
+        """Return a hashable value that identifies a call by the 'client' its
+        reply is addressed to."""
+        return client
+
+    def shutdown_workers(self):
+        """Wait for commands that are still running to finish, and stop the
+        worker threads."""
+        self._workers.shutdown()
+
+    def _call_in_worker(self, client, command, args, kwargs, deadline, cancel_event, request_bytes, binary_arrays):
+        metrics_name = self.metrics_name(command, args)
+        self._worker_calls.binary_arrays = binary_arrays # replies to the call are sent from this thread
+        try:
+            with self.metrics.measure(metrics_name, request_bytes), cancellation.deadline(deadline), cancellation.cancel_event(cancel_event):
+                if cancellation.expired():
+                    # the client stopped waiting while the call was queued
+                    logger.info('Dropping command {}: deadline passed before it could be run', command)
+                    self._reply(client, 'Deadline passed before command {} could be run.'.format(command), error=True)
+                    return
+                self.call(client, command, args, kwargs)
+        except BaseException:
+            # exceptions in a worker would otherwise vanish silently into its future
+            logger.log_exception('Error while handling command {}:'.format(command))
+        finally:
+            call_id = self.call_id(client)
+            with self._cancel_events_lock:
+                if self._cancel_events.get(call_id) is cancel_event:
+                    del self._cancel_events[call_id]
+
+    def metrics_name(self, command, args):
+        """Return the name under which a call is recorded in the metrics."""
+        return command
+
+    def call(self, client, command, args, kwargs, stream=False):
+        """Call the named command with *args and **kwargs, and reply to the client
+        with the result.
+
+        If the command returns a generator, it is run to completion while the
+        command's locks are held. If 'stream' is True, each item is sent to the
+        client as a partial reply as soon as it is produced, and the final
+        reply is the generator's return value; otherwise the final reply is the
+        list of all the items."""
+        py_command = self._lookup_checked(client, command, args, kwargs)
         if py_command is None:
-            self._reply('No such command: {}'.format(command), error=True)
-            logger.info('Received unknown command: {}', command)
             return
         try:
-            response = self.run_command(py_command, args, kwargs)
-
+            with self.command_locks.locked(command):
+                cancellation.check() # don't start if the deadline passed while waiting for the locks
+                response = self.run_command(client, py_command, args, kwargs)
+                if inspect.isgenerator(response):
+                    response = self.run_generator(client, response, stream)
         except (Exception, KeyboardInterrupt) as e:
             exception_str = ''.join(traceback.format_exception(type(e), e, e.__traceback__))
             logger.debug('Exception caught: {}', exception_str)
-            self._reply(exception_str, error=True)
+            self._reply(client, exception_str, error=True)
         else:
             logger.debug('Sending response: {}', response)
-            self._reply(response)
+            self._reply(client, response)
 
-    def run_command(self, py_command, args, kwargs):
+    def run_command(self, client, py_command, args, kwargs):
         return py_command(*args, **kwargs)
 
+    def run_generator(self, client, generator, stream=False):
+        """Run a generator returned by a command to completion. Each step is
+        run with run_command(), so that it is treated just as the command
+        itself would be (e.g. it can be interrupted).
+
+        If 'stream' is True, send each item to the client as a partial reply
+        and return the generator's return value, otherwise return the list
+        of items. If the call's deadline passes or it is cancelled, the
+        generator is closed before the next item."""
+        items = []
+        try:
+            while True:
+                cancellation.check() # stop between items once the client has gone or cancelled the call
+                done, value = self.run_command(client, streaming.next_item, [generator], {})
+                if done:
+                    return value if stream else items
+                if stream:
+                    self._reply(client, value, partial=True)
+                else:
+                    items.append(value)
+        finally:
+            # if the client can't be sent an item, make sure the generator cleans up
+            generator.close()
+
+    def _lookup_checked(self, client, command, args, kwargs):
+        """Look up a command and check that it can accept the given arguments.
+        If not, reply to the client with an error and return None."""
+        entry = self.lookup_command(command)
+        if entry is None:
+            self._reply(client, 'No such command: {}'.format(command), error=True)
+            logger.info('Received unknown command: {}', command)
+            return None
+        py_command, signature = entry
+        if signature is not None:
+            try:
+                signature.bind(*args, **kwargs)
+            except TypeError as e:
+                self._reply(client, 'Invalid arguments for command {}: {}'.format(command, e), error=True)
+                logger.info('Received invalid arguments for command {}: {}', command, e)
+                return None
+        return py_command
+
     def lookup(self, name):
         """Look up a name in the namespace, allowing for multiple levels e.g. foo.bar.baz"""
+        entry = self.lookup_command(name)
+        return None if entry is None else entry[0]
+
+    def lookup_command(self, name):
+        """Return (callable, signature) for a command name, or None if the name
+        is not found. The signature (an inspect.Signature, or None if one
+        can't be determined) is used to reject malformed calls before they
+        are dispatched.
+
+        Results are stored in a dispatch table, so that each name only needs
+        to be resolved once. If the namespace is altered, call
+        invalidate_dispatch_table() to clear any stale entries."""
+        try:
+            return self._dispatch_table[name]
+        except KeyError:
+            pass
         # could just eval, but since command is coming from the network, that's a bad idea.
         v = self.namespace
         for k in name.split('.'):
@@ -62,87 +287,292 @@ class BaseRPCServer:
                 v = getattr(v, k)
             except AttributeError:
                 return None
-        return v
-
-    def _reply(self, reply, error=False):
-        """Reply to clients with either a valid response or an error string."""
-        raise NotImplementedError()
-
-    def _receive(self):
-        """Wait until an RPC call is received from the client, then return the call
-        as (command_name, args, kwargs). If self.running goes to False while waiting,
-        raise an error."""
+        entry = self._dispatch_table[name] = _dispatch_entry(v)
+        return entry
+
+    def invalidate_dispatch_table(self):
+        """Clear the table of resolved command names. Must be called if the
+        namespace is altered after commands have been called."""
+        self._dispatch_table = {}
+
+    def client_name(self, client):
+        """Return a string identifying the client that sent a command, or None
+        if clients cannot be distinguished."""
+        return None
+
+    def _reply(self, client, reply, error=False, partial=False, internal=False):
+        """Reply to a client with either a valid response or an error string.
+        May be called from any worker thread.
+
+        If 'partial' is True, the reply is one item of a streamed result, which
+        will be followed by further replies to the same request. If a partial
+        reply cannot be encoded, an exception is raised, so that the caller can
+        end the stream with an error.
+
+        If 'internal' is True, the reply is to one of the server's special
+        commands (e.g. '__DESCRIBE__'), and is sent without checking it for
+        numeric arrays to send as binary data."""
         raise NotImplementedError()
 
 class ZMQServerMixin:
-    def __init__(self, address, context=None):
-        """Mixin for RPC servers that uses ZeroMQ REQ/REP to communicate with clients.
+    def __init__(self, address, context=None, reactor=None, priority=0):
+        """Mixin for RPC servers that uses a ZeroMQ ROUTER socket to communicate
+        with clients (which may use REQ sockets, or DEALER sockets that provide
+        a REQ-style envelope).
+
+        Requests are received, and dispatched to worker threads, by a
+        reactor.Reactor. If no reactor is given, the server has its own, which
+        is run by run(). Otherwise, the server's sockets are handled by the given
+        reactor, which may be shared with other servers, and run() is not used.
+
+        As ZeroMQ sockets are not thread-safe, worker threads do not reply on
+        the ROUTER socket directly, but send replies via per-thread inproc
+        sockets to the reactor thread, which forwards them on.
+
+        A '__CANCEL__' request cancels the call with the same envelope (i.e.
+        from the same client, with the same request id), if it is queued or
+        running (see BaseRPCServer.cancel()); no reply is sent. A call is also
+        cancelled if a reply to it cannot be delivered because its client has
+        disconnected.
+
+        A request may carry a dict of options after its arguments: currently
+        'timeout_sec', the time after which the client stops waiting for the
+        reply, and 'binary_arrays', which if True says that the client can
+        decode 'jsonarrays' replies (see _reply()). Servers from before options were added can't decode such
+        requests, so clients first send an '__OPTIONS__' request, to which the
+        reply is the list of option names the server accepts (see
+        REQUEST_OPTIONS); older servers reply with an error instead.
+
         Parameters:
             address: a string ZeroMQ port identifier, like 'tcp://127.0.0.1:5555'.
             context: a ZeroMQ context to share, if one already exists.
+            reactor: a Reactor to share, if any.
+            priority: priority of this server's sockets in the reactor, relative
+                to those of other servers sharing it (see Reactor.register()).
         """
         self.context = context if context is not None else zmq.Context()
-        self.socket = self.context.socket(zmq.REP)
-        self.socket.RCVTIMEO = 0
+        self.socket = self.context.socket(zmq.ROUTER)
+        self.socket.ROUTER_MANDATORY = 1 # report replies to clients that have gone, rather than silently dropping them
         self.socket.bind(address)
+        self._reply_address = 'inproc://rpc-replies-{}'.format(id(self))
+        self._reply_collector = self.context.socket(zmq.PULL)
+        self._reply_collector.bind(self._reply_address)
+        self._thread_reply_sockets = threading.local()
+        self._reply_sockets = []
+        self._reply_sockets_lock = threading.Lock()
+        self._own_reactor = reactor is None
+        self.reactor = Reactor() if reactor is None else reactor
+        self.reactor.register(self.socket, self._receive_requests, priority)
+        self.reactor.register(self._reply_collector, self._forward_replies, priority)
 
     def run(self):
+        """Run the server's own reactor in the calling thread, until stop() is
+        called from another thread. Commands still running when the server
+        stops will be allowed to finish."""
         try:
-            super().run()
+            self.reactor.run()
         finally:
-            self.socket.close()
-
-    def _receive(self):
-        while not self.socket.poll(500):
-            # every 500 ms, check if still running while we wait for data
-            if not self.running:
-                raise RuntimeError()
-        json = self.socket.recv()
-        try:
-            command, args, kwargs = zmq.utils.jsonapi.loads(json)
-            return command, args, kwargs
-        except Exception as e:
-            self._reply('Could not unpack command, arguments, and keyword arguments from JSON message: {}'.format(e), error=True)
+            self.close()
 
-    def _reply(self, reply, error=False):
+    def stop(self):
+        """Stop the server. A server with its own reactor stops the reactor, and
+        cleans up once run() returns. A server using a shared reactor should be
+        stopped only once the shared reactor has stopped."""
+        if self._own_reactor:
+            self.reactor.stop()
+        else:
+            self.close()
+
+    def close(self):
+        self.shutdown_workers()
+        # all worker threads are done by now, so their sockets can be closed from here
+        for reply_socket in self._reply_sockets:
+            reply_socket.close()
+        self._reply_collector.close()
+        self.socket.close()
+        if self._own_reactor:
+            self.reactor.close()
+
+    def client_name(self, client):
+        return client[0].hex() # the ROUTER identity frame
+
+    def call_id(self, client):
+        return tuple(client) # the whole envelope, including any request id
+
+    def log_metrics_every(self, interval_sec, name='RPC server'):
+        """Log a summary of the commands that took the most time, every
+        'interval_sec' seconds (if any commands were called in that time).
+        Must be called before the reactor is started."""
+        next_time = time.monotonic() + interval_sec
+        previous_stats = None
+        def log_metrics():
+            nonlocal next_time, previous_stats
+            now = time.monotonic()
+            if now >= next_time:
+                next_time = now + interval_sec
+                summary, previous_stats = self.metrics.summary(previous_stats)
+                if summary is not None:
+                    logger.info('{} metrics for the last {} s: {}', name, interval_sec, summary)
+            return next_time - now
+        self.reactor.add_timer(log_metrics)
+
+    def _receive_requests(self):
+        while True:
+            try:
+                frames = self.socket.recv_multipart(flags=zmq.NOBLOCK)
+            except zmq.Again:
+                return
+            try:
+                # the envelope is the identity (and any request id) up to an empty delimiter frame
+                delimiter = frames.index(b'')
+            except ValueError:
+                logger.warning('Discarding RPC message with no envelope delimiter')
+                continue
+            client, message = frames[:delimiter+1], frames[delimiter+1:]
+            try:
+                # an optional options dict may follow the arguments
+                command, args, kwargs, *options = zmq.utils.jsonapi.loads(message[0])
+                options = options[0] if options else {}
+                deadline = None
+                if options.get('timeout_sec') is not None:
+                    deadline = time.monotonic() + options['timeout_sec']
+                send_arrays = bool(options.get('binary_arrays'))
+            except Exception as e:
+                self._reply(client, 'Could not unpack command, arguments, and keyword arguments from JSON message: {}'.format(e), error=True)
+                continue
+            if command == '__CANCEL__':
+                # handled here rather than by a worker, which might be busy running the very call to cancel
+                self.cancel(client)
+                continue
+            if command == '__OPTIONS__':
+                # handled here, where the options are decoded, so that every kind of server answers it
+                self._reply(client, list(REQUEST_OPTIONS), internal=True)
+                continue
+            self.dispatch(client, command, args, kwargs, deadline, len(message[0]), send_arrays)
+
+    def _forward_replies(self):
+        while True:
+            try:
+                frames = self._reply_collector.recv_multipart(flags=zmq.NOBLOCK, copy=False)
+            except zmq.Again:
+                return
+            try:
+                self.socket.send_multipart(frames, flags=zmq.NOBLOCK, copy=False)
+            except zmq.ZMQError as e:
+                client = []
+                for frame in frames:
+                    client.append(frame.bytes)
+                    if not frame.bytes:
+                        break
+                if e.errno == zmq.EHOSTUNREACH:
+                    # the client has gone, so stop any call still producing replies for it
+                    logger.debug('Client {} is no longer connected: cancelling its call', self.client_name(client))
+                    self.cancel(client)
+                else:
+                    logger.warning('Could not send reply to client {}: {}', self.client_name(client), e)
+
+    def _get_reply_socket(self):
+        try:
+            return self._thread_reply_sockets.socket
+        except AttributeError:
+            reply_socket = self.context.socket(zmq.PUSH)
+            reply_socket.connect(self._reply_address)
+            self._thread_reply_sockets.socket = reply_socket
+            with self._reply_sockets_lock:
+                self._reply_sockets.append(reply_socket)
+            return reply_socket
+
+    def _reply(self, client, reply, error=False, partial=False, internal=False):
+        # Binary data may be a single buffer, or a list of buffers to send as
+        # separate frames. Either way, buffers are sent without copying, so
+        # they must not be modified after being returned from a command.
+        # Partial replies to a streamed call have the reply type prefixed
+        # with 'partial_' (e.g. 'partial_json'); the stream ends with an
+        # ordinary reply, or an error.
+        # Numeric arrays within JSON replies are sent as extra binary frames
+        # following the JSON, with reply type 'jsonarrays' (see binary_arrays),
+        # to clients that have asked for them with the 'binary_arrays' option.
+        # Other clients (e.g. from before the option was added) can't decode
+        # such replies, so any numpy arrays are sent to them as JSON lists.
+        arrays = []
         if error:
             reply_type = 'error'
-        elif isinstance(reply, (bytearray, bytes, memoryview)):
+        elif _is_binary(reply):
             reply_type = 'bindata'
-        else:
+        elif internal:
+            reply_type = 'json'
+        elif not getattr(self._worker_calls, 'binary_arrays', False):
             reply_type = 'json'
+            reply = binary_arrays.arrays_to_lists(reply)
+        else:
+            reply, arrays = binary_arrays.extract_arrays(reply)
+            reply_type = 'jsonarrays' if arrays else 'json'
 
-        if reply_type == 'error' or reply_type == 'json':
+        if reply_type != 'bindata':
             try:
                 reply = datafile.json_encode_compact_to_bytes(reply)
             except TypeError:
+                if partial:
+                    raise
                 reply_type = 'error'
                 reply = datafile.json_encode_compact_to_bytes('Could not JSON-serialize return value.')
-        self.socket.send_string(reply_type, flags=zmq.SNDMORE)
-        self.socket.send(reply) # TODO: profile to see if copy=False improves performance
+                arrays = []
+        if not isinstance(reply, list):
+            reply = [reply]
+        if partial:
+            reply_type = 'partial_' + reply_type
+        self.metrics.add_reply(sum(_nbytes(part) for part in reply) + sum(array.nbytes for array in arrays), error=reply_type == 'error')
+        self._get_reply_socket().send_multipart(client + [reply_type.encode('ascii')] + reply + arrays, copy=False)
+
+def _call_spec_problem(call):
+    """Return a description of what is wrong with a (command, args, kwargs)
+    triple received from a client, or None if it is well-formed."""
+    if not isinstance(call, (list, tuple)) or len(call) != 3:
+        return 'expected a (command, args, kwargs) triple, not {!r}'.format(call)
+    command, args, kwargs = call
+    if not isinstance(command, str):
+        return 'command name must be a string, not {!r}'.format(command)
+    if not isinstance(args, (list, tuple)):
+        return 'arguments for {} must be a list, not {!r}'.format(command, args)
+    if not isinstance(kwargs, dict):
+        return 'keyword arguments for {} must be a dict, not {!r}'.format(command, kwargs)
+    return None
+
+def _nbytes(buffer):
+    return buffer.nbytes if isinstance(buffer, memoryview) else len(buffer)
+
+def _is_binary(reply):
+    binary_types = (bytearray, bytes, memoryview)
+    if isinstance(reply, list):
+        return len(reply) > 0 and all(isinstance(part, binary_types) for part in reply)
+    return isinstance(reply, binary_types)
 
 
 class BaseZMQServer(ZMQServerMixin, BaseRPCServer):
-    def __init__(self, namespace, port, context=None):
-        """BaseRPCServer subclass that uses ZeroMQ REQ/REP to communicate with clients.
+    def __init__(self, namespace, port, context=None, max_workers=8, lock_groups=None, reactor=None, priority=0):
+        """BaseRPCServer subclass that uses ZeroMQ ROUTER to communicate with clients.
         Parameters:
             namespace: contains a hierarchy of callable objects to expose to clients.
             port: a string ZeroMQ port identifier, like 'tcp://127.0.0.1:5555'.
             context: a ZeroMQ context to share, if one already exists.
+            max_workers: number of worker threads for running commands.
+            lock_groups: dict mapping command prefixes to lock groups (see CommandLocks).
+            reactor, priority: a Reactor to share, and the server's priority
+                within it (see ZMQServerMixin).
         """
-        BaseRPCServer.__init__(self, namespace)
-        ZMQServerMixin.__init__(self, port, context)
+        BaseRPCServer.__init__(self, namespace, max_workers, lock_groups)
+        ZMQServerMixin.__init__(self, port, context, reactor, priority)
 
 
 class BackgroundBaseZMQServer(BaseZMQServer, threading.Thread):
-    """ZMQ server that runs in a background thread."""
-    def __init__(self, namespace, port, context=None):
-        BaseZMQServer.__init__(self, namespace, port, context)
+    """ZMQ server that runs its own reactor in a background thread."""
+    def __init__(self, namespace, port, context=None, max_workers=8, lock_groups=None):
+        BaseZMQServer.__init__(self, namespace, port, context, max_workers, lock_groups)
         threading.Thread.__init__(self, name='background RPC server', daemon=True)
         self.start()
 
     def stop(self):
-        self.running = False
+        super().stop()
         self.join()
 
 
@@ -158,6 +588,23 @@ class RPCServer(BaseRPCServer):
     The 'interrupter' parameter must be an instance of Interrupter, which can be used
     to simulate control-c interrupts during RPC calls.
 
+    Calls are run concurrently by a pool of worker threads, with per-group locks
+    to serialize calls that share resources; see BaseRPCServer and CommandLocks.
+
+    The special '__BATCH__' command takes a list of (command_name, args, kwargs)
+    triples, runs them in order while holding the locks for all of them, and
+    returns the list of results. If any command fails, the remaining commands are
+    not run and an error is returned.
+
+    Commands that are generator functions can produce their results
+    incrementally. The special '__STREAM__' command takes a (command_name, args,
+    kwargs) triple, and sends each item the generator yields to the client as
+    soon as it is produced, followed by the generator's return value (see
+    BaseRPCServer.call() and the 'streaming' module). Called in any other way,
+    a generator function returns the list of its items. A client that stops
+    reading a stream cancels the call, which closes the generator before its
+    next item (see the '__CANCEL__' request in ZMQServerMixin).
+
     Introspection can be used to provide clients a description of available commands.
     The special '__DESCRIBE__' command returns a list of command descriptions,
     which are triples of (command_name, command_doc, arg_info):
@@ -170,26 +617,140 @@ class RPCServer(BaseRPCServer):
             varkw: name of the variable-keyword parameter (usually '**kwarg', but without the asterisks)
             kwonlyargs: list of keyword-only arguments
             kwonlydefaults: dict mapping keyword-only argument names to default values (if any)
+            cache: present only for functions declared with cacheable.cacheable(): the
+                dict of its parameters
+            stream: present (and True) only for generator functions, which clients
+                should call with '__STREAM__'
+    The descriptions are computed once and then cached, so if the namespace
+    changes, invalidate_descriptions() must be called. The special
+    '__DESCRIBE_HASH__' command returns a hash of the descriptions, which
+    clients can use to check whether a saved copy of the descriptions is current.
+
+    The special '__STATS__' command returns the server's per-command call
+    statistics (see stats()).
     """
-    def __init__(self, namespace, interrupter):
-        super().__init__(namespace)
+    def __init__(self, namespace, interrupter, max_workers=8, lock_groups=None):
+        super().__init__(namespace, max_workers, lock_groups)
         self.interrupter = interrupter
-
-    def call(self, command, args, kwargs):
+        self._descriptions = None
+        self._descriptions_lock = threading.Lock()
+
+    def describe(self):
+        """Return (descriptions, description_hash) for the namespace, computing
+        them if they are not cached."""
+        with self._descriptions_lock:
+            if self._descriptions is None:
+                descriptions = []
+                commands = {}
+                self.gather_descriptions(descriptions, self.namespace, commands=commands)
+                # fill in the dispatch table with everything described
+                dispatch_table = dict(self._dispatch_table)
+                dispatch_table.update((name, _dispatch_entry(py_command)) for name, py_command in commands.items())
+                self._dispatch_table = dispatch_table
+                try:
+                    encoded = datafile.json_encode_compact_to_bytes(descriptions)
+                except TypeError:
+                    # can't be sent to clients anyway, but still needs a hash
+                    encoded = repr(descriptions).encode()
+                self._descriptions = descriptions, hashlib.sha1(encoded).hexdigest()
+            return self._descriptions
+
+    def invalidate_descriptions(self):
+        """Discard the cached namespace descriptions and dispatch table, which
+        must be done if the namespace is altered after descriptions have been
+        requested or commands called."""
+        with self._descriptions_lock:
+            self._descriptions = None
+            self.invalidate_dispatch_table()
+
+    def stats(self):
+        """Return a dict containing the time the server started recording
+        metrics ('start_time', as a time.time() value) and the statistics for
+        each command called since then ('commands': see
+        metrics.CommandMetrics.stats()). Streamed calls are recorded under the
+        name of the streamed command."""
+        return dict(start_time=self.metrics.start_time, commands=self.metrics.stats())
+
+    def metrics_name(self, command, args):
+        if command == '__STREAM__' and args and isinstance(args[0], str):
+            return args[0]
+        return command
+
+    def call(self, client, command, args, kwargs):
         """Dispatch a command or deal with special keyword commands.
-        Currently, only __DESCRIBE__ is supported.
+        Currently, __DESCRIBE__, __DESCRIBE_HASH__, __BATCH__, __STREAM__ and
+        __STATS__ are supported.
         """
         if command == '__DESCRIBE__':
-            descriptions = []
-            self.gather_descriptions(descriptions, self.namespace)
-            self._reply(descriptions)
+            descriptions, description_hash = self.describe()
+            self._reply(client, descriptions, internal=True)
+        elif command == '__DESCRIBE_HASH__':
+            descriptions, description_hash = self.describe()
+            self._reply(client, description_hash, internal=True)
+        elif command == '__BATCH__':
+            if len(args) != 1 or kwargs:
+                self._reply(client, 'Invalid arguments for __BATCH__: expected a list of (command, args, kwargs) triples.', error=True)
+                logger.info('Received invalid arguments for __BATCH__')
+            else:
+                self.call_batch(client, args[0])
+        elif command == '__STREAM__':
+            problem = _call_spec_problem(args) if not kwargs else 'unexpected keyword arguments'
+            if problem is not None:
+                self._reply(client, 'Invalid arguments for __STREAM__: {}'.format(problem), error=True)
+                logger.info('Received invalid arguments for __STREAM__: {}', problem)
+            else:
+                command, args, kwargs = args
+                super().call(client, command, args, kwargs, stream=True)
+        elif command == '__STATS__':
+            self._reply(client, self.stats(), internal=True)
         else:
-            super().call(command, args, kwargs)
+            super().call(client, command, args, kwargs)
+
+    def call_batch(self, client, calls):
+        """Call each of a list of (command, args, kwargs) in order, and reply
+        to the client with the list of results."""
+        if not isinstance(calls, (list, tuple)):
+            self._reply(client, 'Invalid arguments for __BATCH__: expected a list of (command, args, kwargs) triples.', error=True)
+            logger.info('Received invalid arguments for __BATCH__')
+            return
+        for i, call in enumerate(calls):
+            problem = _call_spec_problem(call)
+            if problem is not None:
+                self._reply(client, 'Invalid batched command {}: {}'.format(i, problem), error=True)
+                logger.info('Received invalid batched command {}: {}', i, problem)
+                return
+        py_commands = []
+        for command, args, kwargs in calls:
+            # check all the commands before running any of them
+            py_command = self._lookup_checked(client, command, args, kwargs)
+            if py_command is None:
+                return
+            py_commands.append(py_command)
+        responses = []
+        with self.command_locks.locked(*[command for command, args, kwargs in calls]):
+            if cancellation.expired():
+                self._reply(client, 'Deadline passed before batch could be run.', error=True)
+                return
+            for i, (py_command, (command, args, kwargs)) in enumerate(zip(py_commands, calls)):
+                try:
+                    response = self.run_command(client, py_command, args, kwargs)
+                    if inspect.isgenerator(response):
+                        response = self.run_generator(client, response)
+                    responses.append(response)
+                except (Exception, KeyboardInterrupt) as e:
+                    exception_str = ''.join(traceback.format_exception(type(e), e, e.__traceback__))
+                    logger.debug('Exception caught in batch: {}', exception_str)
+                    self._reply(client, 'Batched command {} ({}) failed; later commands were not run.\n{}'.format(
+                        i, command, exception_str), error=True)
+                    return
+        logger.debug('Sending batch response: {}', responses)
+        self._reply(client, responses)
 
     @staticmethod
-    def gather_descriptions(descriptions, namespace, prefix=''):
+    def gather_descriptions(descriptions, namespace, prefix='', commands=None):
         """Recurse through a namespace, adding descriptions of callable objects encountered
-        to the 'descriptions' list."""
+        to the 'descriptions' list. If a 'commands' dict is provided, the callables
+        themselves are added to it, keyed by their fully-qualified names."""
         for k in dir(namespace):
             if k.startswith('_'):
                 continue
@@ -219,85 +780,133 @@ class RPCServer(BaseRPCServer):
                 argdict['varkw'] = argspec.varkw
                 argdict['kwonlyargs'] = argspec.kwonlyargs
                 argdict['kwonlydefaults'] = argspec.kwonlydefaults if argspec.kwonlydefaults else {}
+                cache_info = cacheable.get_cache_info(v)
+                if cache_info is not None:
+                    argdict['cache'] = cache_info
+                if inspect.isgeneratorfunction(v):
+                    argdict['stream'] = True
                 descriptions.append((prefixed_name, doc, argdict))
+                if commands is not None:
+                    commands[prefixed_name] = v
             else:
                 try:
                     subnamespace = v
                 except AttributeError:
                     continue
-                RPCServer.gather_descriptions(descriptions, subnamespace, prefixed_name)
+                RPCServer.gather_descriptions(descriptions, subnamespace, prefixed_name, commands)
 
-    def run_command(self, py_command, args, kwargs):
-            with self.interrupter.armed():
+    def run_command(self, client, py_command, args, kwargs):
+            with self.interrupter.armed(self.client_name(client)):
                 return py_command(*args, **kwargs)
 
 
 class ZMQServer(ZMQServerMixin, RPCServer):
-    def __init__(self, namespace, interrupter, address, context=None):
-        """RPCServer subclass that uses ZeroMQ REQ/REP to communicate with clients.
+    def __init__(self, namespace, interrupter, address, context=None, max_workers=8, lock_groups=None, reactor=None, priority=0):
+        """RPCServer subclass that uses ZeroMQ ROUTER to communicate with clients.
         Parameters:
             namespace: contains a hierarchy of callable objects to expose to clients.
             interrupter: Interrupter instance for simulating control-c on server
             address: a string ZeroMQ port identifier, like 'tcp://127.0.0.1:5555'.
             context: a ZeroMQ context to share, if one already exists.
+            max_workers: number of worker threads for running commands.
+            lock_groups: dict mapping command prefixes to lock groups (see CommandLocks).
+            reactor, priority: a Reactor to share, and the server's priority
+                within it (see ZMQServerMixin).
         """
-        RPCServer.__init__(self, namespace, interrupter)
-        ZMQServerMixin.__init__(self, address, context)
+        RPCServer.__init__(self, namespace, interrupter, max_workers, lock_groups)
+        ZMQServerMixin.__init__(self, address, context, reactor, priority)
+
+class Interrupter:
+    """Interrupter raises KeyboardInterrupt exceptions in RPC worker threads
+    when requested to do so.
+
+    An 'interrupt' message interrupts all armed threads; 'interrupt <client name>'
+    interrupts only those threads running commands for the named client.
+    The exception is raised asynchronously, so it takes effect when the thread
+    next runs python code: a thread blocked in a long call into C (e.g. a
+    serial-port read) is interrupted as soon as that call returns.
 
-class Interrupter(threading.Thread):
-    """Interrupter runs in a background thread and creates KeyboardInterrupt
-    events in the main thread when requested to do so."""
+    Subclasses receive messages and pass them to handle_message()."""
     def __init__(self):
-        super().__init__(name='InterruptServer', daemon=True)
-        self._armed = False
-        self.start()
+        self._armed = {} # maps thread ids to client names
+        self._armed_lock = threading.Lock()
 
     @contextlib.contextmanager
-    def armed(self):
-        self._armed = True
+    def armed(self, client_name=None):
+        thread_id = threading.get_ident()
+        with self._armed_lock:
+            self._armed[thread_id] = client_name
         try:
             yield
         finally:
-            self._armed = False
-
-    def run(self):
-        self.running = True
+            self._disarm(thread_id)
+
+    def _disarm(self, thread_id):
+        # An interrupt can arrive at any point until the thread is disarmed,
+        # including while it is waiting for the lock here, so keep trying until
+        # done. Once disarmed, cancel any interrupt that is still pending, which
+        # would otherwise go off later, outside of the command (e.g. while its
+        # reply is being sent, or in the worker pool's own code).
         while True:
-            message = self._receive()
-            logger.debug('Interrupt received: {}, armed={}', message, self._armed)
-            if message == 'interrupt' and self._armed:
-                os.kill(os.getpid(), signal.SIGINT)
+            try:
+                with self._armed_lock:
+                    self._armed.pop(thread_id, None)
+                    ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_ulong(thread_id), None)
+                return
+            except KeyboardInterrupt:
+                pass
+
+    def handle_message(self, message):
+        logger.debug('Interrupt received: {}, armed={}', message, self._armed)
+        command, _, client_name = message.partition(' ')
+        if command == 'interrupt':
+            self.interrupt(client_name or None)
+
+    def interrupt(self, client_name=None):
+        """Raise KeyboardInterrupt in threads running commands for the named
+        client, or in all armed threads if client_name is None."""
+        with self._armed_lock:
+            for thread_id, armed_client in self._armed.items():
+                if client_name is None or armed_client == client_name:
+                    ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_ulong(thread_id),
+                        ctypes.py_object(KeyboardInterrupt))
 
     def stop(self):
-        self.running = False
-        self.join()
-
-    def _receive(self):
-        raise NotImplementedError()
+        pass
 
 class ZMQInterrupter(Interrupter):
-    def __init__(self, address, context=None):
-        """InterruptServer subclass that uses ZeroMQ PUSH/PULL to communicate with clients.
+    def __init__(self, address, context=None, reactor=None, priority=0):
+        """Interrupter subclass that uses ZeroMQ PUSH/PULL to communicate with clients.
         Parameters:
             address: a string ZeroMQ port identifier, like 'tcp://127.0.0.1:5555'.
             context: a ZeroMQ context to share, if one already exists.
+            reactor: a Reactor to share, if any. Otherwise, the interrupter
+                runs its own reactor in a background thread.
+            priority: priority of the interrupt socket within the reactor.
         """
+        super().__init__()
         self.context = context if context is not None else zmq.Context()
         self.socket = self.context.socket(zmq.PULL)
-        self.socket.RCVTIMEO = 0
         self.socket.bind(address)
-        super().__init__()
-
-    def run(self):
-        try:
-            super().run()
-        finally:
-            self.socket.close()
-
-    def _receive(self):
-        while not self.socket.poll(500):
-            # every 500 ms, check if still running while we wait for data
-            if not self.running:
-                raise RuntimeError()
-        return str(self.socket.recv(), encoding='ascii')
+        self._own_reactor = reactor is None
+        self.reactor = Reactor() if reactor is None else reactor
+        self.reactor.register(self.socket, self._receive_messages, priority)
+        if self._own_reactor:
+            self._thread = self.reactor.run_in_thread('InterruptServer')
 
+    def stop(self):
+        """Stop the interrupter. If it uses a shared reactor, that reactor must
+        have stopped already."""
+        if self._own_reactor:
+            self.reactor.stop()
+            self._thread.join()
+            self.reactor.close()
+        self.socket.close()
+
+    def _receive_messages(self):
+        while True:
+            try:
+                message = self.socket.recv(flags=zmq.NOBLOCK)
+            except zmq.Again:
+                return
+            self.handle_message(str(message, encoding='ascii'))
@@ -0,0 +1,40 @@
+# This code is licensed under the MIT License (see LICENSE file for details)
+
+"""Support for functions exposed over RPC that produce their results
+incrementally.
+
+A generator function exposed by an RPC server can be called by clients with
+rpc_client.RPCClient.stream() (or, for proxy namespaces, simply by calling the
+proxy function), which returns an iterator that yields each item as soon as the
+server produces it. The generator's return value, if any, is available from
+the iterator's 'value' attribute once it is exhausted. If the client closes the
+iterator before then, the server cancels the call: cancellation.check() raises
+within the generator, and otherwise the generator is closed at its next yield.
+
+Example:
+    class Camera:
+        def iter_frames(self, count):
+            for i in range(count):
+                yield self.acquire()
+            return 'done'
+
+When called other than as a stream (e.g. within a batch, or by an older client),
+the server runs the generator to completion and returns the list of its items.
+"""
+
+def next_item(generator):
+    """Advance a generator, returning (done, value): (False, item) for the
+    next item, or (True, return_value) if the generator is exhausted."""
+    try:
+        return False, next(generator)
+    except StopIteration as e:
+        return True, e.value
+
+def collect(generator):
+    """Run a generator to completion, and return (items, return_value)."""
+    items = []
+    while True:
+        done, value = next_item(generator)
+        if done:
+            return items, value
+        items.append(value)
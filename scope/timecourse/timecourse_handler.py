@@ -154,34 +154,33 @@ class BasicAcquisitionHandler(base_handler.TimepointHandler):
             pass
         assert self.scope.nosepiece.magnification == objective
 
-        self.scope.il.shutter_open = True
-        self.scope.il.spectra.lamps(**{lamp+'_enabled': False for lamp in self.scope.il.spectra.lamp_specs})
-        self.scope.tl.shutter_open = True
-        self.scope.tl.lamp.enabled = False
-        self.scope.tl.condenser_retracted = objective == 5 # only retract condenser for 5x objective
-
         config = self.scope.configuration
         tl_field = self.TL_FIELD
         if tl_field is None:
             tl_field = config.stand.TL_FIELD_DEFAULTS[str(objective)]
-        self.scope.tl.field_diaphragm = tl_field
-
         tl_aperture = self.TL_APERTURE
         if tl_aperture is None:
             tl_aperture = config.stand.TL_APERTURE_DEFAULTS[str(objective)]
-        self.scope.tl.aperture_diaphragm = tl_aperture
-
         il_field = self.IL_FIELD
         if il_field is None:
             il_field = self._IL_FIELD_DEFAULT
-        self.scope.il.field_wheel = il_field
-
-        self.scope.il.filter_cube = self.experiment_metadata['filter_cube']
-        self.scope.camera.sensor_gain = '16-bit (low noise & high well capacity)'
-        self.scope.camera.readout_rate = self.PIXEL_READOUT_RATE
-        self.scope.camera.shutter_mode = 'Rolling'
-
-        self.scope.camera.autofocus.reset_state() # make sure the autofocus mode cache is clear
+        lamp_specs = self.scope.il.spectra.lamp_specs
+
+        # send all the settings to the server in one round-trip
+        with self.scope.batch():
+            self.scope.il.shutter_open = True
+            self.scope.il.spectra.lamps(**{lamp+'_enabled': False for lamp in lamp_specs})
+            self.scope.tl.shutter_open = True
+            self.scope.tl.lamp.enabled = False
+            self.scope.tl.condenser_retracted = objective == 5 # only retract condenser for 5x objective
+            self.scope.tl.field_diaphragm = tl_field
+            self.scope.tl.aperture_diaphragm = tl_aperture
+            self.scope.il.field_wheel = il_field
+            self.scope.il.filter_cube = self.experiment_metadata['filter_cube']
+            self.scope.camera.sensor_gain = '16-bit (low noise & high well capacity)'
+            self.scope.camera.readout_rate = self.PIXEL_READOUT_RATE
+            self.scope.camera.shutter_mode = 'Rolling'
+            self.scope.camera.autofocus.reset_state() # make sure the autofocus mode cache is clear
 
         self.configure_calibrations() # sets self.bf_exposure and self.tl_intensity
 
@@ -386,7 +385,8 @@ class BasicAcquisitionHandler(base_handler.TimepointHandler):
             self.logger.info('Autofocus z: {}', fine_z)
         metadata['stage_z'] = self.scope.stage.z
         with self.debug_timing('Acquisition sequence'):
-            images = self.scope.camera.acquisition_sequencer.run()
+            # images are transferred as they are acquired, rather than after the whole sequence
+            images = list(self.scope.camera.acquisition_sequencer.iter_run())
         exposures = self.scope.camera.acquisition_sequencer.exposure_times
         timestamps = list(self.scope.camera.acquisition_sequencer.latest_timestamps)
         self.post_acquisition_sequence(position_name, position_dir, position_metadata, metadata, images, exposures, timestamps)
@@ -3,6 +3,8 @@
 # Base classes capable of being made available through RPC for properties limited to
 # predetermined or run-time determined sets of valid values.
 
+from ..simple_rpc import cacheable
+
 
 class DictProperty:
     """Base class for any enumerated device property that is limited to a set of non-user-
@@ -13,6 +15,7 @@ class DictProperty:
         self._hw_to_usr = self._get_hw_to_usr()
         self._usr_to_hw = {usr: hw for hw, usr in self._hw_to_usr.items()}
 
+    @cacheable.cacheable
     def get_recognized_values(self):
         """The list of recognized values for this property."""
         return list(sorted(self._usr_to_hw.keys()))
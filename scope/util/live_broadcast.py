@@ -0,0 +1,217 @@
+# This code is licensed under the MIT License (see LICENSE file for details)
+
+"""Broadcast of live camera images to remote viewers.
+
+Without this, each remote viewer fetches every image it displays with an RPC
+call to find the latest image, and another to transfer it, and the server packs
+the same image separately for each viewer. Instead, the LivePublisher packs
+each new image from the camera once for each combination of compression and
+downsampling that viewers have asked for, and publishes it on a ZeroMQ
+PUB/SUB socket. Viewers receive images with a LiveSubscriber.
+
+Only the latest image matters to a viewer, so at most one image at a time is
+queued for each viewer, and the viewer keeps only the latest image it has
+received: a viewer that falls behind misses the intermediate images, rather
+than building up a backlog of stale ones on the server. Likewise, if images arrive faster than the server can pack them, the
+intermediate images are skipped.
+
+Viewers on the same host as the server need not use this: they can map each
+image directly from shared memory (see transfer_ism_buffer).
+"""
+
+import json
+import struct
+import threading
+import time
+import zmq
+
+from . import transfer_ism_buffer
+from ..simple_rpc.reactor import Reactor
+from . import logging
+logger = logging.get_logger(__name__)
+
+# arguments for each compressor, as used by default for RPC image transfers
+_COMPRESSOR_ARGS = dict(blosc=dict(cname='lz4'), zlib=dict(level=2), raw={})
+
+def topic(compressor='blosc', downsample=None):
+    """Return the subscription topic for images with the given compression
+    (None, 'blosc' or 'zlib') and downsampling (None or an integer)."""
+    return '{}/{}/'.format('raw' if compressor is None else compressor, downsample or 1)
+
+def _parse_topic(topic):
+    """Return (compressor, downsample, compressor_args) for a topic, or raise
+    ValueError if it is invalid."""
+    compressor, downsample, rest = topic.split('/')
+    if compressor not in _COMPRESSOR_ARGS or rest:
+        raise ValueError('unknown compressor')
+    downsample = int(downsample)
+    if downsample < 1:
+        raise ValueError('invalid downsample')
+    compressor_args = _COMPRESSOR_ARGS[compressor]
+    return None if compressor == 'raw' else compressor, None if downsample == 1 else downsample, compressor_args
+
+class LivePublisher:
+    def __init__(self, address, context=None, reactor=None, priority=0):
+        """Publish images (e.g. from the camera in live mode) to subscribers.
+
+        Each image is passed to publish(), which returns immediately: a
+        background thread packs the image for each topic that has subscribers
+        (see topic()), and the packed images are sent by a reactor.Reactor.
+        Images arriving while the previous one is being packed replace each
+        other, so only the latest is packed next. Nothing is done at all while
+        there are no subscribers.
+
+        Parameters:
+            address: a string ZeroMQ port identifier, like 'tcp://127.0.0.1:5555'.
+            context: a ZeroMQ context to share, if one already exists.
+            reactor: a Reactor to share, if any. Otherwise, the publisher
+                runs its own reactor in a background thread.
+            priority: priority of the publisher's socket within the reactor.
+        """
+        self.context = context if context is not None else zmq.Context()
+        # an XPUB socket reports subscriptions, so that only the images wanted are packed
+        self.socket = self.context.socket(zmq.XPUB)
+        # CONFLATE has no effect on (X)PUB sockets: instead, the socket queues at most one
+        # image for each subscriber, and drops images for subscribers whose queue is full
+        self.socket.SNDHWM = 1
+        self.socket.bind(address)
+        self._topics = {} # topic -> (compressor, downsample, compressor_args), only altered by the reactor thread
+        self._lock = threading.Condition()
+        self._latest = None # (array, frame_number, timestamp) of the image to pack next
+        self._outgoing = {} # topic -> packed message waiting to be sent
+        self._failed_topics = set() # topics that could not be packed, which are logged only once
+        self._running = True
+        self._packer = threading.Thread(target=self._pack_images, name='LivePacker', daemon=True)
+        self._packer.start()
+        self._own_reactor = reactor is None
+        self.reactor = Reactor() if reactor is None else reactor
+        self.reactor.register(self.socket, self._receive_subscriptions, priority)
+        self.reactor.add_timer(self._send_images)
+        if self._own_reactor:
+            self._thread = self.reactor.run_in_thread('LivePublisher')
+
+    def publish(self, name, array, frame_number, timestamp):
+        """Publish an image (the 'name' of its shared memory buffer is unused).
+        May be called from any thread."""
+        if not self._topics:
+            return
+        with self._lock:
+            self._latest = array, frame_number, timestamp
+            self._lock.notify()
+
+    def stop(self):
+        """Stop the publisher. If it uses a shared reactor, that reactor must
+        have stopped already."""
+        with self._lock:
+            self._running = False
+            self._lock.notify()
+        self._packer.join()
+        if self._own_reactor:
+            self.reactor.stop()
+            self._thread.join()
+            self.reactor.close()
+        self.socket.close()
+
+    def _pack_images(self):
+        while True:
+            with self._lock:
+                while self._running and self._latest is None:
+                    self._lock.wait()
+                if not self._running:
+                    return
+                array, frame_number, timestamp = self._latest
+                self._latest = None
+            if timestamp is not None:
+                timestamp = int(timestamp) # from a numpy integer
+            messages = {}
+            for topic, (compressor, downsample, compressor_args) in self._topics.items():
+                try:
+                    buffers = transfer_ism_buffer._pack_arrays([array], compressor, downsample, compressor_args)[0]
+                except Exception:
+                    if topic not in self._failed_topics:
+                        self._failed_topics.add(topic)
+                        logger.log_exception('Could not pack live image for topic {}:'.format(topic))
+                    continue
+                metadata = json.dumps([frame_number, timestamp, [memoryview(buffer).nbytes for buffer in buffers]]).encode('ascii')
+                # a single frame, as conflating sockets do not support multipart messages
+                messages[topic] = b''.join([topic.encode('ascii'), struct.pack('<I', len(metadata)), metadata] + buffers)
+            del array # don't hold on to the shared memory for longer than needed
+            with self._lock:
+                self._outgoing.update(messages)
+            self.reactor.wakeup()
+
+    def _send_images(self):
+        with self._lock:
+            outgoing = self._outgoing
+            self._outgoing = {}
+        for message in outgoing.values():
+            try:
+                self.socket.send(message, flags=zmq.NOBLOCK, copy=False)
+            except zmq.Again:
+                pass # images are transient: just drop it
+
+    def _receive_subscriptions(self):
+        while True:
+            try:
+                message = self.socket.recv(flags=zmq.NOBLOCK)
+            except zmq.Again:
+                return
+            subscribe, topic = message[0], message[1:].decode('ascii', errors='replace')
+            topics = dict(self._topics)
+            if subscribe:
+                try:
+                    topics[topic] = _parse_topic(topic)
+                except ValueError:
+                    logger.warning('Ignoring subscription to invalid live image topic "{}"', topic)
+                    continue
+            else:
+                topics.pop(topic, None)
+            self._topics = topics # replace rather than alter, as the dict is read from other threads
+
+
+class LiveSubscriber:
+    def __init__(self, address, compressor='blosc', downsample=None, context=None):
+        """Receive images published by a LivePublisher.
+
+        Parameters:
+            address: a string ZeroMQ port identifier, like 'tcp://127.0.0.1:5555'.
+            compressor, downsample: the compression and downsampling of the
+                images to receive: see topic().
+            context: a ZeroMQ context to share, if one already exists.
+        """
+        self.compressor = compressor
+        self.downsample = downsample
+        self.context = context if context is not None else zmq.Context()
+        self.socket = self.context.socket(zmq.SUB)
+        self.socket.CONFLATE = True # keep only the latest image
+        self.socket.LINGER = 0
+        self.socket.connect(address)
+        self._topic = topic(compressor, downsample).encode('ascii')
+        self.socket.subscribe(self._topic)
+
+    def receive(self, timeout=None, min_frame_number=None):
+        """Return (image, timestamp, frame_number) for the latest image received,
+        waiting up to 'timeout' seconds (or indefinitely, if None) for an image
+        to arrive if necessary. Images with frame numbers less than
+        'min_frame_number' are skipped. Return None if the timeout elapses."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            timeout_ms = None if deadline is None else max(0, deadline - time.monotonic()) * 1000
+            if not self.socket.poll(timeout_ms):
+                return None
+            message = self.socket.recv(copy=False).buffer
+            start = len(self._topic)
+            metadata_len, = struct.unpack_from('<I', message, start)
+            start += 4
+            frame_number, timestamp, buffer_lengths = json.loads(bytes(message[start:start+metadata_len]).decode('ascii'))
+            if min_frame_number is not None and frame_number < min_frame_number:
+                continue # a newer image should be along shortly
+            start += metadata_len
+            buffers = []
+            for length in buffer_lengths:
+                buffers.append(message[start:start+length])
+                start += length
+            return transfer_ism_buffer._client_unpack_data(buffers, self.compressor), timestamp, frame_number
+
+    def close(self):
+        self.socket.close()
@@ -5,6 +5,9 @@ from . import state_stack
 class PropertyDevice(state_stack.StateStackDevice):
     """A base class that provides convenience methods for microscope
     device classes that want to present a few properties to the server."""
+    # names of properties that are only updated periodically (e.g. by polling
+    # the hardware), so that their last-published value may be out of date
+    _VOLATILE_PROPERTIES = ()
 
     def __init__(self, property_server, property_prefix):
         """property_server is the property server instance to send property
@@ -14,6 +17,9 @@ class PropertyDevice(state_stack.StateStackDevice):
         super().__init__()
         self._property_server = property_server
         self._property_prefix = property_prefix
+        if property_server:
+            for name in self._VOLATILE_PROPERTIES:
+                property_server.add_volatile(property_prefix+name)
 
     def _update_property(self, name, value):
         """If a non-None property_server was provided, update the named property
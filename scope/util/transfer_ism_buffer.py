@@ -1,16 +1,23 @@
 # This code is licensed under the MIT License (see LICENSE file for details)
 
 import json
+import os
 import numpy
 import struct
 import zlib
 import platform
 import collections
 import threading
+import itertools
+import time
+import weakref
+import concurrent.futures
 
 import ism_buffer
 
-_ism_buffer_registry = collections.defaultdict(list)
+from ..simple_rpc.rpc_client import RPCError
+
+_ism_buffer_registry = {}
 _registry_lock = threading.Lock()
 
 def create_array(name, shape, dtype, order):
@@ -25,6 +32,133 @@ def create_array(name, shape, dtype, order):
     """
     return ism_buffer.new(name, shape, dtype, order).asarray()
 
+class _Segment:
+    def __init__(self, key, buffer):
+        self.key = key
+        self.buffer = buffer
+        self.local_opens = 0 # number of same-host clients that may still have this segment open
+
+class ArrayPool:
+    """Recycling pool of ISM_Buffer shared memory segments, so that image
+    arrays can be provided at high frame rates without creating, mapping,
+    faulting in and unlinking a new shared memory region for each one.
+
+    A segment returns to the pool when the server-side array (and any views
+    of it) are deallocated, unless a client on the same host has opened the
+    segment directly: in that case, the segment is only reused after that
+    client reports that it has let go of its array (see client_get_data_getter()).
+    Segments awaiting such reports are held up to a limit, after which they are
+    simply released to be freed as usual once all processes are done with them.
+    (Clients that do not report closing segments thus never see reused memory.)
+
+    At most max_free unused segments of each shape/dtype/order are retained.
+    """
+    def __init__(self, max_free=8):
+        self.max_free = max_free
+        self._lock = threading.RLock() # reentrant because finalizers can run at any time
+        self._free = collections.defaultdict(list) # key -> list of (name, buffer)
+        self._in_use = {} # name -> _Segment for segments with server-side arrays
+        self._awaiting_close = collections.defaultdict(collections.OrderedDict) # key -> {name: _Segment}
+        self._names = ('image@{}-{}'.format(time.time(), i) for i in itertools.count())
+        self._stats = collections.defaultdict(lambda: dict(in_use=0, high_water=0, free=0,
+            awaiting_close=0, created=0, reused=0, discarded=0))
+
+    def new_array(self, shape, dtype, order):
+        """Return (name, array) for an ISM_Buffer-backed array, reusing a pooled
+        segment if possible. The array contents are undefined."""
+        key = tuple(shape), numpy.dtype(dtype).str, order
+        with self._lock:
+            stats = self._stats[key]
+            free = self._free[key]
+            if free:
+                name, buffer = free.pop()
+                stats['reused'] += 1
+            else:
+                name = next(self._names)
+                buffer = None
+        if buffer is None:
+            buffer = ism_buffer.new(name, shape, dtype, order)
+            with self._lock:
+                stats['created'] += 1
+        array = buffer.asarray()
+        with self._lock:
+            self._in_use[name] = _Segment(key, buffer)
+            stats['in_use'] += 1
+            stats['high_water'] = max(stats['high_water'], stats['in_use'])
+            stats['free'] = len(self._free[key])
+        weakref.finalize(array, self._server_released, name)
+        return name, array
+
+    def local_opened(self, name):
+        """Record that a client on the same host has opened the named segment."""
+        with self._lock:
+            segment = self._in_use.get(name)
+            if segment is not None:
+                segment.local_opens += 1
+
+    def local_closed(self, name):
+        """Record that a client on the same host has let go of the named segment."""
+        with self._lock:
+            segment = self._in_use.get(name)
+            if segment is not None:
+                segment.local_opens = max(0, segment.local_opens - 1)
+                return
+            for key, awaiting in self._awaiting_close.items():
+                if name in awaiting:
+                    segment = awaiting[name]
+                    segment.local_opens -= 1
+                    if segment.local_opens <= 0:
+                        del awaiting[name]
+                        self._stats[key]['awaiting_close'] = len(awaiting)
+                        self._recycle(name, segment)
+                    return
+
+    def stats(self):
+        """Return a dict of pool statistics for each array shape, dtype and order."""
+        with self._lock:
+            return {'{} {} {}'.format('x'.join(map(str, shape)), dtype, order): dict(stats, max_free=self.max_free)
+                for (shape, dtype, order), stats in self._stats.items()}
+
+    def _server_released(self, name):
+        with self._lock:
+            segment = self._in_use.pop(name)
+            stats = self._stats[segment.key]
+            stats['in_use'] -= 1
+            if segment.local_opens == 0:
+                self._recycle(name, segment)
+            else:
+                awaiting = self._awaiting_close[segment.key]
+                awaiting[name] = segment
+                if len(awaiting) > self.max_free:
+                    awaiting.popitem(last=False) # give up on the oldest
+                    stats['discarded'] += 1
+                stats['awaiting_close'] = len(awaiting)
+
+    def _recycle(self, name, segment):
+        free = self._free[segment.key]
+        stats = self._stats[segment.key]
+        if len(free) < self.max_free:
+            free.append((name, segment.buffer))
+        else:
+            stats['discarded'] += 1
+        stats['free'] = len(free)
+
+_array_pool = ArrayPool()
+
+def new_pooled_array(shape, dtype, order):
+    """Return (name, array) for a numpy array backed by an ISM_Buffer shared
+    memory region from the recycling pool. Unlike create_array(), the name is
+    chosen by the pool, and the array contents are undefined. Once the
+    array (and any views of it) are deallocated, the region may be reused."""
+    return _array_pool.new_array(shape, dtype, order)
+
+def pool_stats():
+    """Return statistics about the shared memory pool, for each array shape,
+    dtype and order: the number of segments currently in use by the server
+    and their high-water mark, the numbers free and awaiting release by
+    clients, and the counts of segments created, reused, and discarded."""
+    return _array_pool.stats()
+
 def register_array_for_transfer(name, array):
     """Register a named, ISM_Buffer-backed array with the server that is going
     to be transfered to another process. Once the other process obtains the
@@ -40,22 +174,28 @@ def register_array_for_transfer(name, array):
     # thread; or this function and _release_array might get called simultaneously.
     # Thus we protect mutating access to the registry.
     with _registry_lock:
-        # the below is sufficiently atomic that simultaneous calls to this function
-        # won't cause a problem (the default will only get created once),
-        # but we don't want to be appending to an array that's simultaneously
-        # getting deleted by _release_array.
-        _ism_buffer_registry[name].append(array)
+        # don't want to be appending to a list that's simultaneously getting
+        # deleted by release_array.
+        _ism_buffer_registry.setdefault(name, []).append(array)
+
+def _registered_arrays(name):
+    # must be called with _registry_lock held
+    try:
+        return _ism_buffer_registry[name]
+    except KeyError:
+        raise KeyError('No array named "{}" is registered for transfer.'.format(name)) from None
 
 def release_array(name):
     """Remove the named, ISM_Buffer-backed array from the transfer registry,
     allowing it to be deallocated if nobody else on the server process is
     retaining any references. Return the named array."""
-    arrays = _ism_buffer_registry[name]
-    array = arrays.pop()
+    # the lookup, pop, and deletion of an emptied list all have to happen
+    # together: otherwise two threads releasing the same name could both pop
+    # from the list, or another thread could register the name after we decide
+    # that the list is empty but before we delete it.
     with _registry_lock:
-        # don't want another thread to register the same name after we here
-        # decide that arrays is empty, but before we delete it, so synchronize
-        # this section only.
+        arrays = _registered_arrays(name)
+        array = arrays.pop()
         if not arrays:
             del _ism_buffer_registry[name]
     return array
@@ -63,79 +203,288 @@ def release_array(name):
 def borrow_array(name):
     """Return the named array, while still keeping a reference in the registry
     for future transfer to a client."""
-    return _ism_buffer_registry[name][-1]
+    with _registry_lock:
+        return _registered_arrays(name)[-1]
 
-def _server_release_array(name):
+def _server_release_array(name, closed_names=()):
     """Remove the named, ISM_Buffer-backed array from the transfer registry,
     allowing it to be deallocated if nobody else on the server process is
     retaining any references. Does not return the named array, so this function
-    is safe to call over RPC (which does not know how to send numpy arrays)."""
-    release_array(name)
+    is safe to call over RPC (which does not know how to send numpy arrays).
+
+    This is called by clients on the same host after opening the ISM_Buffer
+    directly. Such clients also pass the names of any previously-obtained
+    buffers that they have since let go of, so that pooled shared memory
+    segments can be reused."""
+    _server_release_arrays([name], closed_names)
+
+def _server_release_arrays(names, closed_names=()):
+    """As _server_release_array(), for several arrays at once."""
+    for name in names:
+        _array_pool.local_opened(name)
+    for closed_name in closed_names:
+        _array_pool.local_closed(closed_name)
+    for name in names:
+        release_array(name)
+
+# remote transfers are split into chunks of this size, which are compressed in parallel
+_CHUNK_BYTES = 4 * 1024**2
+_compression_pool = concurrent.futures.ThreadPoolExecutor(os.cpu_count(), thread_name_prefix='Compressor')
+
+def _server_pack_data(name, compressor='blosc', downsample=None, region=None, pyramid_level=None, **compressor_args):
+    """Pack the data in the named ISM_Buffer into a single buffer for transfer
+    over the network (or other serialization): a header describing the array,
+    followed by the array data, compressed in one piece. This is the format
+    expected by clients from before data were sent in chunks: newer clients
+    use _server_pack_chunked_data() instead. Parameters are as for
+    _server_pack_chunked_data()."""
+    array = release_array(name) # get the array and release it from the list of to-be-transfered arrays
+    header, data = _pack_arrays([array], compressor, downsample, compressor_args, region, pyramid_level, chunked=False)[0]
+    return bytearray(header) + data
 
-def _server_pack_data(name, compressor='blosc', downsample=None, **compressor_args):
-    """Pack the data in the named ISM_Buffer into bytes for transfer over
-    the network (or other serialization).
+def _server_pack_chunked_data(name, compressor='blosc', downsample=None, region=None, pyramid_level=None, **compressor_args):
+    """Pack the data in the named ISM_Buffer into a list of buffers for transfer
+    over the network (or other serialization): a header describing the array,
+    followed by the array data.
     Downsample parameter: int / None. If not None, only return every nth pixel.
+    Region and pyramid_level parameters: reduce the array before packing (see
+    reduce_array()), so that only the pixels required are sent.
     Valid compressor values are:
       - None: pack raw image bytes
       - 'blosc': use the fast, modern BLOSC compression library
       - 'zlib': use older, more widely supported zlib compression
-    compressor_args are passed to zlib.compress() or blosc.compress() directly."""
+    compressor_args are passed to zlib.compress() or blosc.compress() directly.
 
+    Uncompressed data is sent as a single buffer that is a view onto the shared
+    memory, without copying. Compressed data is split into chunks that are
+    compressed separately, in parallel."""
     array = release_array(name) # get the array and release it from the list of to-be-transfered arrays
+    return _pack_arrays([array], compressor, downsample, compressor_args, region, pyramid_level)[0]
+
+def _server_pack_many_data(names, compressor='blosc', downsample=None, region=None, pyramid_level=None, **compressor_args):
+    """Pack the data in several named ISM_Buffers into a single list of buffers,
+    so that they can all be transferred in one RPC reply. The list starts with
+    a buffer giving the number of buffers for each array, followed by each
+    array's buffers as from _server_pack_chunked_data(). Parameters are as for
+    _server_pack_chunked_data().
+
+    The chunks of all the arrays are compressed in parallel, so several small
+    images are packed as quickly as one large one."""
+    packed = _pack_arrays([release_array(name) for name in names], compressor, downsample, compressor_args, region, pyramid_level)
+    counts = struct.pack('<{}I'.format(len(packed)), *[len(buffers) for buffers in packed])
+    return [counts] + [buffer for buffers in packed for buffer in buffers]
+
+def reduce_array(array, region=None, downsample=None, pyramid_level=None):
+    """Return a reduced version of an image array, to transfer or display
+    only as much of the image as is needed.
+
+    Parameters:
+        region: None, or ((start0, stop0), (start1, stop1)): the range of
+            indices along each of the first two axes to crop the image to.
+            (None may be given for any start or stop, as with a slice.)
+        downsample: None, or an int: return every nth pixel.
+        pyramid_level: None, or an int n: return the mean of each 2**n x 2**n
+            block of pixels. Partial blocks at the edges of the image are
+            dropped. Integer images are rounded to the nearest value.
+
+    The region is applied first, then the pyramid level, then downsampling.
+    Cropping and downsampling return views of the array; pyramid levels are
+    computed into a new array."""
+    if region is not None:
+        array = array[tuple(slice(start, stop) for start, stop in region)]
+    if pyramid_level:
+        array = _bin_array(array, 2**pyramid_level)
     if downsample:
         array = array[::downsample, ::downsample]
-    dtype_str = numpy.lib.format.dtype_to_descr(array.dtype)
-    if array.flags.f_contiguous:
-        order = 'F'
-    elif array.flags.c_contiguous:
-        order = 'C'
-    else:
-        array = numpy.asfortranarray(array)
-        order = 'F'
-    descr = json.dumps((dtype_str, array.shape, order)).encode('ascii')
-    output = bytearray(struct.pack('<H', len(descr))) # put the len of the descr in a 2-byte uint16
-    output += descr
-    if compressor is None:
-        output += memoryview(array.flatten(order=order))
-    elif compressor == 'zlib':
+    return array
+
+def _bin_array(array, factor):
+    size0, size1 = (size - size % factor for size in array.shape[:2])
+    if size0 == 0 or size1 == 0:
+        raise ValueError('Pyramid level too high for an image of shape {}'.format(array.shape))
+    blocks = array[:size0, :size1].reshape((size0 // factor, factor, size1 // factor, factor) + array.shape[2:])
+    binned = blocks.mean(axis=(1, 3), dtype=numpy.float32)
+    if array.dtype.kind in 'iu':
+        numpy.rint(binned, out=binned)
+    return binned.astype(array.dtype)
+
+def _pack_arrays(arrays, compressor, downsample, compressor_args, region=None, pyramid_level=None, chunked=True):
+    """Return a list of [header] + chunks for each array. If 'chunked' is False,
+    each array's data are compressed in one piece, and the header is in the
+    format from before data were sent in chunks (without the chunk size)."""
+    headers = []
+    chunk_lists = []
+    to_compress = [] # (compress function, chunk) for the chunks of all arrays
+    for array in arrays:
+        array = reduce_array(array, region, downsample, pyramid_level)
+        dtype_str = numpy.lib.format.dtype_to_descr(array.dtype)
+        if array.flags.f_contiguous:
+            order = 'F'
+        elif array.flags.c_contiguous:
+            order = 'C'
+        else:
+            array = numpy.asfortranarray(array)
+            order = 'F'
+        data = array.reshape(-1, order=order).view(numpy.uint8) # a view, as the array is contiguous in this order
+        if compressor is None:
+            chunk_bytes = data.size
+            chunk_lists.append([memoryview(data)])
+        else:
+            chunk_bytes = _CHUNK_BYTES if chunked else max(data.size, 1)
+            compress = _get_compress(compressor, array.dtype.itemsize, compressor_args)
+            chunks = [data[i:i+chunk_bytes] for i in range(0, max(data.size, 1), chunk_bytes)]
+            chunk_lists.append(len(chunks))
+            to_compress.extend((compress, chunk) for chunk in chunks)
+        descr = (dtype_str, array.shape, order, chunk_bytes) if chunked else (dtype_str, array.shape, order)
+        descr = json.dumps(descr).encode('ascii')
+        headers.append(struct.pack('<H', len(descr)) + descr) # put the len of the descr in a 2-byte uint16
+    if to_compress:
+        compressed = iter(_compression_pool.map(lambda job: job[0](job[1]), to_compress))
+        # replace each array's chunk count with its compressed chunks, in order
+        chunk_lists = [[next(compressed) for i in range(chunks)] for chunks in chunk_lists]
+    return [[header] + chunks for header, chunks in zip(headers, chunk_lists)]
+
+def _get_compress(compressor, typesize, compressor_args):
+    if compressor == 'zlib':
         has_level_arg = 'level' in compressor_args
         if len(compressor_args) - has_level_arg > 0:
             raise RuntimeError('"level" is the only valid valid zlib compression option.')
         zlib_compressor_args = [compressor_args['level']] if has_level_arg else []
-        output += zlib.compress(array.flatten(order=order), *zlib_compressor_args)
+        return lambda chunk: zlib.compress(chunk, *zlib_compressor_args)
     elif compressor == 'blosc':
         import blosc
+        blosc.set_releasegil(True) # so that chunks can be compressed in parallel
         # because blosc.compress can't handle a memoryview, we need to use blosc.compress_ptr
-        output += blosc.compress_ptr(array.ctypes.data, array.size, typesize=array.dtype.itemsize, **compressor_args)
+        return lambda chunk: blosc.compress_ptr(chunk.ctypes.data, chunk.size // typesize, typesize=typesize, **compressor_args)
     else:
         raise RuntimeError('un-recognized compressor')
-    return output
-
-def _client_unpack_data(buf, compressor='blosc'):
-    """Unpack (on the client side) data packed (on the server side) by _server_pack_data().
-    The compressor name passed to _server_pack_data() must also be passed
-    to this function."""
-    header_len = struct.unpack_from('<H', buf[:2])[0]
-    dtype, shape, order = json.loads(bytes(buf[2:header_len+2]).decode('ascii'))
-    array_buf = buf[header_len+2:]
+
+def _client_unpack_data(buffers, compressor='blosc'):
+    """Unpack (on the client side) data packed (on the server side) by
+    _server_pack_chunked_data() or _server_pack_data(). The compressor name
+    passed to the server must also be passed to this function.
+
+    The buffers are the header followed by the data chunks, or a single buffer
+    as from _server_pack_data()."""
+    if isinstance(buffers, list):
+        header, *chunks = buffers
+    else:
+        header, chunks = buffers, None
+    header_len = struct.unpack_from('<H', header[:2])[0]
+    dtype, shape, order, *chunk_bytes = json.loads(bytes(header[2:header_len+2]).decode('ascii'))
+    if chunks is None:
+        # the data follow the header, in one piece
+        chunks = [header[header_len+2:]]
+        chunk_bytes = max(numpy.dtype(dtype).itemsize * int(numpy.prod(shape)), 1)
+    else:
+        chunk_bytes, = chunk_bytes
     # NB: If this function exits with an exception involving zero-length slices, please upgrade your pyzmq
     # installation (the issue is known to be fixed pyzmq 14.6.0, and at the time this comment was written,
     # "pip-3.4 install pyzmq" grabbed 14.7.0).
     if compressor is None:
-        data = array_buf
+        array = numpy.ndarray(shape, dtype=dtype, order=order, buffer=chunks[0])
+        array.flags.writeable = True
+        return array
     elif compressor == 'zlib':
-        data = bytearray(zlib.decompress(array_buf))
+        def decompress(chunk, out):
+            out[:] = numpy.frombuffer(zlib.decompress(chunk), dtype=numpy.uint8)
     elif compressor == 'blosc':
         import blosc
-        data = blosc.decompress(array_buf, as_bytearray=True)
-    array = numpy.ndarray(shape, dtype=dtype, order=order, buffer=data)
-    array.flags.writeable = True
+        blosc.set_releasegil(True)
+        def decompress(chunk, out):
+            blosc.decompress_ptr(chunk, out.ctypes.data)
+    else:
+        raise RuntimeError('un-recognized compressor')
+    # decompress each chunk directly into its place in the output array
+    array = numpy.empty(shape, dtype=dtype, order=order)
+    data = array.reshape(-1, order=order).view(numpy.uint8)
+    outs = [data[i*chunk_bytes:(i+1)*chunk_bytes] for i in range(len(chunks))]
+    list(_compression_pool.map(decompress, chunks, outs))
     return array
 
+def _client_unpack_many_data(buffers, compressor='blosc'):
+    """Unpack (on the client side) the list of arrays packed (on the server
+    side) by _server_pack_many_data()."""
+    counts, *buffers = buffers
+    counts = struct.unpack('<{}I'.format(len(counts) // 4), counts)
+    arrays = []
+    start = 0
+    for count in counts:
+        arrays.append(_client_unpack_data(buffers[start:start+count], compressor))
+        start += count
+    return arrays
+
 def _server_get_node():
     return platform.node()
 
+def _adaptive_settings(has_blosc):
+    """Return the list of (compressor, compressor_args, downsample) settings
+    that _AdaptiveCompression chooses from, in order of decreasing transfer
+    size: no compression, then increasingly strong compression, then
+    increasing downsampling with fast compression."""
+    if has_blosc:
+        fast, strong = ('blosc', dict(cname='lz4')), ('blosc', dict(cname='zstd', clevel=5))
+    else:
+        fast, strong = ('zlib', dict(level=1)), ('zlib', dict(level=6))
+    settings = [(None, {}, None), fast + (None,), strong + (None,)]
+    settings += [fast + (downsample,) for downsample in (2, 3, 4, 6, 8)]
+    return settings
+
+class _AdaptiveCompression:
+    """Choose compression and downsampling settings for image transfers, so
+    that images can be transferred at a target frame rate.
+
+    The time taken by each transfer (including compression and decompression)
+    is compared with the time available per frame at the target rate. If
+    transfers take too long, the next setting that produces smaller transfers
+    is used. If they take well under the time available, the next setting that
+    produces larger (less compressed or less downsampled) transfers is tried,
+    unless it was recently found to be too slow. Settings are changed only
+    after several transfers with the current setting, so that a single slow
+    transfer does not cause a change.
+    """
+    _SMOOTHING = 0.3 # weight of each new transfer time in the moving average
+    _MIN_TRANSFERS = 5 # number of transfers with a setting before it can be changed
+    _HEADROOM = 0.5 # try larger transfers if the current ones take less than this fraction of the time available
+    _MEMORY_SEC = 30 # how long to remember that a setting was too slow
+
+    def __init__(self, target_fps, settings, start=1):
+        self.target_fps = target_fps
+        self.settings = settings
+        self.index = start
+        self._average_sec = None
+        self._transfers = 0
+        self._too_slow = {} # setting index -> time.monotonic() time when it was last found too slow
+
+    @property
+    def setting(self):
+        """The current (compressor, compressor_args, downsample) setting."""
+        return self.settings[self.index]
+
+    def record(self, transfer_sec):
+        """Record the time taken by a transfer with the current setting, and
+        change the setting if appropriate."""
+        if self._average_sec is None:
+            self._average_sec = transfer_sec
+        else:
+            self._average_sec += self._SMOOTHING * (transfer_sec - self._average_sec)
+        self._transfers += 1
+        if self._transfers < self._MIN_TRANSFERS:
+            return
+        available_sec = 1 / self.target_fps
+        now = time.monotonic()
+        if self._average_sec > available_sec and self.index < len(self.settings) - 1:
+            self._too_slow[self.index] = now
+            self._change(self.index + 1)
+        elif self._average_sec < available_sec * self._HEADROOM and self.index > 0:
+            if now - self._too_slow.get(self.index - 1, -self._MEMORY_SEC) >= self._MEMORY_SEC:
+                self._change(self.index - 1)
+
+    def _change(self, index):
+        self.index = index
+        self._average_sec = None
+        self._transfers = 0
+
 def client_get_data_getter(rpc_client, force_remote=False):
     """Return a callable, get_data(), which given an ISM_Buffer name, returns
     a numpy array containing the data from that buffer. If the server and client
@@ -144,7 +493,14 @@ def client_get_data_getter(rpc_client, force_remote=False):
     is a fast, zero-copy operation. If the server and client are on different
     hosts, then the data will be packed and serialized over RPC. In this case,
     get_data() will have a method, 'set_network_compression()' to allow the
-    amount of compression applied to the packed data to be tuned."""
+    amount of compression applied to the packed data to be tuned.
+
+    Either way, get_data() has a method 'many()', which given a list of names,
+    returns the list of arrays, obtaining them all with a single RPC call.
+    Both get_data() and many() accept optional 'region' and 'pyramid_level'
+    keyword arguments, to obtain only part of each image, or a mean-binned
+    version of it (see reduce_array()). For remote clients, the reduction is
+    done on the server, so only the reduced images are sent."""
 
     if force_remote:
         is_local = False
@@ -152,23 +508,66 @@ def client_get_data_getter(rpc_client, force_remote=False):
         is_local = rpc_client('_transfer_ism_buffer._server_get_node') == platform.node()
 
     if is_local: # on same machine -- use ISM buffer directly
-        def get_data(name):
+        # names of buffers whose arrays have been deallocated, to report to the server
+        closed_names = collections.deque()
+        def open_array(name):
             array = ism_buffer.open(name).asarray()
-            rpc_client('_transfer_ism_buffer._server_release_array', name)
+            weakref.finalize(array, closed_names.append, name)
             return array
+        def pop_closed_names():
+            closed = []
+            while closed_names:
+                closed.append(closed_names.popleft())
+            return closed
+        def get_data(name, region=None, pyramid_level=None):
+            array = open_array(name)
+            rpc_client('_transfer_ism_buffer._server_release_array', name, pop_closed_names())
+            return reduce_array(array, region, pyramid_level=pyramid_level)
+        def get_many_data(names, region=None, pyramid_level=None):
+            if not names:
+                return []
+            arrays = [open_array(name) for name in names]
+            rpc_client('_transfer_ism_buffer._server_release_arrays', names, pop_closed_names())
+            return [reduce_array(array, region, pyramid_level=pyramid_level) for array in arrays]
+        get_data.many = get_many_data
     else: # pipe data over network
         class GetData:
             def __init__(self):
                 self.downsample = None
                 self.compressor_args = {}
+                self._adaptive = None
                 try:
                     import blosc
+                    self._has_blosc = True
                     self.compressor = 'blosc'
                     self.compressor_args['cname'] = 'lz4'
                 except ImportError:
+                    self._has_blosc = False
                     self.compressor = 'zlib'
                     self.compressor_args['level'] = 2
 
+            def set_target_fps(self, target_fps):
+                """Choose the compression and downsampling of images sent over
+                the network automatically, based on the measured transfer times,
+                so that images can be transferred at the target frame rate.
+                If target_fps is None, stop changing the settings automatically.
+                Calling set_network_compression() also stops automatic changes."""
+                if target_fps is None:
+                    self._adaptive = None
+                    return
+                self._adaptive = _AdaptiveCompression(target_fps, _adaptive_settings(self._has_blosc))
+                self.compressor, self.compressor_args, self.downsample = self._adaptive.setting
+
+            def record_transfer_time(self, seconds):
+                """Record the time taken to obtain an image with the current
+                settings, for automatic adjustment of the settings (see
+                set_target_fps()). Transfers made with this object are recorded
+                automatically; this is for images obtained by other means with
+                the same settings (e.g. from the live image broadcast)."""
+                if self._adaptive is not None:
+                    self._adaptive.record(seconds)
+                    self.compressor, self.compressor_args, self.downsample = self._adaptive.setting
+
             def set_network_compression(self, compressor, downsample=None, **compressor_args):
                 """Set the type of compression applied to images sent over the
                 network.
@@ -180,12 +579,49 @@ def client_get_data_getter(rpc_client, force_remote=False):
                       - 'zlib': use older, more widely supported zlib compression
                     downsample: int / None. If not None, return every nth pixel.
                     compressor_args: passed to zlib.compress() or blosc.compress() directly."""
+                self._adaptive = None
                 self.compressor = compressor
                 self.compressor_args = compressor_args
                 self.downsample = downsample
 
-            def __call__(self, name):
-                data = rpc_client('_transfer_ism_buffer._server_pack_data', name, self.compressor, self.downsample, **self.compressor_args)
-                return _client_unpack_data(data, self.compressor)
+            def __call__(self, name, region=None, pyramid_level=None):
+                t0 = time.perf_counter()
+                data = self._pack_data(name, self.compressor, self.downsample,
+                    **self._reduction_args(region, pyramid_level), **self.compressor_args)
+                array = _client_unpack_data(data, self.compressor)
+                self.record_transfer_time(time.perf_counter() - t0)
+                return array
+
+            def many(self, names, region=None, pyramid_level=None):
+                if not names:
+                    return []
+                t0 = time.perf_counter()
+                data = rpc_client('_transfer_ism_buffer._server_pack_many_data', names, self.compressor, self.downsample,
+                    **self._reduction_args(region, pyramid_level), **self.compressor_args)
+                arrays = _client_unpack_many_data(data, self.compressor)
+                self.record_transfer_time((time.perf_counter() - t0) / len(names))
+                return arrays
+
+            _chunked = True # whether the server can send data in chunks, until found otherwise
+
+            def _pack_data(self, *args, **kwargs):
+                if self._chunked:
+                    try:
+                        return rpc_client('_transfer_ism_buffer._server_pack_chunked_data', *args, **kwargs)
+                    except RPCError as e:
+                        if not str(e).startswith('No such command'):
+                            raise
+                        self._chunked = False # an older server
+                return rpc_client('_transfer_ism_buffer._server_pack_data', *args, **kwargs)
+
+            @staticmethod
+            def _reduction_args(region, pyramid_level):
+                # only sent if needed, so that full images can still be fetched from older servers
+                args = {}
+                if region is not None:
+                    args['region'] = region
+                if pyramid_level:
+                    args['pyramid_level'] = pyramid_level
+                return args
         get_data = GetData()
     return is_local, get_data
@@ -0,0 +1,69 @@
+# This code is licensed under the MIT License (see LICENSE file for details)
+
+"""Run a scope server with a simulated camera (and no other hardware) in a
+background thread of the test process, on free ports.
+
+Like the real andor library, the simulated one supports only a single camera
+per process, so all tests share one server: see get_server()."""
+
+import atexit
+import copy
+import socket
+import tempfile
+import threading
+
+from scope import scope_server
+from scope.config import default_config
+from scope.config import scope_configuration
+
+_PORT_NAMES = ('RPC_PORT', 'RPC_INTERRUPT_PORT', 'PROPERTY_PORT', 'IMAGE_TRANSFER_RPC_PORT', 'LIVE_BROADCAST_PORT')
+
+def _free_ports(count):
+    sockets = [socket.socket() for i in range(count)]
+    for s in sockets:
+        s.bind(('127.0.0.1', 0))
+    ports = [str(s.getsockname()[1]) for s in sockets]
+    for s in sockets:
+        s.close()
+    return ports
+
+class SimulatedServer:
+    def __init__(self, ipc=False):
+        """Start a server. If ipc is False, local clients use TCP."""
+        self._ipc_dir = tempfile.TemporaryDirectory()
+        config = copy.deepcopy(default_config.scope_configuration)
+        config['drivers'] = (('camera', 'andor.simulated.SimulatedZyla'),)
+        config['server'].update(zip(_PORT_NAMES, _free_ports(len(_PORT_NAMES))))
+        config['server'].update(IPC_DIR=self._ipc_dir.name if ipc else None, METRICS_LOG_INTERVAL=None)
+        self._old_config = scope_configuration._CONFIG
+        scope_configuration._CONFIG = config
+        self.server = scope_server.ScopeServer()
+        self.server.config = scope_configuration.get_config()
+        self.server.host = self.server.config.server.LOCALHOST
+        self.server.initialize_daemon()
+        self.scope = self.server.scope_server.namespace
+        self._thread = threading.Thread(target=self.server.run_daemon, name='TestScopeServer', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self.server.reactor.stop() # run_daemon() then shuts everything down
+        self._thread.join()
+        scope_configuration._CONFIG = self._old_config
+        self._ipc_dir.cleanup()
+
+_server = None
+
+def get_server():
+    """Return the shared SimulatedServer, starting it if necessary."""
+    global _server
+    if _server is None:
+        _server = SimulatedServer()
+        atexit.register(_server.stop)
+    return _server
+
+def close_client(client):
+    """Stop a ScopeClient's property thread and close its sockets. (Otherwise,
+    if the client's ZeroMQ context is garbage-collected along with its
+    sockets, terminating the context can block.)"""
+    client.properties.stop()
+    client._context.destroy(linger=0)
@@ -0,0 +1,245 @@
+# This code is licensed under the MIT License (see LICENSE file for details)
+
+import time
+import unittest
+import zmq
+
+from scope import scope_client
+from scope.simple_rpc import property_client
+from scope.simple_rpc import property_server
+
+import simulated_server
+
+def _wait_for(condition, timeout=5):
+    end = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > end:
+            return False
+        time.sleep(0.01)
+    return True
+
+class ScopeClientSynchronizationTests(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = simulated_server.get_server()
+
+    def setUp(self):
+        self.client = scope_client.ScopeClient(self.server.server.host)
+
+    def tearDown(self):
+        simulated_server.close_client(self.client)
+
+    def test_properties_filled_in_on_connect(self):
+        properties = self.client.properties.properties
+        self.assertEqual(properties['scope.camera.exposure_time'], self.server.scope.camera.get_exposure_time())
+        self.assertIn('scope.camera.live_mode', properties)
+        self.assertTrue(self.client.properties.is_current('scope.camera.exposure_time'))
+
+    def test_synchronize_calls_callbacks(self):
+        values = []
+        self.client.properties.subscribe('scope.camera.bit_depth', values.append, valueonly=True)
+        self.client.synchronize_properties()
+        self.assertTrue(_wait_for(lambda: values))
+        self.assertEqual(values, [self.server.scope.camera.get_bit_depth()])
+
+    def test_updates_after_snapshot(self):
+        exposure_time = self.server.scope.camera.get_exposure_time()
+        try:
+            self.client.camera.exposure_time = exposure_time * 2
+            new_exposure = self.server.scope.camera.get_exposure_time()
+            self.assertTrue(_wait_for(lambda: self.client.properties.properties['scope.camera.exposure_time'] == new_exposure))
+        finally:
+            self.client.camera.exposure_time = exposure_time
+
+
+class PropertyCacheTests(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = simulated_server.get_server()
+        cls.camera = cls.server.scope.camera
+
+    def setUp(self):
+        self.exposure_time = self.camera.get_exposure_time()
+        self.client = scope_client.ScopeClient(self.server.server.host)
+        self.cache = self.client._property_cache
+
+    def tearDown(self):
+        simulated_server.close_client(self.client)
+        self.camera.set_exposure_time(self.exposure_time)
+
+    def _wait_for_exposure_time(self, exposure_time):
+        return _wait_for(lambda: self.client.properties.properties['scope.camera.exposure_time'] == exposure_time)
+
+    def test_reads_served_locally(self):
+        self.assertEqual(self.client.camera.exposure_time, self.exposure_time)
+        call_count = self.client._rpc_client.call_count
+        hits = self.cache.hits
+        for i in range(5):
+            self.assertEqual(self.client.camera.exposure_time, self.exposure_time)
+        self.assertEqual(self.client._rpc_client.call_count, call_count)
+        self.assertEqual(self.cache.hits, hits + 5)
+
+    def test_read_after_set(self):
+        self.client.camera.exposure_time = self.exposure_time * 2
+        # the value read must reflect the change, even before the update arrives
+        self.assertEqual(self.client.camera.exposure_time, self.camera.get_exposure_time())
+        self.assertNotEqual(self.client.camera.exposure_time, self.exposure_time)
+
+    def test_change_by_other_client(self):
+        self.camera.set_exposure_time(self.exposure_time * 2)
+        new_exposure = self.camera.get_exposure_time()
+        self.assertTrue(self._wait_for_exposure_time(new_exposure))
+        self.assertEqual(self.client.camera.exposure_time, new_exposure)
+
+    def test_resynchronize_after_missed_update(self):
+        property_server = self.server.server.property_server
+        with property_server._lock:
+            # as if an update to the exposure time was published, but lost on the way
+            property_server._sequence += 1
+            property_server._property_sequences['scope.camera.exposure_time'] = property_server._sequence
+        self.camera.set_exposure_time(self.exposure_time * 2)
+        new_exposure = self.camera.get_exposure_time()
+        self.assertTrue(_wait_for(lambda: self.client.properties.gap_count == 1))
+        self.assertEqual(self.client.camera.exposure_time, new_exposure)
+        self.assertEqual(self.client.properties.gap_count, 0)
+        hits = self.cache.hits
+        self.assertEqual(self.client.camera.exposure_time, new_exposure)
+        self.assertEqual(self.cache.hits, hits + 1)
+
+    def test_server_restart(self):
+        self.assertEqual(self.client.camera.exposure_time, self.exposure_time)
+        property_server = self.server.server.property_server
+        with property_server._lock:
+            # as if the server was restarted: a new epoch, and sequence numbers start over
+            property_server.epoch += 1
+            property_server._sequence = 0
+            property_server._property_sequences.clear()
+        self.camera.set_exposure_time(self.exposure_time * 2)
+        new_exposure = self.camera.get_exposure_time()
+        self.assertTrue(_wait_for(lambda: self.client.properties.epoch == property_server.epoch))
+        self.assertEqual(self.client.camera.exposure_time, new_exposure)
+        hits = self.cache.hits
+        self.assertEqual(self.client.camera.exposure_time, new_exposure)
+        self.assertEqual(self.cache.hits, hits + 1)
+
+    def test_only_cached_properties_mirrored(self):
+        mirrored = self.client.properties.mirrored_prefixes
+        self.assertIn('scope.camera.exposure_time', mirrored)
+        self.assertNotIn('scope.camera.frame_number', mirrored)
+        self.assertFalse(any(prefix.endswith('.') for prefix in mirrored))
+
+
+class SequenceTests(unittest.TestCase):
+    def setUp(self):
+        self.server = property_server.ZMQServer('tcp://127.0.0.1:*')
+        address = self.server.socket.LAST_ENDPOINT.decode()
+        self.client = property_client.ZMQClient(address)
+        self.client.mirror('test.')
+        self.server.add_property('test.x', 0)
+        # wait for the subscription to take effect
+        self.assertTrue(_wait_for(lambda: self._publish_until_received('test.ready')))
+        self.client.synchronize(*self.server.get_snapshot())
+
+    def _publish_until_received(self, property_name):
+        self.server.update_property(property_name, time.monotonic())
+        return property_name in self.client.properties
+
+    def tearDown(self):
+        self.client.stop()
+        self.server.stop()
+
+    def test_updates_applied(self):
+        self.server.update_property('test.x', 1)
+        self.assertTrue(_wait_for(lambda: self.client.properties.get('test.x') == 1))
+        self.assertTrue(_wait_for(lambda: self.client.current_through == self.server.get_sequence()))
+        self.assertEqual(self.client.gap_count, 0)
+        self.assertTrue(self.client.is_current('test.x'))
+
+    def test_gap_detected(self):
+        with self.server._lock:
+            # as if an update to test.x was published, but lost on the way
+            self.server._sequence += 1
+            self.server._property_sequences['test.x'] = self.server._sequence
+        self.server.update_property('test.x', 2)
+        self.assertTrue(_wait_for(lambda: self.client.gap_count == 1))
+        self.assertFalse(self.client.is_current('test.x'))
+        self.client.synchronize(*self.server.get_snapshot())
+        self.assertEqual(self.client.gap_count, 0)
+        self.assertTrue(self.client.is_current('test.x'))
+
+    def test_stale_update_discarded(self):
+        self.server.update_property('test.x', 3)
+        self.assertTrue(_wait_for(lambda: self.client.properties.get('test.x') == 3))
+        # an update that arrives after a snapshot that already reflects it
+        self.client.synchronize(self.server.get_sequence(), {'test.x': 4})
+        self.server._publish_update('test.x', 3, self.server.get_sequence(), 0, self.server.get_sequence())
+        self.server.update_property('test.ready', 'last')
+        self.assertTrue(_wait_for(lambda: self.client.properties['test.ready'] == 'last'))
+        self.assertEqual(self.client.properties['test.x'], 4)
+
+    def test_server_restart(self):
+        self.server.update_property('test.x', 1)
+        self.assertTrue(_wait_for(lambda: self.client.properties.get('test.x') == 1))
+        old_epoch = self.server.epoch
+        address = self.server.socket.LAST_ENDPOINT.decode()
+        self.server.stop()
+        self.server = property_server.ZMQServer(address)
+        self.server.add_property('test.x', 0)
+        # the new server's sequence numbers start over, but its updates are not discarded as stale
+        self.assertTrue(_wait_for(lambda: self._publish_until_received('test.restarted')))
+        self.assertEqual(self.client.epoch, self.server.epoch)
+        self.assertFalse(self.client.is_current('test.x'))
+        self.client.synchronize(*self.server.get_snapshot())
+        self.assertTrue(self.client.is_current('test.x'))
+        self.assertEqual(self.client.properties['test.x'], 0)
+        # a late snapshot from the old server is ignored
+        self.client.synchronize(100, {'test.x': 'old'}, old_epoch)
+        self.assertEqual(self.client.properties['test.x'], 0)
+        self.server.update_property('test.x', 2)
+        self.assertTrue(_wait_for(lambda: self.client.properties.get('test.x') == 2))
+        self.assertEqual(self.client.gap_count, 0)
+
+    def test_reconnect_requires_snapshot(self):
+        self.assertTrue(self.client.is_current('test.x'))
+        self.client.reconnect()
+        self.assertFalse(self.client.is_current('test.x'))
+        self.assertEqual(self.client.current_through, 0)
+        self.client.synchronize(*self.server.get_snapshot())
+        self.assertTrue(self.client.is_current('test.x'))
+
+    def test_unpublishable_update_skipped(self):
+        self.server.update_property('test.unencodable', object())
+        self.server.update_property('test.x', 5)
+        self.assertTrue(_wait_for(lambda: self.client.properties.get('test.x') == 5))
+        # publication continues afterward
+        self.server.update_property('test.x', 6)
+        self.assertTrue(_wait_for(lambda: self.client.properties.get('test.x') == 6))
+
+
+class RateLimitTests(unittest.TestCase):
+    def test_invalid_rate_rejected(self):
+        for max_rate in (0, -1):
+            with self.assertRaises(ValueError):
+                property_server.PropertyServer(max_rates={'test.': max_rate})
+
+
+class VersionOneServerTests(unittest.TestCase):
+    def test_unsequenced_updates(self):
+        context = zmq.Context()
+        socket = context.socket(zmq.PUB)
+        port = socket.bind_to_random_port('tcp://127.0.0.1')
+        client = property_client.ZMQClient('tcp://127.0.0.1:{}'.format(port), context=context)
+        try:
+            client.mirror('test.')
+            def publish():
+                socket.send_multipart([b'test.x', b'5'])
+                return client.properties.get('test.x') == 5
+            self.assertTrue(_wait_for(publish))
+            self.assertFalse(client.is_current('test.x'))
+        finally:
+            client.stop()
+            socket.close()
+            context.term()
+
+if __name__ == '__main__':
+    unittest.main()
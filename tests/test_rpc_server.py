@@ -0,0 +1,294 @@
+# This code is licensed under the MIT License (see LICENSE file for details)
+
+import ctypes
+import json
+import numpy
+import threading
+import time
+import unittest
+import zmq
+
+from scope.simple_rpc import rpc_client
+from scope.simple_rpc import rpc_server
+
+def _busy(seconds):
+    # run python code (which async exceptions can interrupt) for a while
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        pass
+
+class InterrupterTests(unittest.TestCase):
+    def setUp(self):
+        self.interrupter = rpc_server.Interrupter()
+
+    def _run_in_thread(self, target):
+        thread = threading.Thread(target=target, daemon=True)
+        thread.start()
+        return thread
+
+    def test_interrupt(self):
+        armed = threading.Event()
+        result = []
+        def command():
+            try:
+                with self.interrupter.armed('client'):
+                    armed.set()
+                    _busy(5)
+                result.append('finished')
+            except KeyboardInterrupt:
+                result.append('interrupted')
+        thread = self._run_in_thread(command)
+        armed.wait()
+        self.interrupter.interrupt('other client')
+        time.sleep(0.05)
+        self.interrupter.interrupt('client')
+        thread.join(2)
+        self.assertEqual(result, ['interrupted'])
+        self.assertEqual(self.interrupter._armed, {})
+
+    def test_late_interrupt_is_cancelled(self):
+        armed = threading.Event()
+        finish = threading.Event()
+        result = []
+        def command():
+            try:
+                with self.interrupter.armed('client'):
+                    armed.set()
+                    finish.wait()
+                result.append('finished')
+                _busy(0.2) # stands in for sending the reply
+                result.append('replied')
+            except KeyboardInterrupt:
+                result.append('interrupted')
+        thread = self._run_in_thread(command)
+        armed.wait()
+        with self.interrupter._armed_lock:
+            # the command finishes and waits to disarm while an interrupt is being sent
+            finish.set()
+            time.sleep(0.05)
+            ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_ulong(thread.ident), ctypes.py_object(KeyboardInterrupt))
+        thread.join(2)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(result, ['finished', 'replied'])
+        self.assertEqual(self.interrupter._armed, {})
+
+
+class _Counter:
+    def __init__(self):
+        self.produced = 0
+        self.closed = threading.Event()
+
+    def count(self, n):
+        try:
+            for i in range(n):
+                time.sleep(0.01)
+                self.produced += 1
+                yield i
+        finally:
+            self.closed.set()
+
+    def ping(self):
+        return 'pong'
+
+    def echo(self, value):
+        return value
+
+    def array(self, n):
+        return numpy.arange(n)
+
+class _CounterServerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.context = zmq.Context()
+        self.counter = _Counter()
+        self.server = rpc_server.ZMQServer(self.counter, rpc_server.Interrupter(), 'tcp://127.0.0.1:*', context=self.context)
+        self.address = self.server.socket.LAST_ENDPOINT.decode()
+        self.server_thread = threading.Thread(target=self.server.run, daemon=True)
+        self.server_thread.start()
+
+    def tearDown(self):
+        self.server.stop()
+        self.server_thread.join()
+        self.context.destroy(linger=0)
+
+
+class MalformedRequestTests(_CounterServerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = rpc_client.ZMQClient(self.address, context=self.context)
+
+    def _assert_error_reply(self, command, *args, **kwargs):
+        with self.assertRaises(rpc_client.RPCError):
+            self.client(command, *args, **kwargs)
+        # the server is still answering
+        self.assertEqual(self.client('ping'), 'pong')
+
+    def test_malformed_batch(self):
+        self._assert_error_reply('__BATCH__')
+        self._assert_error_reply('__BATCH__', 'ping')
+        self._assert_error_reply('__BATCH__', [['ping', []]])
+        self._assert_error_reply('__BATCH__', [['ping', [], {}], 'ping'])
+        self._assert_error_reply('__BATCH__', [[1, [], {}]])
+        self._assert_error_reply('__BATCH__', [['ping', {}, []]])
+        self._assert_error_reply('__BATCH__', [['ping', [], {}]], extra=True)
+        self.assertEqual(self.client('__BATCH__', [['ping', [], {}]]), ['pong'])
+
+    def test_malformed_stream(self):
+        self._assert_error_reply('__STREAM__')
+        self._assert_error_reply('__STREAM__', 'count')
+        self._assert_error_reply('__STREAM__', 'count', 3)
+        self._assert_error_reply('__STREAM__', 'count', [3])
+        self._assert_error_reply('__STREAM__', 'count', [3], [])
+        self._assert_error_reply('__STREAM__', 'count', [3], {}, extra=True)
+
+
+class ReplyEncodingTests(_CounterServerTestCase):
+    def test_numeric_lists(self):
+        client = rpc_client.ZMQClient(self.address, context=self.context)
+        for value in ([1, 2] * 20, [1.5, 2.5] * 20, [[1, 2]] * 40, [1, 2.5] * 20, [True, 1] * 20):
+            reply = client('echo', value)
+            self.assertEqual(reply, value)
+            self.assertEqual([type(item) for item in reply], [type(item) for item in value])
+
+    def test_arrays(self):
+        client = rpc_client.ZMQClient(self.address, context=self.context)
+        reply = client('array', 40)
+        self.assertIsInstance(reply, numpy.ndarray)
+        self.assertEqual(reply.tolist(), list(range(40)))
+
+    def test_older_client(self):
+        # like a client from before binary arrays were added, which sends no request options
+        socket = self.context.socket(zmq.REQ)
+        socket.connect(self.address)
+        try:
+            for command, args, expected in [('echo', [[1, 2] * 20], [1, 2] * 20), ('array', [40], list(range(40)))]:
+                socket.send(json.dumps([command, args, {}]).encode())
+                self.assertTrue(socket.poll(2000))
+                reply_type, reply = socket.recv_multipart()
+                self.assertEqual(reply_type, b'json')
+                self.assertEqual(json.loads(reply), expected)
+        finally:
+            socket.close()
+
+
+class RequestOptionsTests(_CounterServerTestCase):
+    def test_options_accepted(self):
+        client = rpc_client.ZMQClient(self.address, context=self.context)
+        self.assertEqual(client('ping'), 'pong')
+        self.assertTrue(client._accepts_options)
+
+    def test_older_server(self):
+        socket = self.context.socket(zmq.ROUTER)
+        port = socket.bind_to_random_port('tcp://127.0.0.1')
+        def serve():
+            # like a server from before request options were added, which can't decode them
+            for i in range(3):
+                *envelope, message = socket.recv_multipart()
+                command, args, kwargs = json.loads(message)
+                if command == '__OPTIONS__':
+                    reply = [b'error', json.dumps('No such command: __OPTIONS__').encode()]
+                else:
+                    reply = [b'json', json.dumps('pong').encode()]
+                socket.send_multipart(envelope + reply)
+        thread = threading.Thread(target=serve, daemon=True)
+        thread.start()
+        client = rpc_client.ZMQClient('tcp://127.0.0.1:{}'.format(port), context=self.context)
+        try:
+            self.assertEqual(client('ping'), 'pong')
+            self.assertFalse(client._accepts_options)
+            self.assertEqual(client('ping'), 'pong')
+            thread.join(2)
+        finally:
+            client.socket.close()
+            socket.close()
+
+
+class AsyncClientTests(_CounterServerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = rpc_client.AsyncZMQClient(self.address, context=self.context)
+
+    def tearDown(self):
+        self.client.close()
+        super().tearDown()
+
+    def _in_other_thread(self, function):
+        result = []
+        thread = threading.Thread(target=lambda: result.append(function()), daemon=True)
+        thread.start()
+        thread.join(2)
+        return result[0]
+
+    def test_batch_is_per_thread(self):
+        with self.client.batch() as batch:
+            batched = self.client('ping')
+            other = self._in_other_thread(lambda: self.client('ping'))
+            self.assertEqual(other.result(2), 'pong')
+        self.assertEqual(len(batch), 1)
+        self.assertEqual(batched.value, 'pong')
+
+    def test_timeout_is_per_thread(self):
+        with self.client.timeout_sec(123):
+            self.assertEqual(self.client._timeout_sec, 123)
+            self.assertEqual(self._in_other_thread(lambda: self.client._timeout_sec), 10)
+        self.assertEqual(self.client._timeout_sec, 10)
+
+
+class StreamCancellationTests(_CounterServerTestCase):
+    def _assert_cancelled(self):
+        self.assertTrue(self.counter.closed.wait(2), 'generator was not closed')
+        self.assertLess(self.counter.produced, 100)
+
+    def test_close(self):
+        client = rpc_client.ZMQClient(self.address, context=self.context)
+        stream = client.stream('count', 1000)
+        self.assertEqual([next(stream), next(stream)], [0, 1])
+        stream.close()
+        self._assert_cancelled()
+        self.assertEqual(client('ping'), 'pong')
+        with self.assertRaises(rpc_client.RPCError):
+            stream.value
+
+    def test_abandon_with_another_call(self):
+        client = rpc_client.ZMQClient(self.address, context=self.context)
+        stream = client.stream('count', 1000)
+        next(stream)
+        self.assertEqual(client('ping'), 'pong')
+        self._assert_cancelled()
+
+    def test_garbage_collected(self):
+        client = rpc_client.ZMQClient(self.address, context=self.context)
+        stream = client.stream('count', 1000)
+        next(stream)
+        del stream
+        self._assert_cancelled()
+
+    def test_garbage_collected_in_other_thread(self):
+        client = rpc_client.ZMQClient(self.address, context=self.context)
+        streams = [client.stream('count', 1000)]
+        next(streams[0])
+        thread = threading.Thread(target=streams.clear)
+        thread.start()
+        thread.join()
+        # the cancellation is sent by the thread that owns the socket, with its next call
+        self.assertEqual(client('ping'), 'pong')
+        self._assert_cancelled()
+
+    def test_client_disconnected(self):
+        client = rpc_client.ZMQClient(self.address, context=self.context)
+        stream = client.stream('count', 1000)
+        next(stream)
+        client.socket.close()
+        self._assert_cancelled()
+
+    def test_async_close(self):
+        client = rpc_client.AsyncZMQClient(self.address, context=self.context)
+        try:
+            with client.stream('count', 1000) as stream:
+                next(stream)
+            self._assert_cancelled()
+            self.assertEqual(client('ping').result(2), 'pong')
+        finally:
+            client.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,189 @@
+# This code is licensed under the MIT License (see LICENSE file for details)
+
+import concurrent.futures
+import gc
+import json
+import struct
+import threading
+import time
+import unittest
+import zlib
+
+import numpy
+import zmq
+
+from scope import scope_client
+from scope.util import live_broadcast
+from scope.util import transfer_ism_buffer
+
+import simulated_server
+
+class SimulatedCameraTests(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.camera = simulated_server.get_server().scope.camera
+
+    def _release(self, names):
+        return [transfer_ism_buffer.release_array(name) for name in names]
+
+    def test_stream_acquire(self):
+        trigger_mode = self.camera.get_trigger_mode()
+        names, timestamps, frame_rate = self.camera.stream_acquire(3, 10)
+        images = self._release(names)
+        self.assertEqual(len(images), 3)
+        self.assertEqual(len(timestamps), 3)
+        self.assertEqual(timestamps, sorted(timestamps))
+        self.assertGreater(frame_rate, 0)
+        self.assertEqual(images[0].shape, images[-1].shape)
+        # camera state is restored afterward
+        self.assertEqual(self.camera.get_trigger_mode(), trigger_mode)
+
+    def test_iter_stream_acquire(self):
+        stream = self.camera.iter_stream_acquire(2, 10)
+        names = [name for name, timestamp in stream]
+        self.assertEqual(len(self._release(names)), 2)
+        self.assertFalse(self.camera.get_live_mode())
+
+    def test_stream_acquire_from_software_trigger_mode(self):
+        # the frame rate is restored after the trigger mode, so must be writable in software trigger mode
+        with self.camera.in_state(trigger_mode='Software'):
+            names, timestamps, frame_rate = self.camera.stream_acquire(2, 10)
+            self._release(names)
+            self.assertEqual(self.camera.get_trigger_mode(), 'Software')
+
+    def test_reader_failure_is_reported(self):
+        convert_pool = self.camera._convert_pool
+        dead_pool = concurrent.futures.ThreadPoolExecutor(1)
+        dead_pool.shutdown()
+        self.camera._convert_pool = dead_pool # conversions can't be submitted, so the reader thread fails
+        errors = []
+        def next_image():
+            try:
+                self.camera.next_image()
+            except RuntimeError as e:
+                errors.append(e)
+        try:
+            with self.camera.image_sequence_acquisition(2):
+                thread = threading.Thread(target=next_image, daemon=True)
+                thread.start()
+                thread.join(5)
+                self.assertFalse(thread.is_alive(), 'next_image() did not return')
+        finally:
+            self.camera._convert_pool = convert_pool
+        self.assertEqual(len(errors), 1)
+
+    def test_uncollected_frames_are_released(self):
+        def in_use():
+            gc.collect()
+            return sum(stats['in_use'] for stats in transfer_ism_buffer.pool_stats().values())
+        before_start = in_use()
+        with self.camera.image_sequence_acquisition(4):
+            self._release([self.camera.next_image()])
+            reader = self.camera._sequence_reader
+        self.assertTrue(reader.frames.empty())
+        self.assertIsNone(reader.next_future)
+        # only the latest image (held by the camera) remains in use
+        self.assertLessEqual(in_use(), before_start + 1)
+
+
+class TransferRegistryTests(unittest.TestCase):
+    def test_concurrent_release(self):
+        name = 'test-concurrent-release'
+        count = 1000
+        for i in range(count):
+            transfer_ism_buffer.register_array_for_transfer(name, i)
+        with concurrent.futures.ThreadPoolExecutor(8) as pool:
+            released = list(pool.map(lambda i: transfer_ism_buffer.release_array(name), range(count)))
+        self.assertEqual(sorted(released), list(range(count)))
+        self.assertNotIn(name, transfer_ism_buffer._ism_buffer_registry)
+
+    def test_release_unknown_name(self):
+        with self.assertRaises(KeyError):
+            transfer_ism_buffer.release_array('test-unknown-name')
+        with self.assertRaises(KeyError):
+            transfer_ism_buffer.borrow_array('test-unknown-name')
+        self.assertNotIn('test-unknown-name', transfer_ism_buffer._ism_buffer_registry)
+
+    def test_unpack_single_buffer(self):
+        # as sent by servers from before image data were sent in chunks
+        array = numpy.arange(12, dtype=numpy.uint16).reshape(3, 4)
+        descr = json.dumps((numpy.lib.format.dtype_to_descr(array.dtype), array.shape, 'C')).encode('ascii')
+        header = struct.pack('<H', len(descr)) + descr
+        for compressor, data in [(None, array.tobytes()), ('zlib', zlib.compress(array.tobytes()))]:
+            unpacked = transfer_ism_buffer._client_unpack_data(memoryview(bytearray(header + data)), compressor)
+            self.assertTrue((unpacked == array).all())
+
+    def test_pack_single_buffer(self):
+        # as expected by clients from before image data were sent in chunks
+        name = 'test-pack-single-buffer'
+        array = numpy.arange(12, dtype=numpy.uint16).reshape(3, 4)
+        for compressor in (None, 'zlib'):
+            transfer_ism_buffer.register_array_for_transfer(name, array)
+            packed = transfer_ism_buffer._server_pack_data(name, compressor)
+            header_len, = struct.unpack_from('<H', packed)
+            dtype, shape, order = json.loads(bytes(packed[2:header_len+2]).decode('ascii'))
+            data = bytes(packed[header_len+2:])
+            if compressor == 'zlib':
+                data = zlib.decompress(data)
+            self.assertEqual(numpy.ndarray(shape, dtype=dtype, order=order, buffer=data).tolist(), array.tolist())
+            self.assertTrue((transfer_ism_buffer._client_unpack_data(packed, compressor) == array).all())
+
+
+class LiveBroadcastTests(unittest.TestCase):
+    def setUp(self):
+        self.context = zmq.Context()
+        self.publisher = live_broadcast.LivePublisher('tcp://127.0.0.1:*', context=self.context)
+        self.address = self.publisher.socket.LAST_ENDPOINT.decode()
+
+    def tearDown(self):
+        self.publisher.stop()
+        self.context.destroy(linger=0)
+
+    def test_slow_subscriber(self):
+        # a subscriber that doesn't read its images (and, unlike a LiveSubscriber,
+        # doesn't conflate them) must not cause a backlog of images on the server
+        subscriber = self.context.socket(zmq.SUB)
+        subscriber.RCVHWM = 1
+        subscriber.connect(self.address)
+        subscriber.subscribe(live_broadcast.topic(None))
+        deadline = time.monotonic() + 2
+        while not self.publisher._topics and time.monotonic() < deadline:
+            time.sleep(0.01)
+        image = numpy.zeros((1000, 1000), dtype=numpy.uint16)
+        count = 50
+        for i in range(count):
+            self.publisher.publish(None, image, i, None)
+            time.sleep(0.02)
+        received = 0
+        while subscriber.poll(500):
+            subscriber.recv()
+            received += 1
+        subscriber.close()
+        self.assertGreater(received, 0)
+        # only the images in flight when the subscriber stopped reading arrive
+        self.assertLess(received, count // 2)
+
+
+class StreamCancellationTests(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = simulated_server.get_server()
+
+    def setUp(self):
+        self.client = scope_client.ScopeClient(self.server.server.host)
+
+    def tearDown(self):
+        simulated_server.close_client(self.client)
+
+    def test_closed_stream_stops_acquisition(self):
+        start = time.monotonic()
+        stream = self.client.camera.iter_stream_acquire(1000, 10) # would take 100 s to finish
+        image, timestamp = next(stream)
+        stream.close()
+        # the camera is only available again once the acquisition has stopped
+        self.assertFalse(self.client.camera.live_mode)
+        self.assertEqual(self.server.scope.camera.get_trigger_mode(), self.client.camera.trigger_mode)
+        self.assertLess(time.monotonic() - start, 10)
+
+if __name__ == '__main__':
+    unittest.main()